@@ -1,20 +1,40 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 import io
+import copy
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
 import os
 import time
 import boto3
-import botocore
+import botocore.config
 import json
 import requests
-from template2sh import Template2Script
+from requests.adapters import HTTPAdapter
+from template2sh import ScriptCache, Template2Script
+import sizing
 
 #region = os.getenv("AWS_REGION")
 ip = "127.0.0.1"
 bucket = os.getenv("BUCKET_NAME")
 job_num= int(os.getenv("DOMAINS_NUM"))
+forecast_hours = int(os.getenv("FORECAST_DAYS", "1")) * 24
 ftime = "2023-01-01:12:00:00Z"
+# shared concurrent uploader shipped with the post scripts, replaces one `aws s3 cp` per path
+uploader = "python /fsx/post-scripts/zUpload.py"
+# jobs of one stage are submitted, and their sbatch scripts uploaded, by this many threads;
+# also the size of the slurmrestd and S3 connection pools
+max_workers = 16
+# submit each per-domain stage as one slurm job array indexed by domain instead of one job per domain
+array_jobs = os.getenv("ARRAY_JOBS", "false").lower() == "true"
+# zone of an array task, expanded by the shell inside the job script
+array_zone = "domain_${SLURM_ARRAY_TASK_ID}"
+# decode the GFS files once per cycle in /fsx/ungrib for all domains instead of once per domain
+shared_ungrib = os.getenv("SHARED_UNGRIB", "true").lower() == "true"
+# sbatch scripts stored by content hash in s3 monitor/, loaded once per invocation in main
+script_cache = None
+# WRF scaling model, calibrated one from s3 input/sizing.json if there is one, loaded in main
+sizing_model = None
 
 template = {
     "job": {
@@ -36,7 +56,7 @@ template = {
 @lru_cache
 def s3client():
     session = boto3.session.Session()
-    s3_client = session.client("s3")
+    s3_client = session.client("s3", config=botocore.config.Config(max_pool_connections=max_workers))
     return s3_client
 
 
@@ -57,156 +77,343 @@ def headers():
             }
 
 
+@lru_cache
+def http():
+    """
+    Keep-alive session shared by every call to slurmrestd, one pooled connection per submitting thread
+    """
+    session = requests.Session()
+    session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=max_workers))
+    session.headers.update(headers())
+    return session
+
+
+def job_suffix(zone):
+    """
+    job_monitor.sh takes the domain from <stage>_domain_<n> job names, and from the task id of <stage>_array jobs
+    """
+    return "array" if zone == array_zone else zone
+
+
+def cycle_environment():
+    """
+    Values that change every forecast cycle. They reach the jobs as environment variables instead of being
+    written into the job scripts, so a script stays byte for byte the same from one cycle to the next and
+    ScriptCache stores it once; only the per-cycle sbatch header carries them
+    """
+    global bucket
+    global ftime
+    y=ftime[0:4]
+    m=ftime[5:7]
+    d=ftime[8:10]
+    h=ftime[11:13]
+    return {"FORECAST_CYCLE": f"{y}{m}{d}{h}", "FORECAST_OUTPUT": f"s3://{bucket}/outputs/{y}{m}{d}"}
+
+
+def new_job(name, cwd, dependency=None, **options):
+    """
+    Job definition copied from template, so jobs built in parallel never share state,
+    with the cycle_environment of the current forecast cycle
+    :param name: slurm job name, also the name of the sbatch script in s3 monitor/
+    :param cwd: current working directory of the job
+    :param dependency: optional slurm dependency, e.g. afterok:12
+    :param options: other job options such as nodes, cpus_per_task and tasks_per_node
+    """
+    job = copy.deepcopy(template)
+    job["job"]["name"] = name
+    job["job"].update(options)
+    job["job"]["current_working_directory"] = cwd
+    job["job"]["environment"].update(cycle_environment())
+    if dependency is not None:
+        job["job"]["dependency"] = dependency
+    return job
+
+
+def with_prelude(script, lines):
+    """
+    Insert shell lines right after the shebang of a job script
+    """
+    if not lines:
+        return script
+    shebang, _, body = script.partition("\n")
+    return f"{shebang}\n{lines.strip()}\n{body}"
+
+
+def as_array(job, zones):
+    """
+    Turn a job built for array_zone into an array job with one task per zone.
+    Array tasks share the sbatch options, so the per-domain working directory moves into the script
+    and the output of every task goes to its own domain as slurm-<task job id>.out, which keeps
+    the slurm-${SLURM_JOB_ID}.out log uploads in the job scripts unchanged.
+    An afterok dependency on the previous array becomes aftercorr, task i only waits for its task i.
+    :param job: job definition from preproc, run_wrf or post with zone=array_zone
+    :param zones: domain names, domain_1 ... domain_n
+    """
+    cwd = job["job"]["current_working_directory"]
+    job["script"] = with_prelude(job["script"], f"cd {cwd}")
+    job["job"]["current_working_directory"] = "/fsx"
+    job["job"]["array"] = f"1-{len(zones)}"
+    job["job"]["standard_output"] = cwd.replace("${SLURM_ARRAY_TASK_ID}", "%a") + "/slurm-%j.out"
+    if "dependency" in job["job"]:
+        job["job"]["dependency"] = job["job"]["dependency"].replace("afterok:", "aftercorr:")
+    return job
+
+
 def submit(data):
     global ip
     url = f"http://{ip}:8080/slurm/v0.0.37/job/submit"
-    resp = requests.post(url, data=json.dumps(data), headers=headers())
+    resp = http().post(url, data=json.dumps(data))
     print(resp)
-    jid = resp.json()["job_id"]
-    print(resp.json())
+    body = resp.json()
+    print(body)
     print(resp.status_code)
-    return jid
+    if "job_id" not in body:
+        raise RuntimeError(f"submitting {data['job']['name']} failed: {body.get('errors')}")
+    return body["job_id"]
+
+
+def submit_stage(executor, jobs, uploads):
+    """
+    Submit independent jobs concurrently and queue the upload of their sbatch scripts
+    :param executor: thread pool shared by every stage
+    :param jobs: {key: (job, zone)}, zone is None for jobs not tied to a domain
+    :param uploads: list collecting the upload futures, waited for once every stage is submitted
+    :return: {key: job_id}
+    """
+    futures = {key: executor.submit(submit, job) for key, (job, zone) in jobs.items()}
+    job_ids = {key: future.result() for key, future in futures.items()}
+    for key, (job, zone) in jobs.items():
+        convert = Template2Script(job, job_ids[key], bucket, s3client(), zone, script_cache)
+        uploads.append(executor.submit(convert.generate))
+    return job_ids
+
+
+def upload_script(sources, dest, include=None, manifest=None):
+    """
+    Shell lines uploading sources to dest with a single uploader process
+    :param sources: local files, directories or shell globs
+    :param dest: s3:// destination, ending with / to keep file names
+    :param include: optional glob patterns, only matching files are uploaded
+    :param manifest: optional run directory, its finished wrfout files (see zManifest.py) are uploaded too
+    """
+    options = "".join(f" --include \"{pattern}\"" for pattern in include or [])
+    if manifest is not None:
+        options += f" --manifest {manifest}"
+    return f"\nconda activate yunda-python39\n{uploader} {' '.join(sources)} {dest}{options}\n"
 
 
 def status(jobid):
     global ip
     url = f"http://{ip}:8080/slurm/v0.0.37/job/{jobid}"
-    resp = requests.get(url, headers=headers())
+    resp = http().get(url)
     print(resp)
     return resp.json()
 
 
 def fini(ids):
-    global bucket
-    global ftime
-    y=ftime[0:4]
-    m=ftime[5:7]
-    d=ftime[8:10]
-    h=ftime[11:13]
-    output = f"s3://{bucket}/outputs/{y}{m}{d}"
+    """
+    :param ids: post jobs to run after, forecast.done is only published when every domain was post processed
+    """
+    output = "${FORECAST_OUTPUT}"
     with open("jobs/fini.sh", "r") as f:
         script = f.read()
-    script += f"\naws s3 cp forecast.done {output}/forecast.done"
-    script += f"\naws s3 cp slurm-${{SLURM_JOB_ID}}.out {output}/logs/slurm-${{SLURM_JOB_ID}}.out\n"
-    template["job"]["nodes"] = 1
-    template["job"]["name"] = "fini"
-    template["job"]["tasks_per_node"] = 1
-    template["job"]["current_working_directory"] = "/fsx"
-    template["job"]["dependency"] = f"afterok:{':'.join([str(x) for x in ids])}"
-    template["script"] = script
-    print(template)
-
-    job_id = submit(template)
-    s3_client = s3client()
-    convert = Template2Script(template, job_id, bucket, s3_client)
-    convert.generate()
-    return job_id
+    script += upload_script(["forecast.done"], f"{output}/")
+    script += upload_script(["slurm-${SLURM_JOB_ID}.out"], f"{output}/logs/")
+    job = new_job("fini", "/fsx", f"afterok:{':'.join([str(x) for x in ids])}",
+                  nodes=1, cpus_per_task=1, tasks_per_node=1)
+    job["script"] = script
+    print(job)
+    return job
 
     
-def preproc(zone):
-    global bucket
-    global ftime
-    y=ftime[0:4]
-    m=ftime[5:7]
-    d=ftime[8:10]
-    h=ftime[11:13]
-    output = f"s3://{bucket}/outputs/{y}{m}{d}/{zone}"
+def ungrib(zone):
+    """
+    Shared ungrib job, decoding the GFS files over the ungrib window of zone's namelist.wps.
+    pre.sh of every domain whose window matches links its FILE:* intermediates instead of running ungrib.exe
+    :param zone: domain whose namelist.wps sets the window
+    """
+    output = "${FORECAST_OUTPUT}"
+    with open("jobs/ungrib.sh", "r") as f:
+        script = f.read()
+    script = with_prelude(script, f"export UNGRIB_NAMELIST=/fsx/{zone}/preproc/namelist.wps")
+    script += upload_script(["/fsx/slurm-${SLURM_JOB_ID}.out", "ungrib.*.log"], f"{output}/logs/ungrib/")
+    # one core per ungrib time window, see zUngrib.py
+    job = new_job("ungrib", "/fsx", nodes=1, cpus_per_task=12, tasks_per_node=1)
+    job["script"] = script
+    print(job)
+    return job
+
+
+def preproc(zone, uid=None):
+    output = f"${{FORECAST_OUTPUT}}/{zone}"
     with open("jobs/pre.sh", "r") as f:
         script = f.read()
-    script += f"\naws s3 cp slurm-${{SLURM_JOB_ID}}.out {output}/logs/\n"
-    script += f"\naws s3 cp preproc/geogrid.*.log {output}/logs/\n"
-    script += f"\naws s3 cp preproc/ungrib.*.log {output}/logs/\n"
-    script += f"\naws s3 cp preproc/metgrid.*.log {output}/logs/\n"
-    script += f"\naws s3 cp run/real.*.log {output}/logs/\n"
-    template["job"]["name"] = "pre_" + zone
-    template["job"]["nodes"] = 1
-    template["job"]["cpus_per_task"] = 1
-    template["job"]["tasks_per_node"] = 12
-    template["job"]["current_working_directory"] = f"/fsx/{zone}"
-    template["script"] = script
-    print(template)
-    job_id = submit(template)
-    s3_client = s3client()
-    convert = Template2Script(template, job_id, bucket, s3_client, zone)
-    convert.generate()
-    return job_id
-
-
-def run_wrf(zone, pid):
-    global bucket
-    global ftime
-    y=ftime[0:4]
-    m=ftime[5:7]
-    d=ftime[8:10]
-    h=ftime[11:13]
-    output = f"s3://{bucket}/outputs/{y}{m}{d}/{zone}"
+    # geo_em of earlier cycles, keyed by the namelist.wps domain settings
+    script = with_prelude(script, f"export GEO_CACHE=s3://{bucket}/cache/geogrid")
+    script += upload_script(["slurm-${SLURM_JOB_ID}.out", "preproc/geogrid.*.log", "preproc/geogrid_cache.*.log",
+                             "preproc/ungrib.*.log", "preproc/metgrid.*.log", "run/real.*.log"], f"{output}/logs/")
+    # afterany: if the shared ungrib job fails, the domains run their own ungrib
+    job = new_job("pre_" + job_suffix(zone), f"/fsx/{zone}", f"afterany:{uid}" if uid else None,
+                  nodes=1, cpus_per_task=1, tasks_per_node=12)
+    # metgrid.exe and real.exe cap their MPI ranks with the patch size the wrf job is sized with
+    job["job"]["environment"]["MIN_PATCH"] = str(sizing.min_patch(sizing_model))
+    job["script"] = script
+    print(job)
+    return job
+
+
+def domain_sizing(zone):
+    """
+    Nodes, MPI ranks, OpenMP threads and nproc_x/nproc_y of the domain's WRF job from its namelist.input,
+    the former fixed 2 x 24 x 4 when the namelist can't be read or sized
+    :param zone: domain name
+    """
+    try:
+        body = s3client().get_object(Bucket=bucket, Key=f"input/{zone}/namelist.input")["Body"].read()
+        plan = sizing.size_job(body.decode(), forecast_hours, sizing_model)
+    except Exception as e:
+        # any namelist the model can't size must not stop the forecast
+        print(f"sizing {zone} failed, using the default allocation: {e!r}")
+        return dict(sizing.FALLBACK)
+    print(f"sizing {zone}: {plan}")
+    return plan
+
+
+def run_wrf(zone, pid, plan=sizing.FALLBACK):
+    output = f"${{FORECAST_OUTPUT}}/{zone}"
     with open("jobs/run.sh", "r") as f:
         script = f.read()
-    script += f"\naws s3 cp ../slurm-${{SLURM_JOB_ID}}.out {output}/logs/\n"
-    script += f"aws s3 cp . {output}/wrfout/ --recursive --exclude \"*\" --include \"wrfout_*\"\n"
-    template["job"]["name"] = "wrf_" + zone
-    template["job"]["nodes"] = 2 
-    template["job"]["cpus_per_task"] = 4
-    template["job"]["tasks_per_node"] = 24
+    # the decomposition goes into namelist.input before run.sh starts wrf.exe
+    script = with_prelude(script, sizing.decomposition_script(plan))
+    script += sizing.timing_script(plan)
+    script += upload_script(["../slurm-${SLURM_JOB_ID}.out", sizing.TIMING_NAME], f"{output}/logs/")
+    # wrf.exe has exited, so every readable wrfout is final; the uploader then takes them from the manifest
+    script += "\npython /fsx/post-scripts/zManifest.py update . --final\n"
+    script += upload_script([], f"{output}/wrfout/", manifest=".")
     # please note current working directory is /fsx/{zone}
     # in run.sh script, it will change current working directory to run
-    template["job"]["current_working_directory"] = f"/fsx/{zone}"
-    template["job"]["dependency"] = f"afterok:{pid}"
-    template["script"] = script
-    print(template)
-    job_id = submit(template)
-    s3_client = s3client()
-    convert = Template2Script(template, job_id, bucket, s3_client, zone)
-    convert.generate()
-    return job_id
+    job = new_job("wrf_" + job_suffix(zone), f"/fsx/{zone}", f"afterok:{pid}", nodes=plan["nodes"],
+                  cpus_per_task=plan["cpus_per_task"], tasks_per_node=plan["tasks_per_node"])
+    job["script"] = script
+    print(job)
+    return job
     
 
-# 当前工作目录是 /fsx吗
+def post_id(zone):
+    """
+    Id of zone's post processing in the worker spool, fixed per forecast cycle so a retried post job
+    replaces the result of the failed one; the cycle is expanded by the job from its environment
+    """
+    return f"post_{zone}_${{FORECAST_CYCLE}}"
+
+
 def post(zone, jid):
-    global bucket
-    global ftime
-    y=ftime[0:4]
-    m=ftime[5:7]
-    d=ftime[8:10]
-    h=ftime[11:13]
-    output = f"s3://{bucket}/outputs/{y}{m}{d}/{zone}"
+    """
+    Lightweight client job queuing zone in the warm post worker on the head node and waiting for the result,
+    so the job fails when the post processing fails and job_monitor.sh retries it like any other job.
+    Without a live worker process_gfs runs right in this job.
+    """
+    output = f"${{FORECAST_OUTPUT}}/{zone}"
     with open("jobs/post.sh", "r") as f:
         script = f.read()
-    script += f"python process_gfs.py /fsx/{zone} {output}"
-    template["job"]["nodes"] = 1
-    template["job"]["name"] = f"post_"+zone
-    template["job"]["dependency"] = f"afterok:{jid}"
-    # 设置当前工作路径
-    template["job"]["current_working_directory"] = f"/fsx/post-scripts"
-    template["script"] = script
-    print(template)
-    job_id = submit(template)
-    s3_client = s3client()
-    convert = Template2Script(template, job_id, bucket, s3_client, zone)
-    convert.generate()
-    return job_id
+    # the zarr store lets the dashboards read a single turbine without downloading the whole day
+    script += (f"python zWorker.py submit --spool /fsx/post-spool --id {post_id(zone)} -- "
+               f"/fsx/{zone} {output} --workers ${{SLURM_CPUS_ON_NODE:-1}} --stream --incremental --parquet --zarr\n")
+    job = new_job("post_" + job_suffix(zone), "/fsx/post-scripts", f"afterok:{jid}",
+                  nodes=1, cpus_per_task=1, tasks_per_node=1)
+    job["script"] = script
+    print(job)
+    return job
+
+
+def submit_ungrib(executor, zones, uploads):
+    """
+    :return: id of the shared ungrib job, None when it isn't worth a job
+    """
+    if not shared_ungrib or len(zones) < 2:
+        return None
+    return submit_stage(executor, {"ungrib": (ungrib(zones[0]), None)}, uploads)["ungrib"]
+
+
+def submit_domains(executor, zones, uploads):
+    """
+    One job per domain and stage, chained with afterok
+    :return: {zone: {"pre": id, "wrf": id, "post": id}}, {"fini": id}, and {"ungrib": id} with shared ungrib
+    """
+    # namelists are read and sized while the preprocs are submitted
+    plans = {n: executor.submit(domain_sizing, n) for n in zones}
+    uid = submit_ungrib(executor, zones, uploads)
+    pids = submit_stage(executor, {n: (preproc(n, uid), n) for n in zones}, uploads)
+    jids = submit_stage(executor, {n: (run_wrf(n, pids[n], plans[n].result()), n) for n in zones}, uploads)
+    lids = submit_stage(executor, {n: (post(n, jids[n]), n) for n in zones}, uploads)
+    fid = submit_stage(executor, {"fini": (fini([lids[n] for n in zones]), None)}, uploads)["fini"]
+    job_ids = {n: {"pre": pids[n], "wrf": jids[n], "post": lids[n]} for n in zones}
+    job_ids["fini"] = fid
+    if uid:
+        job_ids["ungrib"] = uid
+    return job_ids
+
+
+def submit_arrays(executor, zones, uploads):
+    """
+    One job array per stage chained with aftercorr, so task i of an array starts as soon as task i
+    of the previous one succeeds; fini waits for the whole post array.
+    Four submissions whatever the number of domains.
+    Array tasks share one allocation, sized for the largest domain; WRF decomposes each domain itself.
+    :return: same map as submit_domains, with array task ids <array id>_<index>
+    """
+    plans = list(executor.map(domain_sizing, zones))
+    plan = max(plans, key=lambda p: p["nodes"] * p["tasks_per_node"] * p["cpus_per_task"])
+    plan = dict(sizing.FALLBACK, nodes=plan["nodes"], tasks_per_node=plan["tasks_per_node"],
+                cpus_per_task=plan["cpus_per_task"])
+    uid = submit_ungrib(executor, zones, uploads)
+    pid = submit_stage(executor, {"pre": (as_array(preproc(array_zone, uid), zones), None)}, uploads)["pre"]
+    jid = submit_stage(executor, {"wrf": (as_array(run_wrf(array_zone, pid, plan), zones), None)}, uploads)["wrf"]
+    lid = submit_stage(executor, {"post": (as_array(post(array_zone, jid), zones), None)}, uploads)["post"]
+    fid = submit_stage(executor, {"fini": (fini([lid]), None)}, uploads)["fini"]
+    job_ids = {n: {stage: f"{array_id}_{i}" for stage, array_id in (("pre", pid), ("wrf", jid), ("post", lid))}
+               for i, n in enumerate(zones, 1)}
+    job_ids["fini"] = fid
+    if uid:
+        job_ids["ungrib"] = uid
+    return job_ids
 
 
 def main(event, context):
+    """
+    Submit preproc -> wrf -> post for every domain and fini after all of them.
+    Jobs of one stage don't depend on each other and are submitted concurrently, a stage is only
+    submitted once the job ids it depends on are known.
+    event["arrayJobs"] overrides the ARRAY_JOBS environment variable.
+    :return: {"domain_1": {"pre": id, "wrf": id, "post": id}, ..., "fini": id}
+    """
     global ip
     global job_num
     global ftime
+    global script_cache
+    global sizing_model
     
     print(event)
     ip=event['headNode']['privateIpAddress']
     ftime=event['ftime']
     print(ip)
-    pids=[]
-    jids=[]
-    lids=[]
-
-    for i in range(1,job_num+1):
-        n='domain_'+str(i)
-        pids.append(preproc(n))
-    for i in range(1,job_num+1):
-        n='domain_'+str(i)
-        jids.append(run_wrf(n,pids[i-1]))
-    for i in range(1,job_num+1):
-        n='domain_'+str(i)
-        lids.append(post(n,jids[i-1]))
-    fini(lids)
+    zones = ['domain_'+str(i) for i in range(1,job_num+1)]
+    # create the cached clients before the threads race to do it
+    http()
+    script_cache = ScriptCache(bucket, s3client())
+    sizing_model = sizing.load_model(s3client(), bucket)
+
+    uploads = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        if event.get("arrayJobs", array_jobs):
+            job_ids = submit_arrays(executor, zones, uploads)
+        else:
+            job_ids = submit_domains(executor, zones, uploads)
+        # scripts are only needed by job_monitor.sh for retries, but a failed upload must still fail the lambda
+        for upload in uploads:
+            upload.result()
+    # the index only points at scripts that are all in s3
+    script_cache.save()
+
+    print(job_ids)
+    return job_ids
@@ -31,42 +31,119 @@ log ()
         echo "$timestamp $*"
 }
 
+###################################################################################
+# MPI ranks for metgrid.exe and real.exe: the tasks of this job, fewer when a domain of
+# the namelist ($1) can't give every rank a patch of at least MIN_PATCH x MIN_PATCH points.
+# MIN_PATCH is set by the forecast lambda from the sizing model of the wrf jobs (sizing.py)
+###################################################################################
+mpi_ranks ()
+{
+        if [ -z "$MIN_PATCH" ]
+        then
+                echo ${SLURM_NTASKS:-1}
+                return
+        fi
+        awk -F '=' -v tasks=${SLURM_NTASKS:-1} -v min_patch=$MIN_PATCH '
+        tolower($1) ~ /^ *max_dom *$/ { max_dom = $2 + 0 }
+        tolower($1) ~ /^ *e_we *$/ { n = split($2, v, ","); for (i = 1; i <= n; i++) if (v[i] + 0 > 0) we[i] = v[i] - 1 }
+        tolower($1) ~ /^ *e_sn *$/ { n = split($2, v, ","); for (i = 1; i <= n; i++) if (v[i] + 0 > 0) sn[i] = v[i] - 1 }
+        END {
+                ranks = tasks
+                for (i = 1; i <= (max_dom ? max_dom : length(we)); i++) {
+                        r = int(we[i] / min_patch) * int(sn[i] / min_patch)
+                        if (r < ranks) ranks = r
+                }
+                print (ranks < 1 ? 1 : ranks)
+        }' $1
+}
+
+# run $1 with $3 MPI ranks, output to $2; serially when that fails or there is one rank
+run_mpi ()
+{
+        if [ $3 -gt 1 ]
+        then
+                log "INFO - Starting $1 on $3 MPI ranks"
+                mpirun -np $3 ./$1 > $2 2>&1 && return 0
+                log "WARN - $1 failed on $3 MPI ranks, running it serially"
+        fi
+        log "INFO - Starting $1"
+        ./$1 >> $2 2>&1
+}
+
 ###################################################################################
 # Start Preprocessing
 ###################################################################################
 cd preproc
 echo $(pwd)
-log "INFO - Starting geogrid.exe"
-./geogrid.exe > geogrid.$day.log 2>&1
-if [ $? -ne 0 ]
+
+# geo_em only depends on the domain settings and the static data, not on the forecast date.
+# When GEO_CACHE (s3:// prefix) is set, reuse the geo_em of an earlier cycle with the same settings
+geo_cache()
+{
+        (conda activate yunda-python39 && python /fsx/post-scripts/zGeoCache.py "$@" >> geogrid_cache.$day.log 2>&1)
+}
+
+if [ -n "$GEO_CACHE" ] && geo_cache restore . $GEO_CACHE
 then
-        log "CRIT - geogrid.exe Completed with errors."
-        exit 1
+        log "INFO - geo_em restored from $GEO_CACHE, geogrid.exe skipped"
+else
+        log "INFO - Starting geogrid.exe"
+        ./geogrid.exe > geogrid.$day.log 2>&1
+        if [ $? -ne 0 ]
+        then
+                log "CRIT - geogrid.exe Completed with errors."
+                exit 1
+        fi
+        log "INFO - geogrid.exe Completed"
+        if [ -n "$GEO_CACHE" ] && ! geo_cache save . $GEO_CACHE
+        then
+                log "WARN - saving geo_em to $GEO_CACHE failed"
+        fi
 fi
-log "INFO - geogrid.exe Completed"
-
-./link_grib.csh ../../downloads/ > link_grid.$day.log 2>&1
-log "INFO - generate geog data"
 
 rm -f FILE*
 rm -f PFILE*
 
+# what the intermediate files depend on: first start/end date, interval, prefix and the Vtable,
+# the shared ungrib job (jobs/ungrib.sh) writes the same for its run
+ungrib_window()
+{
+        sed -n -E "s/^\s*(start_date|end_date|interval_seconds|prefix)\s*=\s*'?([^', ]*).*/\1=\2/p" $1
+        md5sum < Vtable | cut -c1-32
+}
 
-log "INFO - Starting ungrib.exe"
-./ungrib.exe > ungrib.$day.log 2>&1
-if [ $? -ne 0 ]
+# ungrib.exe over concurrent time windows of namelist.wps on $1 cores, serially when that fails
+parallel_ungrib()
+{
+        (conda activate yunda-python39 && python /fsx/post-scripts/zUngrib.py . --workers $1 > ungrib.$day.log 2>&1) && return 0
+        log "WARN - parallel ungrib failed, running ungrib.exe serially"
+        ./ungrib.exe >> ungrib.$day.log 2>&1
+}
+
+SHARED_UNGRIB=/fsx/ungrib
+if [ -f $SHARED_UNGRIB/window ] && [ "$(ungrib_window namelist.wps)" == "$(cat $SHARED_UNGRIB/window)" ]
 then
-        log "CRIT - ungrib.exe Completed with errors."
-        exit 1
+        prefix=$(sed -n -E "s/^\s*prefix\s*=\s*'?([^', ]*).*/\1/p" namelist.wps)
+        ln -sf $SHARED_UNGRIB/${prefix:-FILE}:* .
+        log "INFO - using the intermediate files of the shared ungrib job, ungrib.exe skipped"
+else
+        ./link_grib.csh ../../downloads/ > link_grid.$day.log 2>&1
+        log "INFO - generate geog data"
+
+        log "INFO - Starting ungrib.exe"
+        parallel_ungrib ${SLURM_NTASKS:-1}
+        if [ $? -ne 0 ]
+        then
+                log "CRIT - ungrib.exe Completed with errors."
+                exit 1
+        fi
+
+        log "INFO - ungrib.exe Completed"
 fi
 
-log "INFO - ungrib.exe Completed"
-
 rm -f met_em*
 
-log "INFO - Starting metgrid.exe"
-#mpirun -np $NP ./metgrid.exe > metgrid.$day.log 2>&1
-./metgrid.exe > metgrid.$day.log 2>&1
+run_mpi metgrid.exe metgrid.$day.log $(mpi_ranks namelist.wps)
 if [ $? -ne 0 ]
 then
         log "CRIT - metgrid.exe Completed with errors."
@@ -89,9 +166,9 @@ rm -f wrfbdy*
 rm -f wrfout*
 
 
-log "INFO - Starting real.exe"
-#mpirun -np 4 ./real.exe  > real.$day.log 2>&1
-./real.exe >real.$day.log 2>&1
+# the wrf job writes its own nproc_x/nproc_y, real.exe decomposes for its rank count
+sed -i '/^ *nproc_[xy] *=/Id' namelist.input
+run_mpi real.exe real.$day.log $(mpi_ranks namelist.input)
 if [ $? -ne 0 ]
 then
         log "CRIT - real.exe Completed with errors."
@@ -9,8 +9,9 @@ export KMP_AFFINITY=compact
 export OMP_STACKSIZE=12G
 export SLURM_EXPORT_ENV=ALL
 export WRF_VERSION=4.2.2
-export MKL_NUM_THREADS=4
-export OMP_NUM_THREADS=4
+# threads per MPI rank as sized by the forecast lambda
+export MKL_NUM_THREADS=${SLURM_CPUS_PER_TASK:-4}
+export OMP_NUM_THREADS=${SLURM_CPUS_PER_TASK:-4}
 
 
 source /apps/scripts/env.sh 3 2
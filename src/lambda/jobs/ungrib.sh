@@ -0,0 +1,51 @@
+#!/bin/bash -l
+# Decode the GFS files once per cycle for every domain. Each domain's pre job uses the FILE:*
+# intermediates of this job when its ungrib window matches, and runs its own ungrib otherwise.
+source /apps/scripts/env.sh 3 2
+
+ulimit -s unlimited
+
+day=$(date +%Y%m%d)
+UNGRIB_NAMELIST=${UNGRIB_NAMELIST:-/fsx/domain_1/preproc/namelist.wps}
+
+log ()
+{
+        timestamp=`date "+%Y.%m.%d-%H:%M:%S %Z"`
+        echo "$timestamp $*"
+}
+
+# what the intermediate files depend on: first start/end date, interval, prefix and the Vtable
+ungrib_window()
+{
+        sed -n -E "s/^\s*(start_date|end_date|interval_seconds|prefix)\s*=\s*'?([^', ]*).*/\1=\2/p" $1
+        md5sum < Vtable | cut -c1-32
+}
+
+# ungrib.exe over concurrent time windows of namelist.wps on $1 cores, serially when that fails
+parallel_ungrib()
+{
+        (conda activate yunda-python39 && python /fsx/post-scripts/zUngrib.py . --workers $1 > ungrib.$day.log 2>&1) && return 0
+        log "WARN - parallel ungrib failed, running ungrib.exe serially"
+        ./ungrib.exe >> ungrib.$day.log 2>&1
+}
+
+cd /fsx/ungrib
+echo $(pwd)
+# the window file marks a complete run, drop the one of an earlier attempt first
+rm -f window
+rm -f FILE*
+rm -f PFILE*
+cp $UNGRIB_NAMELIST namelist.wps
+
+./link_grib.csh ../downloads/ > link_grid.$day.log 2>&1
+
+log "INFO - Starting ungrib.exe"
+parallel_ungrib ${SLURM_CPUS_PER_TASK:-1}
+if [ $? -ne 0 ]
+then
+        log "CRIT - ungrib.exe Completed with errors."
+        exit 1
+fi
+log "INFO - ungrib.exe Completed"
+
+ungrib_window namelist.wps > window
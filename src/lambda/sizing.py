@@ -0,0 +1,334 @@
+"""
+Grid-aware sizing of the WRF job of a domain.
+The run time is modelled as  seconds = overhead_seconds + seconds_per_cell_step * work / cores,
+work being grid cells x time steps summed over the nests, and the smallest allocation expected to meet
+the deadline is picked. WRF's minimum patch size caps the MPI ranks of small domains, the cores left over
+go to OpenMP threads.
+Every successful run records logs/wrf_timing.json next to its outputs, calibrate refits the model from them:
+python sizing.py plan namelist.input --forecast-days 10
+python sizing.py calibrate --bucket my-bucket --save
+"""
+import argparse
+import json
+import math
+import re
+import sys
+
+import botocore.exceptions
+
+DEFAULT_MODEL = {
+    # core-seconds per grid cell and time step, physics included
+    "seconds_per_cell_step": 1.6e-5,
+    # real.exe is in the preproc job, this is wrf.exe start-up, I/O and MPI set-up
+    "overhead_seconds": 300,
+    "deadline_minutes": 180,
+    # hpc6a.48xlarge
+    "cores_per_node": 96,
+    "max_nodes": 8,
+    "threads_per_rank": 4,
+    "max_threads_per_rank": 12,
+    # smallest patch given to an MPI rank, in grid points along x and along y
+    "min_patch": 15,
+}
+# what every domain ran with before, still used when a domain's namelist can't be sized
+FALLBACK = {"nodes": 2, "tasks_per_node": 24, "cpus_per_task": 4, "nproc_x": None, "nproc_y": None}
+MODEL_KEY = "input/sizing.json"
+TIMING_NAME = "wrf_timing.json"
+
+
+def parse_value(text):
+    text = text.strip()
+    for convert in (int, lambda v: float(v.lower().replace("d", "e"))):
+        try:
+            return convert(text)
+        except ValueError:
+            pass
+    if text.lower() in (".true.", "t"):
+        return True
+    if text.lower() in (".false.", "f"):
+        return False
+    return text.strip("'\"")
+
+
+def parse_namelist(text):
+    """
+    Minimal Fortran namelist reader, enough for namelist.input
+    :return: {group: {key: [values]}}, group and key names in lower case
+    """
+    groups = {}
+    group = key = None
+    for line in text.splitlines():
+        line = line.split("!", 1)[0].strip()
+        if not line:
+            continue
+        if line.startswith("&"):
+            group = groups.setdefault(line[1:].strip().lower(), {})
+            key = None
+        elif line == "/":
+            group = key = None
+        elif group is not None:
+            match = re.match(r"(\w+)\s*=\s*(.*)$", line)
+            if match:
+                key = match.group(1).lower()
+                group[key] = []
+                line = match.group(2)
+            if key is not None:
+                group[key].extend(parse_value(v) for v in line.split(",") if v.strip())
+    return groups
+
+
+def per_domain(values, max_dom, default=None):
+    values = list(values or [default])
+    return (values + values[-1:] * max_dom)[:max_dom]
+
+
+def numbers(name, values, minimum):
+    """
+    :return: values, ValueError if one is still a placeholder or below minimum
+    """
+    if any(isinstance(v, bool) or not isinstance(v, (int, float)) or v < minimum for v in values):
+        raise ValueError(f"{name} = {values} can't be sized, expected numbers >= {minimum}")
+    return values
+
+
+def domain_work(namelist, forecast_hours):
+    """
+    :param namelist: parsed namelist.input
+    :param forecast_hours: run length used when run_days/run_hours are still placeholders
+    :return: grid cells x time steps over all nests, [(mass points along x, along y) of every nest]
+    :raise ValueError: &domains or one of its sizes is missing, or a value is still a placeholder or out of range
+    """
+    if "domains" not in namelist:
+        raise ValueError("the namelist has no &domains group")
+    domains = namelist["domains"]
+    missing = [key for key in ("e_we", "e_sn", "e_vert", "time_step") if key not in domains]
+    if missing:
+        raise ValueError(f"&domains doesn't set {', '.join(missing)}")
+    max_dom = numbers("max_dom", domains.get("max_dom", [1])[:1], 1)[0]
+    e_we = numbers("e_we", per_domain(domains["e_we"], max_dom), 2)
+    e_sn = numbers("e_sn", per_domain(domains["e_sn"], max_dom), 2)
+    e_vert = numbers("e_vert", per_domain(domains["e_vert"], max_dom), 2)
+    ratio = numbers("parent_time_step_ratio", per_domain(domains.get("parent_time_step_ratio"), max_dom, 1), 1)
+    parent = numbers("parent_id", per_domain(domains.get("parent_id"), max_dom, 1), 1)
+    time_step = numbers("time_step", domains["time_step"][:1], 0)[0]
+    if time_step <= 0:
+        raise ValueError(f"time_step = {time_step} can't be sized")
+    # a nest's parent comes before it
+    if any(parent[d] > d for d in range(1, max_dom)):
+        raise ValueError(f"parent_id = {parent} can't be sized")
+
+    control = namelist.get("time_control", {})
+    units = {"run_days": 86400, "run_hours": 3600, "run_minutes": 60, "run_seconds": 1}
+    lengths = [control.get(key, [0])[0] for key in units]
+    if all(isinstance(length, int) for length in lengths) and any(lengths):
+        run_seconds = sum(length * unit for length, unit in zip(lengths, units.values()))
+    else:
+        run_seconds = forecast_hours * 3600
+
+    work = 0
+    steps = []
+    for d in range(max_dom):
+        # a nest takes parent_time_step_ratio steps for every step of its parent
+        steps.append(run_seconds / time_step if d == 0 else steps[parent[d] - 1] * ratio[d])
+        work += (e_we[d] - 1) * (e_sn[d] - 1) * (e_vert[d] - 1) * steps[d]
+    return work, [(e_we[d] - 1, e_sn[d] - 1) for d in range(max_dom)]
+
+
+def decompose(ranks, grids, min_patch):
+    """
+    nproc_x x nproc_y = ranks keeping every patch of every nest at least min_patch points wide,
+    the most square patches on the outer domain first
+    :return: (nproc_x, nproc_y), None if the domains are too small for that many ranks
+    """
+    best = None
+    nx, ny = grids[0]
+    for nproc_x in range(1, ranks + 1):
+        if ranks % nproc_x:
+            continue
+        nproc_y = ranks // nproc_x
+        if any(x // nproc_x < min_patch or y // nproc_y < min_patch for x, y in grids):
+            continue
+        skew = abs(math.log((nx / nproc_x) / (ny / nproc_y)))
+        if best is None or skew < best[0]:
+            best = (skew, nproc_x, nproc_y)
+    return best[1:] if best else None
+
+
+def allocation(nodes, grids, model):
+    """
+    Fill nodes with MPI ranks of threads_per_rank threads, using more threads per rank when the
+    domains can't take that many ranks; on a single node the cores the ranks of tiny domains leave over
+    are split among them as OpenMP threads.
+    :return: dict of nodes, tasks_per_node, cpus_per_task, nproc_x, nproc_y, or None
+    """
+    cores_per_node = model["cores_per_node"]
+    for threads in range(model["threads_per_rank"], model["max_threads_per_rank"] + 1):
+        if cores_per_node % threads:
+            continue
+        tasks_per_node = cores_per_node // threads
+        nproc = decompose(tasks_per_node * nodes, grids, model["min_patch"])
+        if nproc:
+            return {"nodes": nodes, "tasks_per_node": tasks_per_node, "cpus_per_task": threads,
+                    "nproc_x": nproc[0], "nproc_y": nproc[1]}
+    if nodes > 1:
+        return None
+    for ranks in range(cores_per_node // model["threads_per_rank"], 0, -1):
+        nproc = decompose(ranks, grids, model["min_patch"])
+        if nproc:
+            return {"nodes": 1, "tasks_per_node": ranks, "cpus_per_task": cores_per_node // ranks,
+                    "nproc_x": nproc[0], "nproc_y": nproc[1]}
+    return None
+
+
+def min_patch(model=None):
+    """
+    Smallest patch of an MPI rank, the preproc jobs get it as MIN_PATCH so metgrid.exe and real.exe
+    limit their ranks by the same rule as the WRF decomposition
+    """
+    return dict(DEFAULT_MODEL, **(model or {}))["min_patch"]
+
+
+def predicted_seconds(work, cores, model):
+    return model["overhead_seconds"] + model["seconds_per_cell_step"] * work / cores
+
+
+def size_job(namelist_text, forecast_hours, model=None):
+    """
+    Smallest allocation whose predicted run time meets the deadline, or the fastest one there is
+    :param namelist_text: content of the domain's namelist.input
+    :param forecast_hours: forecast length
+    :param model: scaling model, DEFAULT_MODEL entries it doesn't set are used
+    :return: allocation dict with work and predicted_minutes added
+    """
+    model = dict(DEFAULT_MODEL, **(model or {}))
+    work, grids = domain_work(parse_namelist(namelist_text), forecast_hours)
+    best = None
+    for nodes in range(1, model["max_nodes"] + 1):
+        plan = allocation(nodes, grids, model)
+        if plan is None:
+            break
+        cores = plan["nodes"] * plan["tasks_per_node"] * plan["cpus_per_task"]
+        plan.update(work=work, predicted_minutes=round(predicted_seconds(work, cores, model) / 60, 1))
+        if best is None or plan["predicted_minutes"] < best["predicted_minutes"]:
+            best = plan
+        if plan["predicted_minutes"] <= model["deadline_minutes"]:
+            break
+    if best is None:
+        raise ValueError(f"domains {grids} are smaller than one {model['min_patch']} point patch")
+    return best
+
+
+def decomposition_script(plan, namelist="run/namelist.input"):
+    """
+    Shell lines writing the chosen nproc_x/nproc_y into &domains, nothing for the fallback sizing
+    """
+    if not plan.get("nproc_x"):
+        return ""
+    return (f"\nsed -i -e '/^ *nproc_[xy] *=/Id' "
+            f"-e 's/^ *&domains.*/&\\n nproc_x = {plan['nproc_x']},\\n nproc_y = {plan['nproc_y']},/I' {namelist}\n")
+
+
+def timing_script(plan):
+    """
+    Shell lines run in the WRF run directory after run.sh, recording what calibrate needs
+    when wrf.exe completed; JOB_FINISH_TIME is set by run.sh
+    """
+    if "work" not in plan:
+        return ""
+    cores = plan["nodes"] * plan["tasks_per_node"] * plan["cpus_per_task"]
+    record = json.dumps({key: plan[key] for key in ("work", "nodes", "tasks_per_node", "cpus_per_task",
+                                                    "predicted_minutes")})
+    return (f"\nif grep -q 'SUCCESS COMPLETE WRF' rsl.out.0000 2>/dev/null; then\n"
+            f"  echo '{record[:-1]}, \"cores\": {cores}, \"seconds\": '${{JOB_FINISH_TIME:-0}}'}}' > {TIMING_NAME}\n"
+            f"fi\n")
+
+
+def load_model(s3_client, bucket):
+    """
+    Calibrated model from s3 input/sizing.json, DEFAULT_MODEL if there is none
+    """
+    try:
+        body = s3_client.get_object(Bucket=bucket, Key=MODEL_KEY)["Body"].read()
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] != "NoSuchKey":
+            raise
+        return dict(DEFAULT_MODEL)
+    return dict(DEFAULT_MODEL, **json.loads(body))
+
+
+def calibrate(records, model=None):
+    """
+    Least squares fit of overhead_seconds and seconds_per_cell_step to past runs
+    :param records: dicts with work, cores and seconds, as written by timing_script
+    :param model: model whose other entries are kept
+    """
+    model = dict(DEFAULT_MODEL, **(model or {}))
+    points = [(r["work"] / r["cores"], r["seconds"]) for r in records if r.get("seconds") and r.get("cores")]
+    if not points:
+        return model
+    n = len(points)
+    mean_x = sum(x for x, _ in points) / n
+    mean_y = sum(y for _, y in points) / n
+    var_x = sum((x - mean_x) ** 2 for x, _ in points)
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in points) / var_x if var_x > 0 else 0
+    overhead = mean_y - slope * mean_x
+    if slope <= 0 or overhead < 0:
+        # too few or too similar runs to separate the two terms, keep the overhead and fit the slope
+        overhead = min(model["overhead_seconds"], min(y for _, y in points))
+        slope = sum(y - overhead for _, y in points) / sum(x for x, _ in points)
+    model.update(seconds_per_cell_step=slope, overhead_seconds=overhead, calibrated_runs=n)
+    return model
+
+
+def read_timings(s3_client, bucket, prefix="outputs/"):
+    records = []
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            if obj["Key"].endswith(f"/logs/{TIMING_NAME}"):
+                body = s3_client.get_object(Bucket=bucket, Key=obj["Key"])["Body"].read()
+                records.append(json.loads(body))
+    return records
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="size WRF jobs from namelist.input and calibrate the scaling model")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    plan_parser = subparsers.add_parser("plan", help="print the allocation chosen for a namelist.input")
+    plan_parser.add_argument("namelist")
+    plan_parser.add_argument("--forecast-days", type=float, default=1)
+    plan_parser.add_argument("--model", help="model json, default DEFAULT_MODEL")
+    calibrate_parser = subparsers.add_parser("calibrate", help="fit the model to the recorded run timings")
+    calibrate_parser.add_argument("--bucket", required=True)
+    calibrate_parser.add_argument("--prefix", default="outputs/")
+    calibrate_parser.add_argument("--save", action="store_true", help=f"write the model to s3 {MODEL_KEY}")
+    args = parser.parse_args(argv)
+
+    if args.command == "plan":
+        model = None
+        if args.model:
+            with open(args.model) as f:
+                model = json.load(f)
+        with open(args.namelist) as f:
+            text = f.read()
+        try:
+            plan = size_job(text, args.forecast_days * 24, model)
+        except ValueError as e:
+            print(f"{args.namelist} can't be sized: {e}", file=sys.stderr)
+            return 1
+        print(json.dumps(plan, indent=1))
+        return 0
+
+    import boto3
+    s3_client = boto3.client("s3")
+    records = read_timings(s3_client, args.bucket, args.prefix)
+    model = calibrate(records, load_model(s3_client, args.bucket))
+    print(f"{len(records)} runs")
+    print(json.dumps(model, indent=1))
+    if args.save:
+        s3_client.put_object(Bucket=args.bucket, Key=MODEL_KEY, Body=json.dumps(model, indent=1).encode())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,25 +1,125 @@
+import hashlib
+import io
 import os
+import threading
 import boto3
+import botocore.exceptions
+
+
+class ScriptCache:
+    """
+    Content addressed store of rendered scripts in s3:
+    monitor/cache/<sha256>.sh holds each distinct script, monitor/index maps job name to the hashes of its sbatch
+    script and of the job script that one sources, one "<job name> <sbatch sha256> <script sha256>" per line.
+    Scripts already referenced by the index are never uploaded again, so a cycle whose job scripts didn't change
+    only uploads the sbatch headers (their dependencies and environment hold the new job ids and the cycle)
+    and the index. Saving the index deletes the cached scripts it no longer references.
+    """
+    cache_prefix = "monitor/cache"
+    index_key = "monitor/index"
+
+    def __init__(self, bucket, s3_client):
+        self.bucket = bucket
+        self.s3_client = s3_client
+        self.index = self.load_index()
+        self.known = set(digest for digests in self.index.values() for digest in digests)
+        self.changed = False
+        # Template2Script.generate runs in threads of forecast.main
+        self.lock = threading.Lock()
+
+    def load_index(self):
+        try:
+            body = self.s3_client.get_object(Bucket=self.bucket, Key=self.index_key)["Body"].read().decode()
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] != "NoSuchKey":
+                raise
+            return {}
+        index = {}
+        for line in body.splitlines():
+            fields = line.split()
+            if fields:
+                index[fields[0]] = fields[1:]
+        return index
+
+    def put(self, content):
+        """
+        :param content: script text
+        :return: sha256 of content, the script is in s3 as monitor/cache/<sha256>.sh
+        """
+        digest = hashlib.sha256(content.encode()).hexdigest()
+        with self.lock:
+            if digest in self.known:
+                return digest
+            self.known.add(digest)
+        self.s3_client.put_object(Bucket=self.bucket, Key="{}/{}.sh".format(self.cache_prefix, digest),
+                                  Body=content.encode())
+        return digest
+
+    def record(self, name, digests):
+        with self.lock:
+            if self.index.get(name) != digests:
+                self.index[name] = digests
+                self.changed = True
+
+    def save(self):
+        """
+        Write the index once all jobs are generated
+        """
+        with self.lock:
+            if not self.changed:
+                return
+            body = "".join("{} {}\n".format(name, " ".join(digests)) for name, digests in sorted(self.index.items()))
+            self.changed = False
+        self.s3_client.put_object(Bucket=self.bucket, Key=self.index_key, Body=body.encode())
+        self.prune()
+
+    def prune(self):
+        """
+        Delete the scripts in monitor/cache that the index doesn't reference, such as the sbatch headers
+        of earlier cycles and job scripts that changed since
+        :return: number of deleted scripts
+        """
+        with self.lock:
+            referenced = set(digest for digests in self.index.values() for digest in digests)
+        stale = []
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.cache_prefix + "/"):
+            for obj in page.get("Contents", []):
+                digest = os.path.basename(obj["Key"])[:-len(".sh")]
+                if obj["Key"].endswith(".sh") and digest not in referenced:
+                    stale.append({"Key": obj["Key"]})
+        # delete_objects takes at most 1000 keys
+        for i in range(0, len(stale), 1000):
+            self.s3_client.delete_objects(Bucket=self.bucket, Delete={"Objects": stale[i:i + 1000], "Quiet": True})
+        with self.lock:
+            self.known -= set(os.path.basename(obj["Key"])[:-len(".sh")] for obj in stale)
+        return len(stale)
+
 
 class Template2Script:
-    def __init__(self, job_template, job_id, bucket, s3_client, zone=None):
+    def __init__(self, job_template, job_id, bucket, s3_client, zone=None, cache=None):
 
         self.template = job_template
         self.job_id = str(job_id)
         self.monitor_home = "/fsx/monitor"
         self.bucket = bucket
-        # Since this class run in lambda context, the only directory in lambda context can access is /tmp
-        # and there is storage limitation is 512MB by default, so please don't place large file in it
-        self.local_dir = "/tmp"
+        # Scripts are rendered in memory and stored by content hash, see ScriptCache.
+        # Without a shared cache, generate() saves the index itself
+        self.cache = cache
+        self.script_digest = None
 
         self.job_options_map = {
             "name": "--job-name",
             "nodes": "--nodes",
-            "cpus_per_task": "--gpus-per-task",
+            "cpus_per_task": "--cpus-per-task",
             "tasks_per_node": "--ntasks-per-node",
             "current_working_directory": "--chdir",
             "requeue": "--requeue",
-            "dependency": "--dependency"
+            "dependency": "--dependency",
+            # job arrays, one task per domain; job_monitor.sh resubmits a single failed task
+            # with sbatch --array=<task id>, which overrides the range below
+            "array": "--array",
+            "standard_output": "--output"
         }
 
         self.generator_func_map = {
@@ -32,16 +132,19 @@ class Template2Script:
 
     def job_options_generator(self, file_pointer, template_dict):
         """
-        :param file_pointer: point to sbatch script in /tmp folder
+        :param file_pointer: in-memory sbatch script
         :param template_dict: slurm job details in JSON format
         :return:
         """
         job_options = template_dict['job']
         for opt_key in job_options:
             if opt_key == "environment":
+                # sbatch only keeps the last --export, so every variable goes on one line; the forecast cycle
+                # is passed this way, a retried job must see the same one
                 env = job_options[opt_key]
-                for env_key in env:
-                    file_pointer.write("#SBATCH --export={}={}\n".format(env_key, env[env_key]))
+                if env:
+                    file_pointer.write("#SBATCH --export={}\n".format(
+                        ",".join("{}={}".format(env_key, env[env_key]) for env_key in env)))
             elif opt_key == "current_working_directory":
                 # When retrying, sbatch script will be placed in /fsx/monitor
                 # so replace current_working_directory with that path hardcode
@@ -52,23 +155,30 @@ class Template2Script:
 
     def script_generator(self, file_pointer, template_dict):
         script_content = template_dict['script']
-        job_script_path = r'{}/{}_script.sh'.format(self.local_dir, self.prefix)
-        s3_obj_name = "monitor/{}_script.sh".format(self.prefix)
-        with open(job_script_path, 'w') as script_pointer:
-            script_pointer.write(script_content)
-        self.s3_client.upload_file(job_script_path, self.bucket, s3_obj_name)
-        file_pointer.write("source ./{}\n".format(self.prefix))
+        digest = self.cache.put(script_content)
+        self.script_digest = digest
+        # sbatch runs in /fsx/monitor, where job_monitor.sh keeps its copies of monitor/cache
+        file_pointer.write("source ./cache/{}.sh\n".format(digest))
 
     def generate(self):
-        job_sbatch_path = r'{}/{}.sh'.format(self.local_dir, self.prefix)
-        s3_obj_name = "monitor/{}.sh".format(self.prefix)
-        with open(job_sbatch_path, 'w') as file_pointer:
-            file_pointer.write("#!/bin/bash\n")
-            for key in self.template:
-                func_name = self.generator_func_map[key]
-                func = getattr(Template2Script, func_name)
-                func(self, file_pointer, self.template)
-        self.s3_client.upload_file(job_sbatch_path, self.bucket, s3_obj_name)
+        """
+        Store the sbatch script and the job script it sources, and point the index at both
+        :return: sha256 of the sbatch script
+        """
+        save = self.cache is None
+        if save:
+            self.cache = ScriptCache(self.bucket, self.s3_client)
+        file_pointer = io.StringIO()
+        file_pointer.write("#!/bin/bash\n")
+        for key in self.template:
+            func_name = self.generator_func_map[key]
+            func = getattr(Template2Script, func_name)
+            func(self, file_pointer, self.template)
+        digest = self.cache.put(file_pointer.getvalue())
+        self.cache.record(self.prefix, [digest, self.script_digest])
+        if save:
+            self.cache.save()
+        return digest
 
 
 # if __name__ == '__main__':
@@ -0,0 +1,158 @@
+"""
+Tests for the ScriptCache index and its upload skipping and pruning, against a moto s3 bucket
+python -m pytest test_template2sh.py
+"""
+import copy
+
+import pytest
+
+pytest.importorskip("moto")
+
+import boto3
+from moto import mock_aws
+
+from template2sh import ScriptCache, Template2Script
+
+BUCKET = "bkt"
+JOBS = {
+    "pre_domain_1": "#!/bin/bash\necho pre\n",
+    "wrf_domain_1": "#!/bin/bash\necho wrf\n",
+}
+
+
+class RecordingClient:
+    """
+    Forwards to the real client and records the keys of put_object calls
+    """
+    def __init__(self, client):
+        self.client = client
+        self.puts = []
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def put_object(self, **kwargs):
+        self.puts.append(kwargs["Key"])
+        return self.client.put_object(**kwargs)
+
+
+def template(name, script, cycle, dependency=None):
+    job = {
+        "name": name,
+        "nodes": 1,
+        "current_working_directory": "/fsx/scripts",
+        "environment": {"FORECAST_CYCLE": cycle, "FORECAST_OUTPUT": "s3://{}/outputs/{}".format(BUCKET, cycle[:8])},
+    }
+    if dependency:
+        job["dependency"] = dependency
+    return {"job": job, "script": script}
+
+
+def submit_cycle(client, cycle, jobs=JOBS):
+    """
+    Render every job of a cycle with a shared cache like forecast.main does
+    :return: {job name: sbatch sha256}
+    """
+    cache = ScriptCache(BUCKET, client)
+    digests = {}
+    for job_id, (name, script) in enumerate(sorted(jobs.items()), 1):
+        digests[name] = Template2Script(template(name, script, cycle, "afterok:{}".format(job_id)), job_id,
+                                        BUCKET, client, cache=cache).generate()
+    cache.save()
+    return digests
+
+
+def read(client, key):
+    return client.get_object(Bucket=BUCKET, Key=key)["Body"].read().decode()
+
+
+def cached_digests(client):
+    response = client.list_objects_v2(Bucket=BUCKET, Prefix=ScriptCache.cache_prefix + "/")
+    return set(obj["Key"].split("/")[-1][:-len(".sh")] for obj in response.get("Contents", []))
+
+
+def read_index(client):
+    lines = read(client, ScriptCache.index_key).splitlines()
+    return dict((fields[0], fields[1:]) for fields in (line.split() for line in lines))
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=BUCKET)
+        yield RecordingClient(client)
+
+
+def test_first_cycle_writes_scripts_and_index(s3):
+    digests = submit_cycle(s3, "2026101800")
+    index = read_index(s3)
+    assert sorted(index) == sorted(JOBS)
+    assert cached_digests(s3) == set(digest for pair in index.values() for digest in pair)
+    for name, script in JOBS.items():
+        sbatch_digest, script_digest = index[name]
+        assert sbatch_digest == digests[name]
+        assert read(s3, "monitor/cache/{}.sh".format(script_digest)) == script
+        header = read(s3, "monitor/cache/{}.sh".format(sbatch_digest))
+        assert header.startswith("#!/bin/bash\n#SBATCH --job-name={}\n".format(name))
+        assert "#SBATCH --chdir=/fsx/monitor\n" in header
+        assert "#SBATCH --export=FORECAST_CYCLE=2026101800,FORECAST_OUTPUT=s3://bkt/outputs/20261018\n" in header
+        assert header.endswith("source ./cache/{}.sh\n".format(script_digest))
+
+
+def test_next_cycle_uploads_headers_and_prunes(s3):
+    submit_cycle(s3, "2026101800")
+    first = read_index(s3)
+    s3.puts.clear()
+
+    submit_cycle(s3, "2026101900")
+    second = read_index(s3)
+    # job scripts don't depend on the cycle, only the headers and the index are uploaded again
+    assert [second[name][1] for name in JOBS] == [first[name][1] for name in JOBS]
+    assert sorted(s3.puts) == sorted(["monitor/cache/{}.sh".format(second[name][0]) for name in JOBS] +
+                                     [ScriptCache.index_key])
+    # the headers of the first cycle are gone
+    assert cached_digests(s3) == set(digest for pair in second.values() for digest in pair)
+
+
+def test_unchanged_cycle_uploads_nothing(s3):
+    submit_cycle(s3, "2026101800")
+    s3.puts.clear()
+    submit_cycle(s3, "2026101800")
+    assert s3.puts == []
+
+
+def test_changed_script_replaces_cached_copy(s3):
+    submit_cycle(s3, "2026101800")
+    old = read_index(s3)["wrf_domain_1"][1]
+    jobs = dict(JOBS, wrf_domain_1="#!/bin/bash\necho wrf v2\n")
+    submit_cycle(s3, "2026101800", jobs)
+    new = read_index(s3)["wrf_domain_1"][1]
+    assert new != old
+    assert old not in cached_digests(s3)
+    assert read(s3, "monitor/cache/{}.sh".format(new)) == jobs["wrf_domain_1"]
+
+
+def test_pruned_script_is_uploaded_again(s3):
+    """
+    A script pruned in one cycle and needed again later must not be skipped as already known
+    """
+    cache = ScriptCache(BUCKET, s3)
+    digest = cache.put("echo a\n")
+    cache.record("job", [digest])
+    cache.save()
+    cache.record("job", [cache.put("echo b\n")])
+    cache.save()
+    assert digest not in cached_digests(s3)
+    assert cache.put("echo a\n") == digest
+    assert digest in cached_digests(s3)
+
+
+def test_generate_without_cache_saves_index(s3):
+    job = template("post_domain_1", "#!/bin/bash\necho post\n", "2026101800")
+    digest = Template2Script(copy.deepcopy(job), 3, BUCKET, s3).generate()
+    assert read_index(s3)["post_domain_1"][0] == digest
+    assert len(cached_digests(s3)) == 2
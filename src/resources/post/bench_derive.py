@@ -0,0 +1,99 @@
+'''
+派生变量核函数与MetPy的一致性检查和耗时对比
+python bench_derive.py --shape 4 10 300 300 --dtype float32
+一致性超出容差时以非零状态退出；逐个核函数的一致性测试见test_derive.py
+'''
+import argparse
+import sys
+import time
+
+import numpy as np
+import xarray as xr
+
+import zDerive
+
+
+def make_inputs(shape, dtype, seed=0):
+    '''构造单调递减的气压和合理范围内的温度、混合比、风场，垂直维为第二维'''
+    rng = np.random.default_rng(seed)
+    nt, nz = shape[:2]
+    dp = rng.uniform(5, 30, size=shape)
+    pres = 1010. - np.cumsum(dp, axis=1)
+    t = 300. - 0.0065 * (1010. - pres) * 8 + rng.normal(0, 0.5, size=shape)
+    qv = rng.uniform(0.001, 0.02, size=shape)
+    u = rng.normal(0, 8, size=shape)
+    v = rng.normal(0, 8, size=shape)
+    u.flat[:10] = 0.
+    v.flat[:10] = 0.
+    dims = ['Time', 'bottom_top', 'south_north', 'west_east'][:len(shape)]
+    return {name: xr.DataArray(array.astype(dtype), dims=dims)
+            for name, array in zip(['pres', 't', 'qv', 'u', 'v'], [pres, t, qv, u, v])}
+
+
+def metpy_reference(inputs):
+    from metpy.calc import wind_speed, wind_direction, density, potential_temperature, static_stability
+    from metpy.units import units
+    # 参考值统一用float64计算，float32核函数与之比较
+    pres = inputs['pres'].values.astype(np.float64) * units('hPa')
+    t = inputs['t'].values.astype(np.float64) * units('degK')
+    u = inputs['u'].values.astype(np.float64) * units('m/s')
+    v = inputs['v'].values.astype(np.float64) * units('m/s')
+    qv = inputs['qv'].values.astype(np.float64) * units('kg/kg')
+    return {
+        'wind_speed': wind_speed(u, v).m_as('m/s'),
+        'wind_direction': wind_direction(u, v).m_as('degree'),
+        'density': density(pres, t, qv).m_as('kg/m**3'),
+        'potential_temperature': potential_temperature(pres, t).m_as('K'),
+        'static_stability': static_stability(pres, t, 1).m_as('J/kg/hPa**2'),
+    }
+
+
+def kernel_results(inputs):
+    pres, t, qv, u, v = (inputs[name].values for name in ['pres', 't', 'qv', 'u', 'v'])
+    return {
+        'wind_speed': zDerive.wind_speed(u, v),
+        'wind_direction': zDerive.wind_direction(u, v),
+        'density': zDerive.density(pres, t, qv),
+        'potential_temperature': zDerive.potential_temperature(pres, t),
+        'static_stability': zDerive.static_stability(pres, t, 1),
+    }
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="zDerive vs MetPy parity and timing")
+    parser.add_argument("--shape", type=int, nargs='+', default=[4, 10, 200, 200])
+    parser.add_argument("--dtype", default="float64", choices=["float32", "float64"])
+    parser.add_argument("--rtol", type=float, default=None, help="default 1e-10 for float64, 1e-4 for float32")
+    args = parser.parse_args()
+    rtol = args.rtol if args.rtol is not None else (1e-10 if args.dtype == 'float64' else 1e-4)
+
+    inputs = make_inputs(tuple(args.shape), args.dtype)
+    t_metpy, expected = timed(metpy_reference, inputs)
+    t_kernel, actual = timed(kernel_results, inputs)
+
+    failed = False
+    print(f"{'variable':<24} {'max abs diff':>14} {'scaled diff':>14}")
+    for name, reference in expected.items():
+        reference = np.asarray(reference, dtype=np.float64)
+        result = np.asarray(actual[name], dtype=np.float64)
+        abs_diff = np.abs(result - reference)
+        if name == 'wind_direction':
+            # 0度与360度等价
+            abs_diff = np.minimum(abs_diff, np.abs(360. - abs_diff))
+        # 以参考场的量级归一化，避免接近0的格点放大相对误差
+        scaled_diff = abs_diff.max() / np.abs(reference).max()
+        ok = scaled_diff <= rtol
+        failed |= not ok
+        print(f"{name:<24} {abs_diff.max():>14.3e} {scaled_diff:>14.3e} {'ok' if ok else 'FAILED'}")
+    print(f"metpy: {t_metpy:.3f}s  zDerive: {t_kernel:.3f}s  numexpr: {zDerive.ne is not None}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+'''
+interp3dpoint_wrfout 微基准
+对比逐风机sel循环与一次高级索引的耗时，并检查两者结果一致
+python bench_interp3dpoint.py --turbines 100 1000 10000 20000
+'''
+import argparse
+import time
+
+import numpy as np
+import xarray as xr
+
+from zCal import interp3dpoint_wrfout
+
+
+def interp3dpoint_loop(da_input, target_level):
+    '''原实现：逐风机sel + loc赋值'''
+    da_interp3d = da_input.isel(level=0).copy()
+    for id in da_input.id:
+        da_interp3d.loc[dict(id=id)] = da_input.sel(id=id, level=target_level.sel(id=id))
+    da_interp3d.coords['level'] = target_level
+    return da_interp3d
+
+
+def make_inputs(n_turbines, n_times=4, levels=(70, 80, 90, 100, 110, 120, 140), seed=0):
+    rng = np.random.default_rng(seed)
+    names = np.array([f"WT{i:05d}" for i in range(n_turbines)])
+    times = np.arange('2023-09-14T00', n_times, dtype='datetime64[h]')
+    da_input = xr.DataArray(rng.normal(size=(n_times, len(levels), n_turbines)).astype(np.float32),
+                            dims=['time', 'level', 'id'], coords=[times, list(levels), names])
+    target_level = xr.DataArray(rng.choice(levels, n_turbines), dims='id', coords={'id': names})
+    return da_input, target_level
+
+
+def timeit(func, *args, repeat=3):
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="interp3dpoint_wrfout microbenchmark")
+    parser.add_argument("--turbines", type=int, nargs='+', default=[100, 1000, 10000, 20000])
+    parser.add_argument("--loop-max", type=int, default=2000,
+                        help="skip the per-turbine loop above this many turbines, it is too slow to wait for")
+    args = parser.parse_args()
+
+    print(f"{'turbines':>10} {'loop (s)':>12} {'gather (s)':>12} {'speedup':>10}")
+    for n_turbines in args.turbines:
+        da_input, target_level = make_inputs(n_turbines)
+        t_gather, result = timeit(interp3dpoint_wrfout, da_input, target_level)
+        if n_turbines <= args.loop_max:
+            t_loop, expected = timeit(interp3dpoint_loop, da_input, target_level, repeat=1)
+            xr.testing.assert_identical(result.transpose(*expected.dims), expected)
+            print(f"{n_turbines:>10} {t_loop:>12.4f} {t_gather:>12.4f} {t_loop / t_gather:>9.0f}x")
+        else:
+            print(f"{n_turbines:>10} {'-':>12} {t_gather:>12.4f} {'-':>10}")
+
+
+if __name__ == '__main__':
+    main()
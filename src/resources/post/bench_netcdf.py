@@ -0,0 +1,127 @@
+'''
+NetCDF编码配置的文件大小与读写耗时对比
+python bench_netcdf.py --times 400 --turbines 2000 --levels 5
+每个配置分别测量：整体写出(to_netcdf)、逐时次追加(NetCDFAppender)、整体读入、按风机块读入全部时次
+以及与原始数据的最大误差(float32和packed为有损配置)
+'''
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from zEncoding import NETCDF_PROFILES, to_netcdf
+from zStore import NetCDFAppender
+
+VARS_2D = ['T2', 'PSFC', 'U10', 'V10', 'ws10', 'wd10']
+VARS_3D = ['ws', 'wd', 'tk', 'pressure', 'density']
+
+
+def make_final(n_times, n_turbines, n_levels, seed=0):
+    '''构造与ds_final结构相同的数据集：随时间平滑变化的场加小扰动，float64与原始写出一致'''
+    rng = np.random.default_rng(seed)
+    times = pd.date_range('2023-09-14', periods=n_times, freq='15min')
+    ids = [f"WT{i:05d}" for i in range(n_turbines)]
+    levels = np.linspace(70, 150, n_levels)
+    phase = np.linspace(0, 8 * np.pi, n_times)[:, None]
+    base = rng.uniform(0, 2 * np.pi, n_turbines)[None, :]
+
+    data_vars = {}
+    for i, name in enumerate(VARS_2D):
+        field = 10 * (i + 1) + 5 * np.sin(phase + base) + rng.normal(0, 0.1, (n_times, n_turbines))
+        data_vars[name] = (('time', 'id'), field)
+    for i, name in enumerate(VARS_3D):
+        profile = np.log(levels / 10)[None, :, None]
+        field = (10 * (i + 1) + 5 * np.sin(phase + base)[:, None, :] * profile
+                 + rng.normal(0, 0.1, (n_times, n_levels, n_turbines)))
+        data_vars[name] = (('time', 'level', 'id'), field)
+    return xr.Dataset(data_vars, coords={'time': times, 'level': levels, 'id': ids})
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def read_all(path):
+    with xr.open_dataset(path) as ds:
+        return ds.load()
+
+
+def read_by_id(path, id_chunk):
+    '''按风机块读取全部时次，与Excel/Parquet导出的访问方式相同'''
+    with xr.open_dataset(path) as ds:
+        for start in range(0, ds.sizes['id'], id_chunk):
+            ds.isel(id=slice(start, start + id_chunk)).load()
+
+
+def append_all(ds, path, profile):
+    with NetCDFAppender(path, profile=profile) as appender:
+        for i in range(ds.sizes['time']):
+            appender.append(ds.isel(time=slice(i, i + 1)))
+
+
+def max_error(ds, path):
+    with xr.open_dataset(path) as ds_read:
+        return max(float(np.nanmax(np.abs(ds_read[name].values - ds[name].values))) for name in ds.data_vars)
+
+
+def bench_profile(ds, profile, workdir, id_chunk):
+    path = os.path.join(workdir, f"{profile}.nc")
+    append_path = os.path.join(workdir, f"{profile}_append.nc")
+    raw_mb = ds.nbytes / 1024 ** 2
+
+    t_write, _ = timed(to_netcdf, ds, path, profile)
+    t_append, _ = timed(append_all, ds, append_path, profile)
+    t_read, _ = timed(read_all, path)
+    t_read_id, _ = timed(read_by_id, path, id_chunk)
+    size_mb = os.path.getsize(path) / 1024 ** 2
+    return {
+        'profile': profile,
+        'size_mb': round(size_mb, 2),
+        'append_size_mb': round(os.path.getsize(append_path) / 1024 ** 2, 2),
+        'ratio': round(raw_mb / size_mb, 2),
+        'write_s': round(t_write, 3),
+        'write_mb_s': round(raw_mb / t_write, 1),
+        'append_s': round(t_append, 3),
+        'read_s': round(t_read, 3),
+        'read_mb_s': round(raw_mb / t_read, 1),
+        'read_by_id_s': round(t_read_id, 3),
+        'max_error': max_error(ds, path),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="NetCDF encoding profiles: size vs read/write throughput")
+    parser.add_argument("--times", type=int, default=400)
+    parser.add_argument("--turbines", type=int, default=2000)
+    parser.add_argument("--levels", type=int, default=5)
+    parser.add_argument("--profiles", nargs='+', default=list(NETCDF_PROFILES), choices=list(NETCDF_PROFILES))
+    parser.add_argument("--id-chunk", type=int, default=1000, help="turbines per block when reading by id")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    ds = make_final(args.times, args.turbines, args.levels)
+    print(f"dataset: {ds.nbytes / 1024 ** 2:.1f} MB in memory")
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for profile in args.profiles:
+            results.append(bench_profile(ds, profile, workdir, args.id_chunk))
+
+    print(f"{'profile':<10} {'size MB':>9} {'ratio':>6} {'write s':>8} {'append s':>9} {'read s':>7} "
+          f"{'by id s':>8} {'max error':>10}")
+    for r in results:
+        print(f"{r['profile']:<10} {r['size_mb']:>9.2f} {r['ratio']:>6.2f} {r['write_s']:>8.3f} {r['append_s']:>9.3f} "
+              f"{r['read_s']:>7.3f} {r['read_by_id_s']:>8.3f} {r['max_error']:>10.2e}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
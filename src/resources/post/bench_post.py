@@ -0,0 +1,272 @@
+'''
+后处理基准测试
+生成合成的wrfout(含wrf-python所需的全局属性和变量)及配套的locations.xlsx、GFSwrfout_varnames.xlsx，
+在风机数、文件数、网格大小的组合上运行流式后处理，按zLog记录的各阶段耗时汇总并保存为JSON
+python bench_post.py --grid 100 200 --levels 30 --files 4 --turbines 100 1000 --output bench_post.json
+python bench_post.py --compare bench_post_old.json bench_post.json
+'''
+import argparse
+import glob
+import itertools
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from netCDF4 import Dataset
+
+G = 9.81
+P_TOP = 5000.
+SURFACE_VARS = ['ter', 'U10', 'V10', 'T2', 'PSFC']
+SIGMA_VARS = ['z', 'pressure', 'tk', 'ua', 'va', 'QVAPOR']
+TURBINE_HEIGHTS = [70, 90, 100, 120]
+
+
+def grid_latlon(nx, ny, dx=9000., cen_lat=38., cen_lon=105.):
+    '''近似的等距网格，足够wrf-python读取和插值使用'''
+    lat = cen_lat + (np.arange(ny) - (ny - 1) / 2) * dx / 111e3
+    lat2d = np.repeat(lat[:, None], nx, axis=1)
+    lon2d = cen_lon + (np.arange(nx)[None, :] - (nx - 1) / 2) * dx / (111e3 * np.cos(np.deg2rad(lat2d)))
+    return lat2d, lon2d
+
+
+def make_wrfout(path, valid_time, nx, ny, nz, seed=0, dx=9000.):
+    '''单时次wrfout：地形、气压、位势、位温、水汽和交错网格风场按简单大气结构构造并加扰动'''
+    rng = np.random.default_rng(seed)
+    lat2d, lon2d = grid_latlon(nx, ny, dx)
+    lat_u, lon_u = grid_latlon(nx + 1, ny, dx)
+    lat_v, lon_v = grid_latlon(nx, ny + 1, dx)
+
+    hgt = 500 + 300 * np.sin(lat2d * 0.3) * np.cos(lon2d * 0.2)
+    psfc = 101325. * np.exp(-hgt / 8000.)
+    # 拉伸的eta层，近地面层较密
+    znw = 1 - (np.arange(nz + 1) / nz) ** 1.5
+    znu = (znw[:-1] + znw[1:]) / 2
+    p_stag = P_TOP + znw[:, None, None] * (psfc - P_TOP)
+    pb = P_TOP + znu[:, None, None] * (psfc - P_TOP)
+    z_stag = hgt + 8000. * np.log(psfc / p_stag)
+    z_mass = (z_stag[:-1] + z_stag[1:]) / 2
+    theta = 290. + 0.004 * (z_mass - hgt) + rng.normal(0, 0.2, z_mass.shape)
+    qv = 0.01 * np.exp(-(z_mass - hgt) / 3000.)
+    wind_profile = np.log(np.maximum(z_mass - hgt, 1.) / 0.1).mean(axis=(1, 2))[:, None, None]
+
+    with Dataset(path, 'w', format='NETCDF4') as nc:
+        for dim, size in [('Time', None), ('DateStrLen', 19), ('west_east', nx), ('south_north', ny),
+                          ('bottom_top', nz), ('west_east_stag', nx + 1), ('south_north_stag', ny + 1),
+                          ('bottom_top_stag', nz + 1)]:
+            nc.createDimension(dim, size)
+        nc.setncatts({
+            'TITLE': ' OUTPUT FROM WRF V4.4 MODEL', 'SIMULATION_START_DATE': valid_time.strftime('%Y-%m-%d_%H:%M:%S'),
+            'START_DATE': valid_time.strftime('%Y-%m-%d_%H:%M:%S'),
+            'WEST-EAST_GRID_DIMENSION': nx + 1, 'SOUTH-NORTH_GRID_DIMENSION': ny + 1,
+            'BOTTOM-TOP_GRID_DIMENSION': nz + 1, 'DX': dx, 'DY': dx, 'GRID_ID': 2, 'PARENT_ID': 1,
+            'MAP_PROJ': 1, 'MAP_PROJ_CHAR': 'Lambert Conformal', 'TRUELAT1': 30., 'TRUELAT2': 60.,
+            'STAND_LON': 105., 'MOAD_CEN_LAT': 38., 'CEN_LAT': 38., 'CEN_LON': 105.,
+            'POLE_LAT': 90., 'POLE_LON': 0.,
+        })
+
+        def var(name, dims, data, dtype='f4', **attrs):
+            v = nc.createVariable(name, dtype, dims)
+            v.setncatts(dict({'FieldType': 104, 'MemoryOrder': 'XYZ', 'stagger': ''}, **attrs))
+            v[:] = data
+
+        times = nc.createVariable('Times', 'S1', ('Time', 'DateStrLen'))
+        times[0] = np.array(list(valid_time.strftime('%Y-%m-%d_%H:%M:%S')), dtype='S1')
+        var('XTIME', ('Time',), [0.], units=f"minutes since {valid_time.strftime('%Y-%m-%d %H:%M:%S')}")
+        surface = ('Time', 'south_north', 'west_east')
+        var('XLAT', surface, lat2d[None], units='degree_north')
+        var('XLONG', surface, lon2d[None], units='degree_east')
+        var('XLAT_U', ('Time', 'south_north', 'west_east_stag'), lat_u[None], stagger='X')
+        var('XLONG_U', ('Time', 'south_north', 'west_east_stag'), lon_u[None], stagger='X')
+        var('XLAT_V', ('Time', 'south_north_stag', 'west_east'), lat_v[None], stagger='Y')
+        var('XLONG_V', ('Time', 'south_north_stag', 'west_east'), lon_v[None], stagger='Y')
+        var('ZNU', ('Time', 'bottom_top'), znu[None])
+        var('ZNW', ('Time', 'bottom_top_stag'), znw[None])
+        var('P_TOP', ('Time',), [P_TOP])
+        var('HGT', surface, hgt[None], units='m')
+        var('PSFC', surface, psfc[None], units='Pa')
+        var('T2', surface, (theta[0] - 2)[None], units='K')
+        var('Q2', surface, qv[0][None], units='kg kg-1')
+        var('U10', surface, (5 + rng.normal(0, 1, (ny, nx)))[None], units='m s-1')
+        var('V10', surface, (2 + rng.normal(0, 1, (ny, nx)))[None], units='m s-1')
+
+        mass = ('Time', 'bottom_top', 'south_north', 'west_east')
+        var('PB', mass, pb[None], units='Pa')
+        var('P', mass, rng.normal(0, 20, pb.shape)[None], units='Pa')
+        var('T', mass, (theta - 300.)[None], units='K')
+        var('QVAPOR', mass, qv[None], units='kg kg-1')
+        var('PHB', ('Time', 'bottom_top_stag', 'south_north', 'west_east'), (G * z_stag)[None],
+            units='m2 s-2', stagger='Z')
+        var('PH', ('Time', 'bottom_top_stag', 'south_north', 'west_east'),
+            rng.normal(0, 5, z_stag.shape)[None], units='m2 s-2', stagger='Z')
+        var('W', ('Time', 'bottom_top_stag', 'south_north', 'west_east'),
+            rng.normal(0, 0.1, z_stag.shape)[None], units='m s-1', stagger='Z')
+        u = 0.8 * wind_profile + rng.normal(0, 1, (nz, ny, nx + 1))
+        v = 0.3 * wind_profile + rng.normal(0, 1, (nz, ny + 1, nx))
+        var('U', ('Time', 'bottom_top', 'south_north', 'west_east_stag'), u[None], units='m s-1', stagger='X')
+        var('V', ('Time', 'bottom_top', 'south_north_stag', 'west_east'), v[None], units='m s-1', stagger='Y')
+
+
+def make_case(prefix, nx, ny, nz, n_files, start='2023-09-14 13:00'):
+    '''按/fsx/domain_x的目录结构生成run/下的wrfout和post/下的变量表'''
+    os.makedirs(os.path.join(prefix, 'run'), exist_ok=True)
+    os.makedirs(os.path.join(prefix, 'post'), exist_ok=True)
+    file_path_list = []
+    for i, valid_time in enumerate(pd.date_range(start, periods=n_files, freq='1h')):
+        path = os.path.join(prefix, 'run', valid_time.strftime('wrfout_d02_%Y-%m-%d_%H:00:00'))
+        make_wrfout(path, valid_time, nx, ny, nz, seed=i)
+        file_path_list.append(path)
+    varnames = pd.DataFrame({'surface': pd.Series(SURFACE_VARS), 'sigma': pd.Series(SIGMA_VARS)})
+    varnames.to_excel(os.path.join(prefix, 'post', 'GFSwrfout_varnames.xlsx'), index=False)
+    return file_path_list
+
+
+def make_locations(prefix, n_turbines, nx, ny, seed=0):
+    '''风机随机分布在网格内部，避开边界单元'''
+    rng = np.random.default_rng(seed)
+    lat2d, lon2d = grid_latlon(nx, ny)
+    iy = rng.uniform(1, ny - 2, n_turbines)
+    ix = rng.uniform(1, nx - 2, n_turbines)
+    df = pd.DataFrame({
+        'turbines': [f"WT{i:05d}" for i in range(n_turbines)],
+        'lons': lon2d[iy.astype(int), ix.astype(int)] + rng.uniform(0, 0.05, n_turbines),
+        'lats': lat2d[iy.astype(int), ix.astype(int)] + rng.uniform(0, 0.05, n_turbines),
+        'WS_height': rng.choice(TURBINE_HEIGHTS, n_turbines),
+    })
+    path = os.path.join(prefix, 'post', 'locations.xlsx')
+    df.to_excel(path, index=False)
+    return path
+
+
+def stage_summary(timing_path):
+    '''把zLog记录的各阶段耗时按阶段名累加'''
+    stages = defaultdict(float)
+    with open(timing_path) as f:
+        for line in f:
+            record = json.loads(line)
+            stages[record['stage']] += record['wall_s']
+    return {name: round(value, 3) for name, value in stages.items()}
+
+
+def run_case(prefix, file_path_list, workers=1, excel=True, parquet=True):
+    '''与process_gfs --stream --incremental相同的流程，不上传'''
+    import process_gfs
+    from zFunc import load_WT_locat
+    from zLog import stage, get_logger, timing_path
+
+    post_dir = os.path.join(prefix, 'post')
+    log_path = os.path.join(post_dir, 'logs', f"bench_{time.time_ns()}.log")
+    output_dirs = {name: os.path.join(post_dir, name) for name in ['gfs_netcdf', 'gfs_excel', 'gfs_parquet', 'weights']}
+    for path in output_dirs.values():
+        os.makedirs(path, exist_ok=True)
+
+    start = time.perf_counter()
+    var_surface_names, var_sigma_names = process_gfs.get_varnames(os.path.join(post_dir, 'GFSwrfout_varnames.xlsx'))
+    turbines_info = load_WT_locat(os.path.join(post_dir, 'locations.xlsx'))
+    select_levels = np.unique(turbines_info[-1])
+    ds_final_iter = process_gfs.post_gfs_files(file_path_list, var_surface_names, var_sigma_names, turbines_info,
+                                               select_levels, log_path, weights_dir=output_dirs['weights'],
+                                               workers=workers)
+    with stage('export', log_path):
+        process_gfs.export_gfs_incremental(ds_final_iter, os.path.join(output_dirs['gfs_netcdf'], 'GFS_bench.nc'),
+                                           output_dirs['gfs_excel'] if excel else None,
+                                           output_dirs['gfs_parquet'] if parquet else None, workers)
+    total = time.perf_counter() - start
+    get_logger(log_path).flush()
+    stages = stage_summary(timing_path(log_path))
+    if workers <= 1:
+        # 流式处理是惰性的，串行时export包含各文件的cut/interp/derive，扣除后为写出本身的耗时
+        stages['write'] = round(stages['export'] - sum(stages.get(name, 0) for name in ['cut', 'interp', 'derive']), 3)
+    return {'total_s': round(total, 3), 'stages': stages}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(old_path, new_path):
+    '''按参数组合对比两次结果，比值>1表示变慢'''
+    def load(path):
+        with open(path) as f:
+            content = json.load(f)
+        return content, {tuple(sorted(r['params'].items())): r for r in content['results']}
+
+    old, old_results = load(old_path)
+    new, new_results = load(new_path)
+    print(f"{old.get('commit')} -> {new.get('commit')}")
+    for key, result in new_results.items():
+        if key not in old_results:
+            continue
+        params = ' '.join(f"{k}={v}" for k, v in key)
+        print(f"{params}: total {old_results[key]['total_s']:.2f}s -> {result['total_s']:.2f}s "
+              f"({result['total_s'] / old_results[key]['total_s']:.2f}x)")
+        for name, seconds in result['stages'].items():
+            before = old_results[key]['stages'].get(name)
+            if before:
+                print(f"    {name:<8} {before:>8.2f}s -> {seconds:>8.2f}s ({seconds / before:.2f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="post-processing benchmark on synthetic wrfout files")
+    parser.add_argument("--grid", type=int, nargs='+', default=[100], help="grid points per side")
+    parser.add_argument("--levels", type=int, nargs='+', default=[30])
+    parser.add_argument("--files", type=int, nargs='+', default=[4])
+    parser.add_argument("--turbines", type=int, nargs='+', default=[100, 1000])
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=1, help="runs per combination, the fastest is kept")
+    parser.add_argument("--no-excel", action='store_true')
+    parser.add_argument("--no-parquet", action='store_true')
+    parser.add_argument("--workdir", help="keep the synthetic cases here instead of a temporary directory")
+    parser.add_argument("--output", default="bench_post.json")
+    parser.add_argument("--compare", nargs=2, metavar=('OLD', 'NEW'), help="compare two result files and exit")
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        workdir = args.workdir or tmp_dir
+        for grid, levels, n_files in itertools.product(args.grid, args.levels, args.files):
+            # 同一组网格和文件在不同风机数之间复用
+            prefix = os.path.join(workdir, f"grid{grid}_lev{levels}_files{n_files}")
+            file_path_list = sorted(glob.glob(os.path.join(prefix, 'run', 'wrfout_d02_*')))
+            if len(file_path_list) != n_files:
+                start = time.perf_counter()
+                file_path_list = make_case(prefix, grid, grid, levels, n_files)
+                print(f"generated {prefix} in {time.perf_counter() - start:.1f}s")
+            for n_turbines in args.turbines:
+                make_locations(prefix, n_turbines, grid, grid)
+                runs = [run_case(prefix, file_path_list, args.workers, not args.no_excel, not args.no_parquet)
+                        for _ in range(args.repeat)]
+                best = min(runs, key=lambda run: run['total_s'])
+                params = {'grid': grid, 'levels': levels, 'files': n_files, 'turbines': n_turbines,
+                          'workers': args.workers}
+                results.append(dict(params=params, **best))
+                print(params, best)
+
+    content = {
+        'commit': git_commit(),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(content, f, indent=2)
+    print(f"saved {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -3,32 +3,30 @@
 插值
 '''
 #%%
-import sys
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
 import numpy as np
 import pandas as pd
 import xarray as xr
-import wrf 
-from netCDF4 import Dataset
 from tqdm import tqdm
 import os 
+import sys
 import time
+import traceback
 import warnings
 warnings.filterwarnings("ignore")
-from zConfig import date_now_str, gfs_database_dir, gfs_excel_database_dir, gfs_cut_database_dir, gfs_netcdf_dir, gfs_varnames_path, gfs_log_path, locat_path, pred_length, target_height, record_dir
-from zFunc import mkdir_dir_notexist, load_WT_locat, export_excel, export_netcdf, export_log, utc_to_bjt, add_vars_leadhour, detect_files
+from zConfig import date_now_str, gfs_database_dir, gfs_excel_database_dir, gfs_cut_database_dir, gfs_netcdf_dir, gfs_varnames_path, gfs_log_path, locat_path, pred_length, target_height, record_dir, weights_dir, gfs_parquet_dir, gfs_zarr_dir
+from zFunc import mkdir_dir_notexist, load_WT_locat, export_excel, export_netcdf, export_parquet, export_zarr, export_log, utc_to_bjt, add_vars_leadhour, detect_files
 from zCal import interp_gfs_vars, cal_gfs_extend_vars
-
-prefix = sys.argv[1]
-s3_prefix = sys.argv[2]
-local_gfs_database_dir = gfs_database_dir(prefix)
-local_gfs_excel_database_dir = gfs_excel_database_dir(prefix)
-local_gfs_cut_database_dir = gfs_cut_database_dir(prefix)
-local_gfs_netcdf_dir = gfs_netcdf_dir(prefix)
-local_gfs_varnames_path = gfs_varnames_path(prefix)
-local_gfs_log_path = gfs_log_path(prefix)
-local_locat_path = locat_path(prefix)
-local_record_dir= record_dir(prefix)
+from zInterp import level_index_above
+from zLog import stage, get_logger, pool_context
+from zUpload import upload, upload_many
+from zStore import NetCDFAppender, shift_time_ondisk, add_vars_leadhour_ondisk, iter_id_chunks
+from zEncoding import NETCDF_PROFILES, DEFAULT_PROFILE, to_netcdf
+from zWrfout import WrfoutReader
+from zManifest import update_manifest, query_manifest, file_paths
 
 
 def get_varnames(file_path):
@@ -38,23 +36,32 @@ def get_varnames(file_path):
     return var_surface_names, var_sigma_names
 
 
-def yield_gfs_file_path_list():
-    global date_now_str, pred_length,local_gfs_database_dir
-    # 预先给出的文件列表
-    datetime_range = pd.date_range(f'{date_now_str} 13:00:00', periods=pred_length, freq='1H') # 丢弃前一天
-    file_name_list = [time.strftime("wrfout_d02_%Y-%m-%d_%H:00:00") for time in datetime_range]
-    file_path_list = [os.path.join(local_gfs_database_dir, file_name) for file_name in file_name_list] # 预先给出，不依赖实际wrfout生成情况
-    return file_path_list
+def yield_gfs_file_path_list(local_gfs_database_dir, domain='d02', start='13:00', count=None):
+    '''
+    从wrfout清单中取该域从当天start(UTC)起的前count个文件，按有效时间排序，丢弃前一天
+    返回(文件路径列表, 是否写完的列表)；WRF作业已结束，可读的文件都视为完整
+    '''
+    global date_now_str, pred_length
+    count = pred_length if count is None else count
+    manifest = update_manifest(local_gfs_database_dir, final=True)
+    records = query_manifest(manifest, domain=domain, complete=False,
+                             start=pd.Timestamp(f'{date_now_str} {start}'))[:count]
+    return file_paths(local_gfs_database_dir, records), [record['complete'] for record in records]
+
+
+def wrfout_varnames(var_surface_names, var_sigma_names):
+    '''每个wrfout需要读取的变量，height_agl用于确定目标高度以下的sigma层'''
+    return list(var_surface_names) + list(var_sigma_names) + ['height_agl']
 
 
 def pick_surface(wrfin, var_surface_names):
     var_surface_dict = {}
     for var_surface_name in var_surface_names:
-        var_surface = wrf.getvar(wrfin, var_surface_name, timeidx=wrf.ALL_TIMES, method='cat')
+        var_surface = wrfin.getvar(var_surface_name)
         if var_surface.ndim == 2: # 拓展维度，应对插值问题
             time = pd.Timestamp(var_surface.Time.values)
             var_surface = var_surface.expand_dims(dim={'Time': [time]}, axis=0)
-        del var_surface.attrs['projection'] # 删除信息，否则不能保存
+        var_surface.attrs.pop('projection', None) # 删除信息，否则不能保存
         var_surface_dict[var_surface_name] = var_surface
     return var_surface_dict
 
@@ -66,110 +73,304 @@ def pick_sigma(wrfin, var_sigma_names, target_height=300):
     # sigma层变量
     var_sigma_le_300m_dict = {}
     for var_sigma_name in var_sigma_names:
-        var_sigma = wrf.getvar(wrfin, var_sigma_name, timeidx=wrf.ALL_TIMES, method='cat')
+        var_sigma = wrfin.getvar(var_sigma_name)
         var_sigma_le_300m = var_sigma.sel(bottom_top=slice(0, zindex))
         if var_sigma_le_300m.ndim == 3:
             time = pd.Timestamp(var_sigma.Time.values)
             var_sigma_le_300m = var_sigma_le_300m.expand_dims(dim={'Time': [time]}, axis=0)
-        del var_sigma_le_300m.attrs['projection']
+        var_sigma_le_300m.attrs.pop('projection', None)
         var_sigma_le_300m_dict[var_sigma_name] = var_sigma_le_300m
     return var_sigma_le_300m_dict
 
 
-def get_gfs_zindex(wrf_list, target_height):
-    z_agl = wrf.getvar(wrf_list, 'height_agl', timeidx=wrf.ALL_TIMES, method='cat') # 模式高度AGL
-    zindex_list = []
-    try:
-        for time in z_agl.Time.to_index():
-            for i in z_agl.sel(Time=time).bottom_top.values:
-                if z_agl.sel(bottom_top=i).min() >= target_height:
-                    zindex_list.append(i)
-                    break
-        zindex = np.max(zindex_list)
-    except ValueError: # 只有一个时刻的情况
-        for i in z_agl.bottom_top.values:
-            if z_agl.sel(bottom_top=i).min() >= target_height:
-                zindex = i
-                break
-    return zindex
-
-
-def export_cut(var_surface_dict, var_sigma_le_300m_dict, output_path):
+def get_gfs_zindex(wrfin, target_height):
+    z_agl = wrfin.getvar('height_agl') # 模式高度AGL
+    # 所有时刻、所有格点都高于target_height的最低层，一次向量化求出
+    axis = z_agl.dims.index('bottom_top')
+    return z_agl.bottom_top.values[level_index_above(z_agl.values, target_height, axis=axis)]
+
+
+def build_cut(var_surface_dict, var_sigma_le_300m_dict):
     var_dict = var_surface_dict.copy()
     var_dict.update(var_sigma_le_300m_dict)
-    ds = xr.Dataset(var_dict)
-    ds.to_netcdf(output_path)
+    return xr.Dataset(var_dict)
 
 
-def cut_gfs(file_path):
-    global local_gfs_varnames_path, target_height, gfs_cut_dir
+def export_cut(var_surface_dict, var_sigma_le_300m_dict, output_path, nc_profile=DEFAULT_PROFILE):
+    ds = build_cut(var_surface_dict, var_sigma_le_300m_dict)
+    to_netcdf(ds, output_path, nc_profile)
 
-    var_surface_names, var_sigma_names = get_varnames(local_gfs_varnames_path)
-    wrfin = Dataset(file_path)
-    var_surface_dict = pick_surface(wrfin, var_surface_names)
-    var_sigma_le_300m_dict = pick_sigma(wrfin, var_sigma_names, target_height)
+
+def cut_gfs(file_path, var_surface_names, var_sigma_names, output_dir, nc_profile=DEFAULT_PROFILE):
+    global target_height
+
+    with WrfoutReader(file_path, wrfout_varnames(var_surface_names, var_sigma_names)) as wrfin:
+        var_surface_dict = pick_surface(wrfin, var_surface_names)
+        var_sigma_le_300m_dict = pick_sigma(wrfin, var_sigma_names, target_height)
 
     output_name = "cut_" + os.path.basename(file_path)
-    output_path = os.path.join(gfs_cut_dir, output_name)
+    output_path = os.path.join(output_dir, output_name)
+
+    export_cut(var_surface_dict, var_sigma_le_300m_dict, output_path, nc_profile)
+    return output_path
+
+
+def cut_gfs_files(file_path_list, var_surface_names, var_sigma_names, output_dir, workers=1,
+                  nc_profile=DEFAULT_PROFILE):
+    '''
+    逐个文件压缩wrfout，workers > 1 时按文件分配到进程池
+    每个进程独立打开netCDF4.Dataset并写出自己的cut_*.nc，结果与串行一致
+    '''
+    cut_func = partial(cut_gfs, var_surface_names=var_surface_names, var_sigma_names=var_sigma_names,
+                       output_dir=output_dir, nc_profile=nc_profile)
+    workers = min(workers, len(file_path_list))
+    if workers <= 1:
+        return [cut_func(file_path) for file_path in tqdm(file_path_list)]
+    with ProcessPoolExecutor(max_workers=workers, mp_context=pool_context()) as executor:
+        return list(tqdm(executor.map(cut_func, file_path_list), total=len(file_path_list)))
+
+
+def post_gfs_file(file_path, var_surface_names, var_sigma_names, turbines_info, select_levels, log_path,
+                  weights_dir=None, cut_dir=None, nc_profile=DEFAULT_PROFILE):
+    '''
+    单文件流式处理：wrfout -> 挑选变量 -> 垂直/水平插值 -> 派生变量，全程在内存中
+    不再经过gfs_cut的写出和读回，cut_dir非空时才额外写出cut文件
+    '''
+    global target_height
+
+    file_name = os.path.basename(file_path)
+    with stage('cut', log_path, file=file_name):
+        with WrfoutReader(file_path, wrfout_varnames(var_surface_names, var_sigma_names)) as wrfin:
+            ds = build_cut(pick_surface(wrfin, var_surface_names), pick_sigma(wrfin, var_sigma_names, target_height))
+        if cut_dir is not None:
+            to_netcdf(ds, os.path.join(cut_dir, "cut_" + file_name), nc_profile)
+
+    with stage('interp', log_path, file=file_name):
+        ds_interp = interp_gfs_vars(ds, turbines_info, select_levels, log_path, cal_static=True,
+                                    weights_dir=weights_dir)
+    with stage('derive', log_path, file=file_name):
+        return cal_gfs_extend_vars(ds_interp, drop_var=False)
+
+
+def post_gfs_files(file_path_list, var_surface_names, var_sigma_names, turbines_info, select_levels, log_path,
+                   weights_dir=None, cut_dir=None, workers=1, nc_profile=DEFAULT_PROFILE):
+    '''按文件顺序逐个产出每个文件的ds_final，workers > 1 时按文件分配到进程池'''
+    post_func = partial(post_gfs_file, var_surface_names=var_surface_names, var_sigma_names=var_sigma_names,
+                        turbines_info=turbines_info, select_levels=select_levels, log_path=log_path,
+                        weights_dir=weights_dir, cut_dir=cut_dir, nc_profile=nc_profile)
+    workers = min(workers, len(file_path_list))
+    if workers <= 1:
+        for file_path in tqdm(file_path_list):
+            yield post_func(file_path)
+        return
+    with ProcessPoolExecutor(max_workers=workers, mp_context=pool_context()) as executor:
+        yield from tqdm(executor.map(post_func, file_path_list), total=len(file_path_list))
+
+
+def interp_gfs_cut_files(gfs_cut_dir, turbines_info, select_levels, log_path, weights_dir=None):
+    '''读回gfs_cut中的压缩文件，按文件名顺序逐个产出ds_final'''
+    for file_name in tqdm(sorted(os.listdir(gfs_cut_dir))):
+        # export_log(f'-'*40, log_path)
+        # export_log(f'> 当前{file_name}', gfs_log_path)
+        file_path = os.path.join(gfs_cut_dir, file_name)
+        ds = xr.open_dataset(file_path)
+
+        with stage('interp', log_path, file=file_name):
+            ds_interp = interp_gfs_vars(ds, turbines_info, select_levels, log_path, cal_static=True,
+                                        weights_dir=weights_dir)
+        with stage('derive', log_path, file=file_name):
+            ds_final = cal_gfs_extend_vars(ds_interp, drop_var=False)
+        yield ds_final
+
+
+def optional_export(name, export_func, log_path, *args):
+    '''
+    可选的导出(Parquet等)：缺少依赖时记录警告后跳过，返回None；其他错误记录后返回False；导出成功返回True
+    两种失败都不影响NetCDF、Excel等其他结果的导出和上传
+    '''
+    report = (lambda msg: export_log(msg, log_path)) if log_path else print
+    try:
+        export_func(*args)
+        return True
+    except ImportError as e:
+        report(f"缺少依赖，跳过{name}导出：{e}")
+        return None
+    except Exception:
+        report(f"{name}导出失败：{traceback.format_exc()}")
+        return False
+
+
+def export_gfs_incremental(ds_final_iter, netcdf_path, excel_dir=None, parquet_dir=None, workers=1, chunk_size=1000,
+                           nc_profile=DEFAULT_PROFILE, zarr_dir=None, log_path=None):
+    '''
+    每个ds_final产生后立即追加写入netcdf_path，之后在磁盘结果上按风机分块完成北京时、变化量和Excel导出
+    峰值内存只和单个文件、单个风机块有关
+    返回可选导出的结果 {'parquet': True/None/False, 'zarr': ...}，见optional_export
+    '''
+    global date_now_str
+
+    part_path = netcdf_path + '.part'
+    with NetCDFAppender(part_path, profile=nc_profile) as appender:
+        for ds_final in ds_final_iter:
+            appender.append(ds_final)
+    shift_time_ondisk(part_path, 8)
+    for leadhour in [1, 3]:
+        add_vars_leadhour_ondisk(part_path, leadhour, ['T2', 'tk', 'PSFC', 'pressure'], chunk_size)
+    os.replace(part_path, netcdf_path)
+
+    exported = {}
+    if parquet_dir is not None:
+        exported['parquet'] = optional_export('Parquet', export_parquet, log_path,
+                                              iter_id_chunks(netcdf_path, chunk_size), 'GFS', date_now_str, parquet_dir)
+    if zarr_dir is not None:
+        exported['zarr'] = optional_export('Zarr', export_zarr, log_path,
+                                           iter_id_chunks(netcdf_path, chunk_size), 'GFS', date_now_str, zarr_dir)
+    if excel_dir is not None:
+        for ds_chunk in iter_id_chunks(netcdf_path, chunk_size):
+            export_excel(ds_chunk, 'GFS', date_now_str, excel_dir, workers)
+    return exported
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="GFS wrfout post processing")
+    parser.add_argument("prefix", help="domain directory, e.g. /fsx/domain_1")
+    parser.add_argument("s3_prefix", help="output location, e.g. s3://bucket/outputs/20230914/domain_1")
+    parser.add_argument("--domain", default="d02", help="wrfout domain to post process (default: d02)")
+    parser.add_argument("--start", default="13:00",
+                        help="valid time (HH:MM, UTC) on the run date of the first wrfout to process (default: 13:00)")
+    parser.add_argument("--count", type=int, default=pred_length,
+                        help=f"number of wrfout files expected from --start on (default: {pred_length})")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of processes for the per-file stage, 0 means all cores (default: 1, serial)")
+    parser.add_argument("--stream", action="store_true",
+                        help="process each wrfout in memory from cut to derived variables, skipping the gfs_cut round trip")
+    parser.add_argument("--keep-cut", action="store_true",
+                        help="still write cut_*.nc files to gfs_cut in --stream mode")
+    parser.add_argument("--parquet", action="store_true",
+                        help="also export all turbines to one columnar Parquet file under gfs_parquet")
+    parser.add_argument("--zarr", action="store_true",
+                        help="also export a Zarr store chunked by turbine and lead time under gfs_zarr")
+    parser.add_argument("--no-excel", action="store_true",
+                        help="skip the per-turbine Excel files")
+    parser.add_argument("--incremental", action="store_true",
+                        help="append each time slice to the final NetCDF as it is produced instead of concatenating in memory")
+    parser.add_argument("--nc-profile", default=DEFAULT_PROFILE, choices=list(NETCDF_PROFILES),
+                        help=f"compression/chunking/packing profile for cut and final NetCDF files (default: {DEFAULT_PROFILE})")
+    args = parser.parse_args(argv)
+    if args.workers <= 0:
+        args.workers = os.cpu_count()
+    return args
 
-    export_cut(var_surface_dict, var_sigma_le_300m_dict, output_path)
 
 # -------------------------------------------------------------------------
-export_log("-"*40, local_gfs_log_path)
-export_log(f"**** {date_now_str} ****", local_gfs_log_path)
-date_gfs_start = (pd.Timestamp(date_now_str) - pd.Timedelta('1D')).strftime('%Y%m%d')
-
-gfs_dir = os.path.join(local_gfs_database_dir, date_gfs_start)
-gfs_cut_dir = os.path.join(local_gfs_cut_database_dir, date_now_str)
-gfs_excel_dir = os.path.join(local_gfs_excel_database_dir, date_now_str)
-
-mkdir_dir_notexist(gfs_cut_dir)
-mkdir_dir_notexist(gfs_excel_dir)
-
-### 变量压缩
-# 待读取的文件列表
-file_path_list = yield_gfs_file_path_list()
-file_path_list = detect_files(file_path_list, 'GFS', 100, 27, None, local_gfs_log_path, local_record_dir)
-
-for file_path in tqdm(file_path_list):
-    cut_gfs(file_path)
-
-export_log(f"**** wrfout压缩完成 ****", local_gfs_log_path)
-export_log("-"*40, local_gfs_log_path)
-
-# %%
-### 变量插值（合并之后）
-# 风机高度及位置信息
-turbines_info = load_WT_locat(local_locat_path)
-select_levels = np.unique(turbines_info[-1])
-
-ds_final_list = []
-for file_name in tqdm(sorted(os.listdir(gfs_cut_dir))):
-    # export_log(f'-'*40, log_path)
-    # export_log(f'> 当前{file_name}', gfs_log_path)
-    file_path = os.path.join(gfs_cut_dir, file_name)
-    ds = xr.open_dataset(file_path)
-
-    ds_interp = interp_gfs_vars(ds, turbines_info, select_levels, local_gfs_log_path, cal_static=True)
-    ds_final = cal_gfs_extend_vars(ds_interp, drop_var=False)
-    ds_final_list.append(ds_final)
-
-ds_concat = xr.concat(ds_final_list, dim='time')
-ds_concat = utc_to_bjt(ds_concat)
-ds_concat = add_vars_leadhour(ds_concat, 1, ['T2', 'tk', 'PSFC', 'pressure'])
-ds_concat = add_vars_leadhour(ds_concat, 3, ['T2', 'tk', 'PSFC', 'pressure'])
-
-export_excel(ds_concat, 'GFS', date_now_str, gfs_excel_dir)
-export_netcdf(ds_concat, 'GFS', date_now_str, local_gfs_netcdf_dir)
-# script += f"\naws s3 cp ../slurm-${{SLURM_JOB_ID}}.out {output}/logs/\n"
-# script += f"\naws s3 cp /fsx/{zone}/post {output}/post/ --recursive \n"
-export_log(f"**** 开始上传后处理结果文件到S3 ****", local_gfs_log_path)
-
-if s3_prefix.endswith('/'):
-    s3_prefix = s3_prefix.rstrip('/')
-os.system(f"aws s3 cp {prefix}/post/gfs_cut/ {s3_prefix}/gfs_cut/ --recursive")
-os.system(f"aws s3 cp {prefix}/post/gfs_excel/ {s3_prefix}/gfs_excel/ --recursive")
-os.system(f"aws s3 cp {prefix}/post/gfs_netcdf/ {s3_prefix}/gfs_netcdf/ --recursive")
-os.system(f"aws s3 cp {prefix}/post/record/ {s3_prefix}/record/ --recursive")
-os.system(f"aws s3 cp {prefix}/post/logs/ {s3_prefix}/logs/ --recursive")
-export_log(f"**** 处理和导出完成 ****", local_gfs_log_path)
\ No newline at end of file
+def main(argv=None):
+    args = parse_args(argv)
+    prefix = args.prefix
+    s3_prefix = args.s3_prefix.rstrip("/")
+    local_gfs_database_dir = gfs_database_dir(prefix)
+    local_gfs_excel_database_dir = gfs_excel_database_dir(prefix)
+    local_gfs_cut_database_dir = gfs_cut_database_dir(prefix)
+    local_gfs_netcdf_dir = gfs_netcdf_dir(prefix)
+    local_gfs_varnames_path = gfs_varnames_path(prefix)
+    local_gfs_log_path = gfs_log_path(prefix)
+    local_locat_path = locat_path(prefix)
+    local_record_dir = record_dir(prefix)
+    local_weights_dir = weights_dir(prefix)
+    local_gfs_parquet_dir = gfs_parquet_dir(prefix)
+    local_gfs_zarr_dir = gfs_zarr_dir(prefix)
+
+    export_log("-"*40, local_gfs_log_path)
+    export_log(f"**** {date_now_str} ****", local_gfs_log_path)
+    date_gfs_start = (pd.Timestamp(date_now_str) - pd.Timedelta('1D')).strftime('%Y%m%d')
+
+    gfs_dir = os.path.join(local_gfs_database_dir, date_gfs_start)
+    gfs_cut_dir = os.path.join(local_gfs_cut_database_dir, date_now_str)
+    gfs_excel_dir = os.path.join(local_gfs_excel_database_dir, date_now_str)
+
+    mkdir_dir_notexist(gfs_cut_dir)
+    mkdir_dir_notexist(gfs_excel_dir)
+    if args.parquet:
+        mkdir_dir_notexist(local_gfs_parquet_dir)
+    if args.zarr:
+        mkdir_dir_notexist(local_gfs_zarr_dir)
+
+    ### 变量压缩
+    # 待读取的文件列表
+    with stage('detect', local_gfs_log_path):
+        file_path_list, file_exist_list = yield_gfs_file_path_list(local_gfs_database_dir, args.domain,
+                                                                   args.start, args.count)
+        # 清单中写完的文件数与预期的文件数比较，不再逐个检查文件是否存在
+        file_path_list = detect_files(file_path_list, 'GFS', args.count, 27, None, local_gfs_log_path,
+                                      local_record_dir, file_exist_list=file_exist_list)
+
+    var_surface_names, var_sigma_names = get_varnames(local_gfs_varnames_path)
+    # 风机高度及位置信息
+    turbines_info = load_WT_locat(local_locat_path)
+    select_levels = np.unique(turbines_info[-1])
+
+    if args.stream:
+        ### 流式处理：压缩、插值、派生变量逐文件在内存中完成
+        ds_final_iter = post_gfs_files(file_path_list, var_surface_names, var_sigma_names, turbines_info,
+                                       select_levels, local_gfs_log_path, weights_dir=local_weights_dir,
+                                       cut_dir=gfs_cut_dir if args.keep_cut else None, workers=args.workers,
+                                       nc_profile=args.nc_profile)
+    else:
+        ### 变量压缩
+        with stage('cut', local_gfs_log_path, files=len(file_path_list), workers=args.workers):
+            cut_gfs_files(file_path_list, var_surface_names, var_sigma_names, gfs_cut_dir, args.workers,
+                          args.nc_profile)
+
+        export_log(f"**** wrfout压缩完成 ****", local_gfs_log_path)
+        export_log("-"*40, local_gfs_log_path)
+
+        # %%
+        ### 变量插值（合并之后）
+        ds_final_iter = interp_gfs_cut_files(gfs_cut_dir, turbines_info, select_levels, local_gfs_log_path,
+                                             weights_dir=local_weights_dir)
+
+    # 逐文件处理是惰性的，流式模式下export阶段的耗时也包含各文件的cut/interp/derive
+    with stage('export', local_gfs_log_path, incremental=args.incremental, nc_profile=args.nc_profile):
+        if args.incremental:
+            netcdf_path = os.path.join(local_gfs_netcdf_dir, f"GFS_{date_now_str}.nc")
+            exported = export_gfs_incremental(ds_final_iter, netcdf_path, None if args.no_excel else gfs_excel_dir,
+                                              local_gfs_parquet_dir if args.parquet else None, args.workers,
+                                              nc_profile=args.nc_profile,
+                                              zarr_dir=local_gfs_zarr_dir if args.zarr else None,
+                                              log_path=local_gfs_log_path)
+        else:
+            ds_concat = xr.concat(list(ds_final_iter), dim='time')
+            ds_concat = utc_to_bjt(ds_concat)
+            ds_concat = add_vars_leadhour(ds_concat, 1, ['T2', 'tk', 'PSFC', 'pressure'])
+            ds_concat = add_vars_leadhour(ds_concat, 3, ['T2', 'tk', 'PSFC', 'pressure'])
+
+            if not args.no_excel:
+                export_excel(ds_concat, 'GFS', date_now_str, gfs_excel_dir, args.workers)
+            exported = {}
+            if args.parquet:
+                exported['parquet'] = optional_export('Parquet', export_parquet, local_gfs_log_path,
+                                                      ds_concat, 'GFS', date_now_str, local_gfs_parquet_dir)
+            if args.zarr:
+                exported['zarr'] = optional_export('Zarr', export_zarr, local_gfs_log_path,
+                                                   ds_concat, 'GFS', date_now_str, local_gfs_zarr_dir)
+            export_netcdf(ds_concat, 'GFS', date_now_str, local_gfs_netcdf_dir, args.nc_profile)
+    # script += f"\naws s3 cp ../slurm-${{SLURM_JOB_ID}}.out {output}/logs/\n"
+    # script += f"\naws s3 cp /fsx/{zone}/post {output}/post/ --recursive \n"
+    export_log(f"**** 开始上传后处理结果文件到S3 ****", local_gfs_log_path)
+
+    with stage('upload', local_gfs_log_path):
+        # 跳过或失败的可选导出不上传，避免上传写了一半的文件
+        upload_names = ['gfs_cut', 'gfs_excel', 'gfs_netcdf', 'record'] + (['gfs_parquet'] if exported.get('parquet') else [])
+        upload_names += ['gfs_zarr'] if exported.get('zarr') else []
+        result = upload_many([([f"{prefix}/post/{name}/"], f"{s3_prefix}/{name}/") for name in upload_names])
+        export_log(f"上传{result['uploaded']}个文件({result['bytes'] / 1024 ** 2:.1f} MB)，"
+                   f"跳过{result['skipped']}个，失败{len(result['failed'])}个", local_gfs_log_path)
+        for file_path, error in result['failed']:
+            export_log(f"上传失败 {file_path}: {error}", local_gfs_log_path)
+    export_log(f"**** 处理和导出完成 ****", local_gfs_log_path)
+    # 日志和计时最后上传，保证包含upload阶段的记录
+    get_logger(local_gfs_log_path).flush()
+    log_result = upload([f"{prefix}/post/logs/"], f"{s3_prefix}/logs/")
+    return 1 if result['failed'] or log_result['failed'] or False in exported.values() else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,65 @@
+'''
+zDerive核函数与MetPy的一致性测试，float64和float32、NumPy和numexpr两种实现各一组；没有安装MetPy时跳过
+python -m pytest test_derive.py
+'''
+import numpy as np
+import pytest
+
+pytest.importorskip("metpy")
+
+import zDerive
+from bench_derive import make_inputs, metpy_reference, kernel_results
+
+SHAPE = (2, 10, 12, 15)
+# 以参考场的量级归一化的最大误差
+RTOL = {'float64': 1e-10, 'float32': 1e-4}
+KERNELS = ['wind_speed', 'wind_direction', 'density', 'potential_temperature', 'static_stability']
+
+
+@pytest.fixture(scope='module', params=[(dtype, backend) for dtype in ['float64', 'float32']
+                                        for backend in ['numpy', 'numexpr']], ids='-'.join)
+def derived(request):
+    dtype, backend = request.param
+    if backend == 'numexpr' and zDerive.ne is None:
+        pytest.skip("numexpr is not installed")
+    inputs = make_inputs(SHAPE, dtype)
+    ne = zDerive.ne
+    if backend == 'numpy':
+        zDerive.ne = None
+    try:
+        actual = kernel_results(inputs)
+    finally:
+        zDerive.ne = ne
+    return dtype, inputs, metpy_reference(inputs), actual
+
+
+@pytest.mark.parametrize('name', KERNELS)
+def test_matches_metpy(derived, name):
+    dtype, _, expected, actual = derived
+    result = actual[name]
+    assert result.dtype == np.dtype(dtype)
+    assert result.shape == SHAPE
+
+    reference = np.asarray(expected[name], dtype=np.float64)
+    abs_diff = np.abs(result.astype(np.float64) - reference)
+    if name == 'wind_direction':
+        # 0度与360度等价
+        abs_diff = np.minimum(abs_diff, np.abs(360. - abs_diff))
+    assert np.isfinite(result).all()
+    assert abs_diff.max() / np.abs(reference).max() <= RTOL[dtype]
+
+
+def test_calm_wind_direction(derived):
+    dtype, inputs, expected, actual = derived
+    calm = (inputs['u'].values == 0) & (inputs['v'].values == 0)
+    assert calm.any()
+    assert (actual['wind_direction'][calm] == 0).all()
+    assert np.allclose(expected['wind_direction'][calm], 0)
+
+
+def test_static_stability_vertical_dim(derived):
+    '''垂直维放在最后一维时结果与放在第二维时相同'''
+    dtype, inputs, _, actual = derived
+    pres, t = (np.moveaxis(inputs[name].values, 1, -1) for name in ['pres', 't'])
+    result = np.moveaxis(zDerive.static_stability(pres, t, vertical_dim=-1), -1, 1)
+    np.testing.assert_allclose(result, actual['static_stability'], rtol=RTOL[dtype])
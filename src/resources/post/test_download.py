@@ -0,0 +1,143 @@
+'''
+zDownload按.idx挑选消息、合并区间、校验和重试的测试，S3由moto模拟；没有安装moto时跳过
+python -m pytest test_download.py
+'''
+import io
+import os
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip("moto")
+
+import boto3
+from moto import mock_aws
+
+import zDownload
+
+BUCKET = 'bkt'
+CYCLE = datetime(2026, 10, 18, 0)
+VTABLE = '''\
+GRIB1| Level| From |  To  | metgrid  | metgrid | metgrid                                 |GRIB2|GRIB2|GRIB2|GRIB2|
+Param| Type |Level1|Level2| Name     | Units   | Description                             |Discp|Catgy|Param|Level|
+-----+------+------+------+----------+---------+-----------------------------------------+-----------------------+
+  11 | 100  |   *  |      | TT       | K       | Temperature                             |  0  |  0  |  0  | 100 |
+  33 | 100  |   *  |      | UU       | m s-1   | U                                       |  0  |  2  |  2  | 100 |
+   7 | 100  |   *  |      | HGT      | m       | Height                                  |  0  |  3  |  5  | 100 |
+-----+------+------+------+----------+---------+-----------------------------------------+-----------------------+
+'''
+# (变量, 层次, 是否被Vtable选中)
+MESSAGES = [('TMP', '500 mb', True), ('TMP', '850 mb', True), ('UGRD', '500 mb', True),
+            ('ABSV', '500 mb', False), ('HGT', '500 mb', True), ('RH', '2 m above ground', False)]
+
+
+def grib_message(payload_size):
+    '''只有第0段和结束段的最小GRIB2消息，count_grib_messages只检查这两段'''
+    length = 16 + payload_size + 4
+    return b'GRIB\x00\x00\x00\x02' + length.to_bytes(8, 'big') + os.urandom(payload_size) + b'7777'
+
+
+def make_grib():
+    '''返回(文件内容, .idx内容, 选中消息拼接后的内容)'''
+    data, idx, selected = b'', '', b''
+    for n, (name, level, wanted) in enumerate(MESSAGES, 1):
+        message = grib_message(100 + 37 * n)
+        idx += f"{n}:{len(data)}:d=2026101800:{name}:{level}:anl:\n"
+        data += message
+        if wanted:
+            selected += message
+    return data, idx, selected
+
+
+class ShortRangeClient:
+    '''第一次区间请求只返回一半数据，其余调用转给真正的客户端'''
+
+    def __init__(self, client):
+        self.client = client
+        self.range_calls = 0
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def get_object(self, **kwargs):
+        response = self.client.get_object(**kwargs)
+        if 'Range' in kwargs:
+            self.range_calls += 1
+            if self.range_calls == 1:
+                data = response['Body'].read()
+                response['Body'] = io.BytesIO(data[:len(data) // 2])
+        return response
+
+
+@pytest.fixture
+def s3(monkeypatch, tmp_path):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.setattr(zDownload.time, 'sleep', lambda seconds: None)
+    vtable = tmp_path / 'Vtable.GFS'
+    vtable.write_text(VTABLE)
+    with mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket=BUCKET)
+        data, idx, selected = make_grib()
+        key = zDownload.gfs_key(CYCLE, 0)
+        client.put_object(Bucket=BUCKET, Key=key, Body=data)
+        client.put_object(Bucket=BUCKET, Key=key + '.idx', Body=idx.encode())
+        # f003没有.idx
+        client.put_object(Bucket=BUCKET, Key=zDownload.gfs_key(CYCLE, 3), Body=data)
+        yield client, str(vtable), data, idx, selected
+
+
+def test_select_ranges_merges_adjacent_messages(s3):
+    _, vtable, data, idx, _ = s3
+    messages = zDownload.parse_idx(idx)
+    ranges = zDownload.select_ranges(messages, zDownload.read_vtable(vtable), len(data))
+    # 前三条相邻合并为一个区间，ABSV之后的HGT单独一个区间，RH不下载
+    assert ranges == [(0, messages[3][0] - 1, 3), (messages[4][0], messages[5][0] - 1, 1)]
+
+
+def test_download_reassembles_valid_grib(s3, tmp_path):
+    client, vtable, _, _, selected = s3
+    result = zDownload.download(CYCLE, [0], str(tmp_path / 'out'), vtable, bucket=BUCKET, workers=4, client=client)
+    assert result['failed'] == []
+    path, = result['files']
+    assert result['bytes'] == len(selected)
+    assert zDownload.count_grib_messages(path) == 4
+    with open(path, 'rb') as f:
+        assert f.read() == selected
+
+    # 本地已有完整文件时不再下载
+    again = zDownload.download(CYCLE, [0], str(tmp_path / 'out'), vtable, bucket=BUCKET, workers=4, client=client)
+    assert again['files'] == [path] and again['bytes'] == 0
+
+
+def test_short_range_is_retried(s3, tmp_path):
+    client, vtable, _, _, selected = s3
+    short_client = ShortRangeClient(client)
+    result = zDownload.download(CYCLE, [0], str(tmp_path / 'out'), vtable, bucket=BUCKET, workers=1,
+                                client=short_client)
+    assert result['failed'] == []
+    # 两个区间，其中一个重试一次
+    assert short_client.range_calls == 3
+    with open(result['files'][0], 'rb') as f:
+        assert f.read() == selected
+
+
+def test_no_idx_downloads_whole_object(s3, tmp_path):
+    client, vtable, data, _, _ = s3
+    result = zDownload.download(CYCLE, [3], str(tmp_path / 'out'), vtable, bucket=BUCKET, workers=2, client=client)
+    assert result['failed'] == []
+    assert result['bytes'] == len(data)
+    assert zDownload.count_grib_messages(result['files'][0]) == len(MESSAGES)
+    with open(result['files'][0], 'rb') as f:
+        assert f.read() == data
+
+
+def test_invalid_grib_is_reported(s3, tmp_path):
+    client, vtable, data, _, _ = s3
+    client.put_object(Bucket=BUCKET, Key=zDownload.gfs_key(CYCLE, 6), Body=data[:-1])
+    result = zDownload.download(CYCLE, [6], str(tmp_path / 'out'), vtable, bucket=BUCKET, workers=2, client=client)
+    assert result['files'] == []
+    assert result['failed'][0][0] == zDownload.gfs_key(CYCLE, 6)
+    assert not os.listdir(tmp_path / 'out')
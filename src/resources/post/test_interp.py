@@ -0,0 +1,117 @@
+'''
+zInterp水平插值权重与逐点暴力计算的一致性测试，网格为旋转的曲线网格
+覆盖与格点重合、网格外和角点缺测三种情况；安装了geocat-comp时同时与rcm2points比较
+python -m pytest test_interp.py
+'''
+import numpy as np
+import pytest
+
+from zInterp import EXACT_DEG, build_interp_weights, apply_interp_weights
+
+NY, NX = 12, 15
+# 网格间距(度)和旋转角
+STEP = 0.1
+ANGLE = np.deg2rad(20)
+
+
+def make_grid():
+    '''绕(110E, 30N)旋转的规则网格，经纬度都是二维的'''
+    j, i = np.meshgrid(np.arange(NY), np.arange(NX), indexing='ij')
+    x, y = i * STEP, j * STEP
+    lon2d = 110 + x * np.cos(ANGLE) - y * np.sin(ANGLE)
+    lat2d = 30 + x * np.sin(ANGLE) + y * np.cos(ANGLE)
+    return lat2d, lon2d
+
+
+def gcdist(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(np.deg2rad, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * np.arcsin(np.sqrt(min(max(a, 0), 1)))
+
+
+def brute_force(lat2d, lon2d, data, lats, lons):
+    '''逐点遍历全部格点找最近点，在其周围四个单元中按rcm2points的条件找所在单元，再做四角反距离平方加权'''
+    ny, nx = lat2d.shape
+    result = np.full(len(lats), np.nan)
+    for n, (lat, lon) in enumerate(zip(lats, lons)):
+        dist = [[gcdist(lat, lon, lat2d[y, x], lon2d[y, x]) for x in range(nx)] for y in range(ny)]
+        y0, x0 = np.unravel_index(np.argmin(dist), (ny, nx))
+        if abs(lat - lat2d[y0, x0]) < EXACT_DEG and abs(lon - lon2d[y0, x0]) < EXACT_DEG:
+            result[n] = data[y0, x0]
+            continue
+        for dy, dx in [(0, 0), (-1, 0), (0, -1), (-1, -1)]:
+            cy, cx = min(max(y0 + dy, 0), ny - 2), min(max(x0 + dx, 0), nx - 2)
+            if lon2d[cy, cx] <= lon < lon2d[cy, cx + 1] and lat2d[cy, cx] <= lat < lat2d[cy + 1, cx]:
+                break
+        else:
+            continue
+        num = den = 0.
+        for y, x in [(cy, cx), (cy, cx + 1), (cy + 1, cx), (cy + 1, cx + 1)]:
+            if np.isfinite(data[y, x]):
+                w = 1 / gcdist(lat, lon, lat2d[y, x], lon2d[y, x]) ** 2
+                num, den = num + w * data[y, x], den + w
+        if den > 0:
+            result[n] = num / den
+    return result
+
+
+@pytest.fixture(scope='module')
+def case():
+    rng = np.random.default_rng(0)
+    lat2d, lon2d = make_grid()
+    data = np.sin(lat2d * 7) + np.cos(lon2d * 5)
+    # 网格内部的随机点、与格点重合的点(含最后一行/列)、网格外的点
+    inner = rng.integers([1, 1], [NY - 2, NX - 2], size=(40, 2))
+    frac = rng.random((40, 2))
+    lats = lat2d[inner[:, 0], inner[:, 1]] + frac[:, 0] * STEP * 0.9
+    lons = lon2d[inner[:, 0], inner[:, 1]] + frac[:, 1] * STEP * 0.3
+    exact_idx = [(0, 0), (3, 4), (NY - 1, 5), (6, NX - 1), (NY - 1, NX - 1)]
+    exact_lats = [lat2d[idx] + EXACT_DEG / 10 for idx in exact_idx]
+    exact_lons = [lon2d[idx] - EXACT_DEG / 10 for idx in exact_idx]
+    outside_lats = [lat2d.min() - 1, lat2d.max() + 1, 30.5, 25.]
+    outside_lons = [lon2d.min() - 1, lon2d.max() + 1, 100., 110.5]
+    lats = np.concatenate([lats, exact_lats, outside_lats])
+    lons = np.concatenate([lons, exact_lons, outside_lons])
+    kinds = np.array(['inner'] * 40 + ['exact'] * len(exact_idx) + ['outside'] * len(outside_lats))
+    return lat2d, lon2d, data, lats, lons, kinds, exact_idx
+
+
+def test_matches_brute_force(case):
+    lat2d, lon2d, data, lats, lons, kinds, _ = case
+    weights = build_interp_weights(lat2d, lon2d, lats, lons)
+    result = apply_interp_weights(weights, data)
+    expected = brute_force(lat2d, lon2d, data, lats, lons)
+    # 内部的随机点至少有一部分落在某个单元内
+    assert np.isfinite(expected[kinds == 'inner']).sum() > 20
+    np.testing.assert_allclose(result, expected, rtol=1e-12, equal_nan=True)
+
+
+def test_exact_and_outside(case):
+    lat2d, lon2d, data, lats, lons, kinds, exact_idx = case
+    result = apply_interp_weights(build_interp_weights(lat2d, lon2d, lats, lons), data)
+    np.testing.assert_array_equal(result[kinds == 'exact'], [data[idx] for idx in exact_idx])
+    assert np.isnan(result[kinds == 'outside']).all()
+
+
+def test_nan_corners(case):
+    '''缺测角点不参与加权，与格点重合的点取到缺测时为NaN'''
+    lat2d, lon2d, data, lats, lons, kinds, exact_idx = case
+    data = data.copy()
+    data[::2, ::3] = np.nan
+    data[exact_idx[1]] = np.nan
+    weights = build_interp_weights(lat2d, lon2d, lats, lons)
+    # 前置维度(时间、层次)一次完成
+    stacked = np.stack([data, data * 2])
+    result = apply_interp_weights(weights, stacked)
+    expected = brute_force(lat2d, lon2d, data, lats, lons)
+    np.testing.assert_allclose(result[0], expected, rtol=1e-12, equal_nan=True)
+    np.testing.assert_allclose(result[1], expected * 2, rtol=1e-12, equal_nan=True)
+    assert np.isnan(result[0][kinds == 'exact'][1])
+
+
+def test_matches_rcm2points(case):
+    geocat_comp = pytest.importorskip("geocat.comp")
+    lat2d, lon2d, data, lats, lons, _, _ = case
+    result = apply_interp_weights(build_interp_weights(lat2d, lon2d, lats, lons), data)
+    expected = np.asarray(geocat_comp.rcm2points(lat2d, lon2d, data, lats, lons), dtype=np.float64)
+    np.testing.assert_allclose(result, expected, rtol=1e-5, equal_nan=True)
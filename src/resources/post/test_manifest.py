@@ -0,0 +1,131 @@
+'''
+zManifest清单更新、状态和查询的测试，wrfout为只含Times变量的小netCDF文件
+python -m pytest test_manifest.py
+'''
+import os
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+netCDF4 = pytest.importorskip("netCDF4")
+
+import zManifest
+from zManifest import update_manifest, load_manifest, query_manifest, file_paths, status
+
+START = datetime(2026, 10, 18, 12)
+
+
+def write_wrfout(run_dir, domain, valid_time, mtime=None):
+    name = f"wrfout_{domain}_{valid_time:%Y-%m-%d_%H:%M:%S}"
+    path = os.path.join(run_dir, name)
+    with netCDF4.Dataset(path, 'w') as nc:
+        nc.createDimension('Time', None)
+        nc.createDimension('DateStrLen', 19)
+        times = nc.createVariable('Times', 'S1', ('Time', 'DateStrLen'))
+        times[0] = np.array(list(valid_time.strftime('%Y-%m-%d_%H:%M:%S')), 'S1')
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+    return name
+
+
+@pytest.fixture
+def run_dir(tmp_path):
+    '''d01每小时、d02每15分钟，全部已写完较久；另有一个无法读取的d02文件'''
+    old = time.time() - 3600
+    for i in range(4):
+        write_wrfout(str(tmp_path), 'd01', START + timedelta(hours=i), old)
+    for i in range(8):
+        write_wrfout(str(tmp_path), 'd02', START + timedelta(minutes=15 * i), old)
+    broken = tmp_path / f"wrfout_d02_{START - timedelta(minutes=15):%Y-%m-%d_%H:%M:%S}"
+    broken.write_bytes(b'not netcdf')
+    os.utime(broken, (old, old))
+    (tmp_path / 'rsl.out.0000').write_text('')
+    return str(tmp_path)
+
+
+def test_update(run_dir):
+    manifest = update_manifest(run_dir)
+    files = manifest['files']
+    assert len(files) == 13
+    assert os.path.exists(zManifest.manifest_path(run_dir))
+    assert load_manifest(run_dir) == manifest
+
+    record = files[f"wrfout_d02_{START:%Y-%m-%d_%H:%M:%S}"]
+    assert record['domain'] == 'd02' and record['valid_times'] == [START.isoformat()]
+    assert record['complete']
+    broken = files[f"wrfout_d02_{START - timedelta(minutes=15):%Y-%m-%d_%H:%M:%S}"]
+    assert broken['valid_times'] is None and not broken['complete']
+
+
+def test_latest_file_is_complete_when_settled_or_final(run_dir):
+    name = write_wrfout(run_dir, 'd02', START + timedelta(hours=2))
+    assert not update_manifest(run_dir)['files'][name]['complete']
+    # 同域出现更晚的文件后即视为写完
+    write_wrfout(run_dir, 'd02', START + timedelta(hours=2, minutes=15))
+    files = update_manifest(run_dir)['files']
+    assert files[name]['complete']
+    assert not files[f"wrfout_d02_{START + timedelta(hours=2, minutes=15):%Y-%m-%d_%H:%M:%S}"]['complete']
+    assert all(record['complete'] for record in update_manifest(run_dir, final=True)['files'].values()
+               if record['valid_times'] is not None)
+
+
+def test_update_reuses_unchanged_records(run_dir, monkeypatch):
+    update_manifest(run_dir)
+    read = []
+    real_read = zManifest.read_valid_times
+    monkeypatch.setattr(zManifest, 'read_valid_times',
+                        lambda path, name_time: read.append(path) or real_read(path, name_time))
+
+    update_manifest(run_dir)
+    # 只有无法读取的文件会再次尝试
+    assert [os.path.basename(path) for path in read] == \
+           [f"wrfout_d02_{START - timedelta(minutes=15):%Y-%m-%d_%H:%M:%S}"]
+
+    read.clear()
+    name = write_wrfout(run_dir, 'd01', START + timedelta(hours=4))
+    update_manifest(run_dir)
+    assert sorted(os.path.basename(path) for path in read) == \
+           sorted([name, f"wrfout_d02_{START - timedelta(minutes=15):%Y-%m-%d_%H:%M:%S}"])
+
+    # 删除的文件从清单中去掉
+    os.remove(os.path.join(run_dir, name))
+    assert name not in update_manifest(run_dir)['files']
+
+
+def test_status(run_dir, tmp_path_factory):
+    manifest = update_manifest(run_dir)
+    count, latest = status(manifest)
+    assert count == 13
+    assert latest == int(max(os.stat(os.path.join(run_dir, name)).st_mtime for name in manifest['files']))
+    assert status(update_manifest(str(tmp_path_factory.mktemp('empty')))) == (0, 0)
+
+
+def test_query(run_dir):
+    manifest = update_manifest(run_dir, final=True)
+    d02 = query_manifest(manifest, domain='d02')
+    assert [record['valid_times'][0] for record in d02] == \
+           [(START + timedelta(minutes=15 * i)).isoformat() for i in range(8)]
+    # 不完整的文件只在complete=False时返回，排在最前
+    assert query_manifest(manifest, domain='d02', complete=False)[0]['valid_times'] is None
+
+    window = query_manifest(manifest, domain='d02', start=START + timedelta(minutes=30),
+                            end=(START + timedelta(hours=1)).isoformat())
+    assert [record['valid_times'][0] for record in window] == \
+           [(START + timedelta(minutes=15 * i)).isoformat() for i in [2, 3]]
+    assert len(query_manifest(manifest)) == 12
+    assert file_paths(run_dir, d02[:1]) == [os.path.join(run_dir, f"wrfout_d02_{START:%Y-%m-%d_%H:%M:%S}")]
+
+
+def test_main(run_dir, capsys):
+    assert zManifest.main(['status', run_dir]) == 0
+    count, latest = capsys.readouterr().out.split()
+    assert int(count) == 13 and int(latest) > 0
+
+    zManifest.main(['list', run_dir, '--domain', 'd01'])
+    assert capsys.readouterr().out.splitlines() == \
+           [os.path.join(run_dir, f"wrfout_d01_{START + timedelta(hours=i):%Y-%m-%d_%H:%M:%S}") for i in range(4)]
+
+    zManifest.main(['update', run_dir, '--domain', 'd02'])
+    assert capsys.readouterr().out.strip() == '9 files, 8 complete'
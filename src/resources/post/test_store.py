@@ -0,0 +1,79 @@
+'''
+zStore磁盘路径与内存路径的一致性测试：NetCDFAppender逐时次追加、shift_time_ondisk和分块的add_vars_leadhour_ondisk
+与xr.concat后utc_to_bjt、add_vars_leadhour的结果相同；zFunc依赖wrf-python，没有安装时跳过
+python -m pytest test_store.py
+'''
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+pytest.importorskip("wrf")
+
+from zFunc import utc_to_bjt, add_vars_leadhour
+from zStore import NetCDFAppender, shift_time_ondisk, add_vars_leadhour_ondisk, iter_id_chunks
+
+N_TIMES, N_IDS = 20, 7
+LEVELS = [70, 100]
+VARS_LEADHOUR = ['T2', 'tk']
+
+
+def make_slices(seed=0):
+    '''与ds_final结构相同的逐时次Dataset：(time, id)和(time, level, id)的变量，以及各风机的轮毂高度'''
+    rng = np.random.default_rng(seed)
+    ids = [f"WT{i:02d}" for i in range(N_IDS)]
+    times = pd.date_range('2026-10-18 13:00', periods=N_TIMES, freq='15min')
+    hub = xr.DataArray(rng.choice(LEVELS, N_IDS), dims='id')
+    slices = []
+    for time in times:
+        t2 = rng.normal(290, 5, (1, N_IDS))
+        t2[0, 3] = np.nan
+        ds = xr.Dataset({'T2': (('time', 'id'), t2),
+                         'tk': (('time', 'level', 'id'), rng.normal(285, 5, (1, len(LEVELS), N_IDS))),
+                         'ws': (('time', 'id'), rng.random((1, N_IDS)).astype(np.float32))},
+                        coords={'time': [time], 'id': ids, 'level': LEVELS, 'hub': hub})
+        ds['T2'].attrs['units'] = 'K'
+        slices.append(ds)
+    return slices
+
+
+@pytest.mark.parametrize('profile', ['none', 'zlib', 'packed'])
+def test_ondisk_matches_inmemory(tmp_path, profile):
+    slices = make_slices()
+    expected = xr.concat(slices, dim='time')
+    expected = utc_to_bjt(expected)
+    for leadhour in [1, 3]:
+        expected = add_vars_leadhour(expected, leadhour, VARS_LEADHOUR)
+
+    path = str(tmp_path / 'GFS.nc')
+    with NetCDFAppender(path, profile=profile) as appender:
+        for ds in slices:
+            appender.append(ds)
+    shift_time_ondisk(path, 8)
+    for leadhour in [1, 3]:
+        # 分块小于风机数，检验跨块拼接
+        add_vars_leadhour_ondisk(path, leadhour, VARS_LEADHOUR, chunk_size=3)
+
+    # packed配置在追加时按float32写出，变化量的误差为原值(约300)的float32舍入误差
+    atol = 1e-4 if profile == 'packed' else 0
+    with xr.open_dataset(path) as actual:
+        assert set(actual.data_vars) == set(expected.data_vars)
+        np.testing.assert_array_equal(actual.time.values, expected.time.values)
+        np.testing.assert_array_equal(actual.id.values, expected.id.values)
+        np.testing.assert_array_equal(actual.hub.values, expected.hub.values)
+        assert actual['T2'].attrs['units'] == 'K'
+        for name in expected.data_vars:
+            np.testing.assert_allclose(actual[name].transpose(*expected[name].dims).values, expected[name].values,
+                                       atol=atol, rtol=0, equal_nan=True, err_msg=name)
+
+
+def test_iter_id_chunks(tmp_path):
+    slices = make_slices(1)
+    path = str(tmp_path / 'GFS.nc')
+    with NetCDFAppender(path) as appender:
+        for ds in slices:
+            appender.append(ds)
+    chunks = list(iter_id_chunks(path, chunk_size=3))
+    assert [chunk.sizes['id'] for chunk in chunks] == [3, 3, 1]
+    xr.testing.assert_allclose(xr.concat(chunks, dim='id').transpose('time', ...)['tk'],
+                               xr.concat(slices, dim='time')['tk'])
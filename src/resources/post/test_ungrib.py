@@ -0,0 +1,129 @@
+'''
+zUngrib时间窗划分与GRIB2参考时间解析的测试
+python -m pytest test_ungrib.py
+'''
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+from zGeoCache import read_namelist
+from zUngrib import (time_steps, split_windows, grib_valid_time, gribfile_name, window_namelist, prepare_window,
+                     DATE_FORMAT)
+
+NAMELIST = '''\
+&share
+ wrf_core = 'ARW',
+ max_dom = 2,
+ start_date = '2026-10-18_00:00:00','2026-10-18_00:00:00',
+ end_date   = '2026-10-22_00:00:00','2026-10-22_00:00:00',
+ interval_seconds = 10800
+/
+&ungrib
+ out_format = 'WPS',
+ prefix = 'FILE',
+/
+'''
+START = datetime(2026, 10, 18)
+
+
+def grib2_head(reference, discipline=0):
+    '''第0段和第1段的前21字节，参考时间在第1段的第13-19字节'''
+    section0 = b'GRIB\x00\x00' + bytes([discipline, 2]) + (1000).to_bytes(8, 'big')
+    section1 = (21).to_bytes(4, 'big') + b'\x01' + (7).to_bytes(2, 'big') + b'\x00\x00\x02\x01\x01' \
+        + reference.year.to_bytes(2, 'big') + bytes([reference.month, reference.day, reference.hour,
+                                                     reference.minute, reference.second]) + b'\x00\x01'
+    return section0 + section1
+
+
+@pytest.fixture
+def namelist_path(tmp_path):
+    path = tmp_path / 'namelist.wps'
+    path.write_text(NAMELIST)
+    return str(path)
+
+
+def test_time_steps(namelist_path):
+    steps = time_steps(read_namelist(namelist_path))
+    # f000-f096每3小时一个
+    assert len(steps) == 33
+    assert steps[0] == START and steps[-1] == START + timedelta(hours=96)
+    assert all(b - a == timedelta(hours=3) for a, b in zip(steps, steps[1:]))
+
+
+@pytest.mark.parametrize('n, sizes', [(1, [33]), (4, [9, 8, 8, 8]), (12, [3] * 9 + [2] * 3), (40, [1] * 33)])
+def test_split_windows(n, sizes):
+    steps = [START + timedelta(hours=3 * i) for i in range(33)]
+    windows = split_windows(steps, n)
+    assert [len(window) for window in windows] == sizes
+    # 按顺序连续覆盖全部时次
+    assert [step for window in windows for step in window] == steps
+
+
+def test_grib_valid_time(tmp_path):
+    reference = datetime(2026, 10, 18, 6)
+    path = tmp_path / 'gfs.t06z.pgrb2.0p50.f084'
+    path.write_bytes(grib2_head(reference) + b'\x00' * 100)
+    assert grib_valid_time(str(path)) == reference + timedelta(hours=84)
+
+    # link_grib.csh的链接按目标文件名取预报时效
+    link = tmp_path / 'GRIBFILE.AAA'
+    os.symlink(path, link)
+    assert grib_valid_time(str(link)) == reference + timedelta(hours=84)
+
+    short_hour = tmp_path / 'gfs.t06z.pgrb2.0p50.f06'
+    short_hour.write_bytes(grib2_head(reference))
+    assert grib_valid_time(str(short_hour)) == reference + timedelta(hours=6)
+
+
+def test_grib_valid_time_unknown(tmp_path):
+    reference = datetime(2026, 10, 18)
+    no_hour = tmp_path / 'gfs.t00z.pgrb2.0p50.anl'
+    no_hour.write_bytes(grib2_head(reference))
+    grib1 = tmp_path / 'gfs.t00z.pgrb.f003'
+    grib1.write_bytes(grib2_head(reference)[:7] + b'\x01' + grib2_head(reference)[8:])
+    truncated = tmp_path / 'gfs.t00z.pgrb2.0p50.f003'
+    truncated.write_bytes(grib2_head(reference)[:30])
+    for path in [no_hour, grib1, truncated, tmp_path / 'missing.f000']:
+        assert grib_valid_time(str(path)) is None
+
+
+def test_gribfile_name():
+    assert [gribfile_name(i) for i in [0, 1, 25, 26, 27 * 26]] == \
+           ['GRIBFILE.AAA', 'GRIBFILE.AAB', 'GRIBFILE.AAZ', 'GRIBFILE.ABA', 'GRIBFILE.BBA']
+
+
+def test_window_namelist(namelist_path, tmp_path):
+    steps = time_steps(read_namelist(namelist_path))
+    window = split_windows(steps, 4)[1]
+    path = tmp_path / 'window.wps'
+    path.write_text(window_namelist(NAMELIST, window))
+    share = read_namelist(str(path))['share']
+    # 每个域一个值，其余设置不变
+    assert share['start_date'] == [window[0].strftime(DATE_FORMAT)] * 2
+    assert share['end_date'] == [window[-1].strftime(DATE_FORMAT)] * 2
+    assert share['interval_seconds'] == ['10800']
+    assert read_namelist(str(path))['ungrib'] == read_namelist(namelist_path)['ungrib']
+
+
+def test_prepare_window_links_files_in_window(namelist_path, tmp_path):
+    ungrib_dir = tmp_path
+    for name in ('ungrib.exe', 'Vtable'):
+        (ungrib_dir / name).write_text('')
+    gribfiles = []
+    for hour in range(0, 97, 3):
+        path = ungrib_dir / f"gfs.t00z.pgrb2.0p50.f{hour:03d}"
+        path.write_bytes(grib2_head(START))
+        gribfiles.append((str(path), grib_valid_time(str(path))))
+    # 无法判断有效时间的文件链接到每个时间窗
+    gribfiles.append((str(ungrib_dir / 'unknown.grb'), None))
+
+    window = split_windows(time_steps(read_namelist(namelist_path)), 4)[2]
+    work_dir = ungrib_dir / 'w02'
+    assert prepare_window(str(ungrib_dir), str(work_dir), window, gribfiles, NAMELIST) == len(window) + 1
+    linked = sorted(name for name in os.listdir(work_dir) if name.startswith('GRIBFILE.'))
+    assert linked == [gribfile_name(i) for i in range(len(window) + 1)]
+    assert os.path.basename(os.readlink(work_dir / 'GRIBFILE.AAA')) == \
+        f"gfs.t00z.pgrb2.0p50.f{int((window[0] - START).total_seconds() // 3600):03d}"
+    assert os.path.islink(work_dir / 'ungrib.exe') and os.path.islink(work_dir / 'Vtable')
+    assert read_namelist(str(work_dir / 'namelist.wps'))['share']['end_date'][0] == window[-1].strftime(DATE_FORMAT)
@@ -0,0 +1,74 @@
+'''
+zZarr写出与读取的往返测试：整体写出和按风机分块追加写出后，read_turbine/read_variable与原数据一致
+没有安装zarr时跳过
+python -m pytest test_zarr.py
+'''
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+pytest.importorskip("zarr")
+
+from zZarr import ID_CHUNK, write_zarr, read_turbine, read_variable
+
+N_TIMES, N_IDS = 30, 20
+
+
+def make_forecast(seed=0):
+    rng = np.random.default_rng(seed)
+    ids = np.array([f"WT{i:03d}" for i in range(N_IDS)], dtype=object)
+    times = pd.date_range('2026-10-18 21:00', periods=N_TIMES, freq='15min')
+    ws = rng.random((N_TIMES, N_IDS)).astype(np.float32) * 20
+    ws[3, 5] = np.nan
+    ds = xr.Dataset({'ws': (('time', 'id'), ws),
+                     'wd': (('time', 'id'), rng.random((N_TIMES, N_IDS)) * 360),
+                     'tk': (('time', 'level', 'id'), rng.normal(285, 5, (N_TIMES, 2, N_IDS)))},
+                    coords={'time': times, 'id': ids, 'level': [70, 100]})
+    ds['ws'].attrs['units'] = 'm s-1'
+    return ds
+
+
+@pytest.fixture(params=['whole', 'chunks'])
+def store(request, tmp_path):
+    ds = make_forecast()
+    path = str(tmp_path / 'GFS_20261018.zarr')
+    if request.param == 'whole':
+        write_zarr(ds, path)
+    else:
+        # 与iter_id_chunks相同，按风机分块追加
+        write_zarr((ds.isel(id=slice(start, start + 2 * ID_CHUNK)) for start in range(0, N_IDS, 2 * ID_CHUNK)), path)
+    return ds, path
+
+
+def test_read_turbine(store):
+    ds, path = store
+    for turbine_id in ['WT000', 'WT005', 'WT019']:
+        actual = read_turbine(path, turbine_id)
+        expected = ds.sel(id=turbine_id)
+        for name in ds.data_vars:
+            np.testing.assert_array_equal(actual[name].values, expected[name].values)
+            assert actual[name].dtype == expected[name].dtype
+        np.testing.assert_array_equal(actual.time.values, ds.time.values)
+        assert actual['ws'].attrs['units'] == 'm s-1'
+
+    subset = read_turbine(path, 'WT007', ['ws'])
+    assert list(subset.data_vars) == ['ws']
+
+
+def test_read_variable(store):
+    ds, path = store
+    xr.testing.assert_equal(read_variable(path, 'wd').assign_coords(id=ds.id.values), ds['wd'])
+    np.testing.assert_array_equal(read_variable(path, 'tk', ['WT001', 'WT012']).values,
+                                  ds['tk'].sel(id=['WT001', 'WT012']).values)
+
+
+def test_layout(store):
+    '''合并元数据，数据变量按风机和时次分块'''
+    ds, path = store
+    assert os.path.exists(os.path.join(path, '.zmetadata'))
+    with open(os.path.join(path, 'ws', '.zarray')) as f:
+        assert json.load(f)['chunks'] == [N_TIMES, ID_CHUNK]
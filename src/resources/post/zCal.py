@@ -6,6 +6,8 @@ import wrf
 from glob import glob
 from geocat.comp import rcm2rgrid, rcm2points
 from zFunc import export_log
+import zDerive
+from zInterp import load_interp_weights, interp2d_weights, interplevel_vars
 
 
 def interp_ec_vars(ds, turbines_info, log_path):
@@ -37,13 +39,18 @@ def cal_ec_extend_vars(ds_interp, log_path, drop_var=False):
     return ds_final
 
 
-def interp_gfs_vars(ds, turbines_info, select_levels, log_path, cal_static=False):
+def interp_gfs_vars(ds, turbines_info, select_levels, log_path, cal_static=False, weights_dir=None):
     turbines_names, turbines_lons, turbines_lats, turbines_height = turbines_info
 
     # 维度信息
     ds = ds.rename({'Time': 'time'})
     lats, lons = ds['XLAT'], ds['XLONG']
 
+    # 水平插值权重，给定weights_dir时按域缓存复用，否则逐变量调用rcm2points
+    weights = None
+    if weights_dir is not None:
+        weights = load_interp_weights(lats, lons, turbines_lats, turbines_lons, weights_dir)
+
     # 垂直坐标
     z_agl = ds['z'] - ds['ter']
 
@@ -53,14 +60,19 @@ def interp_gfs_vars(ds, turbines_info, select_levels, log_path, cal_static=False
         ds['ss'] = cal_static_stability(ds['pressure'], ds['tk'])
         # export_log(f"Max: {np.max(ds['ss']).values:.4f}", log_path)
 
-    # 垂直+地理插值
+    # 垂直插值：上下层索引和权重只算一次，所有含bottom_top的变量一次完成
+    var_interplevel_dict = interplevel_vars(ds, z_agl, select_levels)
+
+    # 地理插值
     var_interp2d_dict = {}
     for var_name in ds.data_vars:
         # export_log(f"> 正在插值GFS_{var_name}", log_path)
-        data_prepare = ds[var_name]
-        data_interplevel = interplevel_wrfout(data_prepare, z_agl, select_levels)
-        data_interp2d = interp2d_wrfout(data_interplevel, lons, lats, turbines_lons, turbines_lats, turbines_names,
-                                        select_levels)
+        data_interplevel = var_interplevel_dict.get(var_name, ds[var_name])
+        if weights is not None:
+            data_interp2d = interp2d_weights(data_interplevel, weights, turbines_names, select_levels)
+        else:
+            data_interp2d = interp2d_wrfout(data_interplevel, lons, lats, turbines_lons, turbines_lats,
+                                            turbines_names, select_levels)
         # export_log(f"Max: {np.max(data_interp2d).values:.4f}", log_path)
         var_interp2d_dict[var_name] = data_interp2d
 
@@ -112,9 +124,14 @@ def interp2d_wrfout(da_input, source_lon2d, source_lat2d, target_lons, target_la
 def interp3dpoint_wrfout(da_input, target_level):
     '''每台风机的3d插值，3D插值之前必须完成2D插值'''
     if 'level' in da_input.dims:
-        da_interp3d = da_input.isel(level=0).copy()
-        for id in da_input.id:
-            da_interp3d.loc[dict(id=id)] = da_input.sel(id=id, level=target_level.sel(id=id))
+        # 所有风机的轮毂高度层一次高级索引取出，替代逐风机sel
+        da_input = da_input.transpose('time', 'level', 'id')
+        target_level = target_level.sel(id=da_input.id)
+        level_pos = da_input.indexes['level'].get_indexer(target_level.values)
+        if (level_pos < 0).any():
+            raise KeyError(f"levels {np.unique(target_level.values[level_pos < 0])} not in interpolated levels")
+        values = da_input.values[:, level_pos, np.arange(da_input.sizes['id'])]
+        da_interp3d = da_input.isel(level=0, drop=True).copy(data=values)
         da_interp3d.coords['level'] = target_level
         return da_interp3d
     else:
@@ -122,41 +139,18 @@ def interp3dpoint_wrfout(da_input, target_level):
 
 
 def cal_WS_WD(u, v):
-    from metpy.calc import wind_speed, wind_direction
-    from metpy.units import units
-    ws, wd = u.copy(), u.copy()
-    u_input = u.values * units('m/s')
-    v_input = v.values * units('m/s')
-    ws[:], wd[:] = wind_speed(u_input, v_input), wind_direction(u_input, v_input)
+    ws = u.copy(deep=False, data=zDerive.wind_speed(u.values, v.values))
+    wd = u.copy(deep=False, data=zDerive.wind_direction(u.values, v.values))
     return ws, wd
 
 
 def cal_air_density(pres, t, mixing_ratio):
-    from metpy.calc import density
-    from metpy.units import units
-    rho = pres.copy()
-    pres_input = pres * units('hPa')
-    t_input = t * units('degK')
-    mixing_ratio_input = mixing_ratio * units('kg/kg')
-    rho[:] = density(pres_input, t_input, mixing_ratio_input)
-    return rho
+    return pres.copy(deep=False, data=zDerive.density(pres.values, t.values, mixing_ratio.values))
 
 
 def cal_potential_temperature(pres, t):
-    from metpy.calc import potential_temperature
-    from metpy.units import units
-    th = pres.copy()
-    pres_input = pres * units('hPa')
-    t_input = t * units('degK')
-    th[:] = potential_temperature(pres_input, t_input)
-    return th
+    return pres.copy(deep=False, data=zDerive.potential_temperature(pres.values, t.values))
 
 
 def cal_static_stability(pres, t, vertical_dim=1):
-    from metpy.calc import static_stability
-    from metpy.units import units
-    ss = pres.copy()
-    pres_input = pres * units('hPa')
-    t_input = t * units('degK')
-    ss[:] = static_stability(pres_input, t_input, vertical_dim)
-    return ss
\ No newline at end of file
+    return pres.copy(deep=False, data=zDerive.static_stability(pres.values, t.values, vertical_dim))
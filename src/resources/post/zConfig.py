@@ -71,6 +71,34 @@ def gfs_netcdf_dir(prefix):
     return f"{prefix}/post/gfs_netcdf"
 
 
+def gfs_parquet_dir(prefix):
+    """
+    Get gfs Parquet file path, one columnar file per day holding every turbine
+    :param prefix: sample /fsx/domain_1
+    :return: parquet output path
+    """
+    return f"{prefix}/post/gfs_parquet"
+
+
+def gfs_zarr_dir(prefix):
+    """
+    Get gfs Zarr store path, one store per day chunked by turbine and lead time
+    :param prefix: sample /fsx/domain_1
+    :return: zarr output path
+    """
+    return f"{prefix}/post/gfs_zarr"
+
+
+def weights_dir(prefix):
+    """
+    Get cached horizontal interpolation weights path
+    Weights only depend on the domain grid and locations.xlsx, so they are reused across forecast cycles
+    :param prefix: /fsx/domain_1
+    :return: interpolation weights cache path
+    """
+    return f"{prefix}/post/weights"
+
+
 def gfs_log_path(prefix):
     return f"{prefix}/post/logs/gfs_{date_now_str}.log"
 
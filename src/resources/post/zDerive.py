@@ -0,0 +1,93 @@
+'''
+派生变量的纯NumPy实现
+公式和常数与MetPy一致(wind_speed/wind_direction/density/potential_temperature/static_stability)
+输入输出均为无单位的ndarray：气压hPa，温度K，混合比kg/kg；float32输入保持float32计算
+安装了numexpr时逐元素表达式交给numexpr多线程计算
+'''
+import numpy as np
+
+try:
+    import numexpr as ne
+except ImportError:
+    ne = None
+
+# 与metpy.constants相同
+Rd = 287.04749097718457      # 干空气气体常数 J/(kg K)
+epsilon = 0.6219569100577033  # 水汽与干空气分子量之比
+kappa = 0.28571428571428564   # Rd/Cp_d
+P0 = 1000.                    # 参考气压 hPa
+
+
+def _as_array(*arrays):
+    arrays = [np.asarray(array) for array in arrays]
+    dtype = np.result_type(*arrays, np.float32)
+    return [array.astype(dtype, copy=False) for array in arrays], dtype
+
+
+def wind_speed(u, v):
+    (u, v), dtype = _as_array(u, v)
+    if ne is not None:
+        return ne.evaluate('sqrt(u * u + v * v)').astype(dtype, copy=False)
+    return np.sqrt(u * u + v * v)
+
+
+def wind_direction(u, v):
+    '''气象风向(风的来向)，0~360度，静风为0'''
+    (u, v), dtype = _as_array(u, v)
+    wdir = 90. - np.degrees(np.arctan2(-v, -u))
+    wdir = np.where(wdir <= 0, wdir + 360., wdir)
+    return np.where((u == 0) & (v == 0), 0., wdir).astype(dtype, copy=False)
+
+
+def density(pres, t, mixing_ratio):
+    '''空气密度 kg/m3，先求虚温再由状态方程计算'''
+    (p, t, w), dtype = _as_array(pres, t, mixing_ratio)
+    eps, rd = dtype.type(epsilon), dtype.type(Rd)
+    if ne is not None:
+        return ne.evaluate('p * 100 / (rd * t * (w + eps) / (eps * (1 + w)))').astype(dtype, copy=False)
+    return p * 100 / (rd * t * (w + eps) / (eps * (1 + w)))
+
+
+def potential_temperature(pres, t):
+    (p, t), dtype = _as_array(pres, t)
+    p0, k = dtype.type(P0), dtype.type(kappa)
+    if ne is not None:
+        return ne.evaluate('t * (p0 / p) ** k').astype(dtype, copy=False)
+    return t * (p0 / p) ** k
+
+
+def first_derivative(f, x, axis=0):
+    '''非均匀网格二阶精度差分，内部中心差分、两端单侧三点差分，与metpy.calc.first_derivative相同'''
+    f = np.asarray(f)
+    x = np.moveaxis(np.broadcast_to(np.asarray(x), f.shape), axis, 0)
+    f = np.moveaxis(f, axis, 0)
+    dx = np.diff(x, axis=0)
+    result = np.empty_like(f)
+
+    d0, d1 = dx[:-1], dx[1:]
+    combined = d0 + d1
+    result[1:-1] = (-d1 / (d0 * combined) * f[:-2]
+                    + (d1 - d0) / (d0 * d1) * f[1:-1]
+                    + d0 / (d1 * combined) * f[2:])
+
+    d0, d1 = dx[0], dx[1]
+    combined = d0 + d1
+    result[0] = (-(combined + d0) / (combined * d0) * f[0]
+                 + combined / (d0 * d1) * f[1]
+                 - d0 / (combined * d1) * f[2])
+
+    d0, d1 = dx[-2], dx[-1]
+    combined = d0 + d1
+    result[-1] = (d1 / (d0 * combined) * f[-3]
+                  - combined / (d0 * d1) * f[-2]
+                  + (2 * d1 + d0) / (d1 * combined) * f[-1])
+    return np.moveaxis(result, 0, axis)
+
+
+def static_stability(pres, t, vertical_dim=0):
+    '''静力稳定度，单位与MetPy以hPa输入时相同：J/(kg hPa^2)'''
+    (pres, t), dtype = _as_array(pres, t)
+    # 差分对舍入误差敏感，内部统一用float64计算
+    pres, t = pres.astype(np.float64, copy=False), t.astype(np.float64, copy=False)
+    th = potential_temperature(pres, t)
+    return (-Rd * t / pres * first_derivative(np.log(th), pres, axis=vertical_dim)).astype(dtype, copy=False)
@@ -0,0 +1,259 @@
+'''
+按需下载GFS
+NOAA桶中每个gfs.tHHz.pgrb2.0p50.fNNN都有一个.idx索引，记录每条GRIB消息的起始字节、变量名和层次
+这里按Vtable.GFS中ungrib实际使用的变量和层次挑出需要的消息，相邻消息合并成一个Range请求，
+所有文件的请求共用一个有上限的线程池和连接池并发下载，拼接后的文件仍是合法的GRIB2，文件名不变
+每段下载校验长度，整个文件逐条校验GRIB消息结构和条数，失败时重试；没有.idx的文件整个下载
+
+python zDownload.py 2026101800 downloads/ --vtable Vtable.GFS --hours 0:96:3 --no-sign-request
+python zDownload.py 2026101800 downloads/ --vtable Vtable.GFS --endpoint-url http://localhost:5000   # 本地S3测试
+'''
+import argparse
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import boto3
+import botocore.exceptions
+from botocore import UNSIGNED
+from botocore.config import Config
+
+MB = 1024 * 1024
+GFS_BUCKET = 'noaa-gfs-bdp-pds'
+ATTEMPTS = 3
+
+# Vtable中GRIB2的(discipline, category, number)对应.idx中的变量名(wgrib2缩写)
+GRIB2_NAMES = {
+    (0, 0, 0): ['TMP'], (0, 1, 0): ['SPFH'], (0, 1, 1): ['RH'], (0, 1, 11): ['SNOD'], (0, 1, 13): ['WEASD'],
+    (0, 1, 22): ['CLMR'], (0, 1, 23): ['ICMR'], (0, 1, 24): ['RWMR'], (0, 1, 25): ['SNMR'], (0, 1, 32): ['GRLE'],
+    (0, 2, 2): ['UGRD'], (0, 2, 3): ['VGRD'], (0, 2, 8): ['VVEL'], (0, 2, 9): ['DZDT'],
+    (0, 3, 0): ['PRES'], (0, 3, 1): ['PRMSL'], (0, 3, 5): ['HGT'], (0, 3, 192): ['MSLET'],
+    (0, 14, 192): ['O3MR'], (2, 0, 0): ['LAND'], (2, 0, 2): ['TSOIL'], (2, 0, 192): ['SOILW'],
+    (2, 3, 18): ['TSOIL'], (2, 3, 192): ['SOILL'], (10, 2, 0): ['ICEC'],
+}
+# GRIB2层次类型对应.idx中的层次写法，值为从Vtable的Level1/Level2生成匹配函数
+LEVELS = {
+    1: lambda l1, l2: lambda level: level == 'surface',
+    6: lambda l1, l2: lambda level: level == 'max wind',
+    7: lambda l1, l2: lambda level: level == 'tropopause',
+    101: lambda l1, l2: lambda level: level == 'mean sea level',
+    100: lambda l1, l2: _single_level(r'^([\d.]+) mb$', l1),
+    103: lambda l1, l2: _single_level(r'^([\d.]+) m above ground$', l1),
+    # Vtable中土壤层为GRIB1的厘米，.idx中为米
+    106: lambda l1, l2: _layer(l1, l2, 0.01),
+}
+IDX_LEVEL_LAYER = re.compile(r'^([\d.]+)-([\d.]+) m below ground$')
+
+
+def _single_level(pattern, value):
+    pattern = re.compile(pattern)
+    def match(level):
+        m = pattern.match(level)
+        return m is not None and (value == '*' or float(m.group(1)) == float(value))
+    return match
+
+
+def _layer(top, bottom, scale):
+    def match(level):
+        m = IDX_LEVEL_LAYER.match(level)
+        if m is None:
+            return False
+        if top == '*':
+            return True
+        return abs(float(m.group(1)) - float(top) * scale) < 1e-6 \
+            and abs(float(m.group(2)) - float(bottom or top) * scale) < 1e-6
+    return match
+
+
+def read_vtable(path):
+    '''返回[(变量名列表或None, 层次匹配函数或None)]，None表示该项不限制'''
+    rules = []
+    with open(path) as f:
+        for line in f:
+            cols = [col.strip() for col in line.split('|')]
+            if len(cols) < 11 or not cols[4] or not cols[7].isdigit():
+                continue
+            level1, level2 = cols[2], cols[3]
+            discipline, category, number, level_type = (int(col) for col in cols[7:11])
+            names = GRIB2_NAMES.get((discipline, category, number))
+            level = LEVELS.get(level_type)
+            rules.append((names, level(level1, level2) if level else None))
+    return rules
+
+
+def parse_idx(text):
+    '''.idx每行 序号:起始字节:d=参考时间:变量:层次:时效:，返回[(起始字节, 变量, 层次)]'''
+    messages = []
+    for line in text.splitlines():
+        fields = line.split(':')
+        if len(fields) >= 5 and fields[1].isdigit():
+            messages.append((int(fields[1]), fields[3], fields[4]))
+    return messages
+
+
+def select_ranges(messages, rules, size):
+    '''
+    挑出Vtable用到的消息，返回合并后的字节区间[(起, 止(含), 消息数)]
+    size为对象大小，最后一条消息到文件末尾
+    '''
+    ranges = []
+    for i, (start, name, level) in enumerate(messages):
+        if not any((names is None or name in names) and (match is None or match(level)) for names, match in rules):
+            continue
+        end = messages[i + 1][0] - 1 if i + 1 < len(messages) else size - 1
+        if ranges and ranges[-1][1] + 1 == start:
+            ranges[-1] = (ranges[-1][0], end, ranges[-1][2] + 1)
+        else:
+            ranges.append((start, end, 1))
+    return ranges
+
+
+def count_grib_messages(path):
+    '''按第0段的总长度逐条走完整个文件，每条以GRIB开头、7777结尾、版本为2；结构不对时返回None'''
+    count = 0
+    with open(path, 'rb') as f:
+        while True:
+            head = f.read(16)
+            if not head:
+                return count
+            if len(head) < 16 or head[:4] != b'GRIB' or head[7] != 2:
+                return None
+            length = int.from_bytes(head[8:16], 'big')
+            f.seek(length - 20, os.SEEK_CUR)
+            if f.read(4) != b'7777':
+                return None
+            count += 1
+
+
+def gfs_key(cycle, hour, resolution='0p50'):
+    return f"gfs.{cycle:%Y%m%d}/{cycle:%H}/atmos/gfs.t{cycle:%H}z.pgrb2.{resolution}.f{hour:03d}"
+
+
+def s3_client(workers, endpoint_url=None, unsigned=False):
+    config = Config(max_pool_connections=workers, retries={'max_attempts': 5, 'mode': 'standard'},
+                    signature_version=UNSIGNED if unsigned else None)
+    return boto3.session.Session().client('s3', endpoint_url=endpoint_url, config=config)
+
+
+def _get(client, bucket, key, byte_range=None):
+    '''下载一段，长度不符时重试'''
+    for attempt in range(1, ATTEMPTS + 1):
+        try:
+            if byte_range is None:
+                return client.get_object(Bucket=bucket, Key=key)['Body'].read()
+            start, end = byte_range
+            data = client.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end}")['Body'].read()
+            if len(data) == end - start + 1:
+                return data
+            error = f"got {len(data)} bytes of {key} {start}-{end}"
+        except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as e:
+            if isinstance(e, botocore.exceptions.ClientError) and e.response['Error']['Code'] == 'NoSuchKey':
+                raise
+            error = str(e)
+        if attempt == ATTEMPTS:
+            raise IOError(error)
+        time.sleep(attempt)
+
+
+def plan_file(client, bucket, key, rules):
+    '''返回(对象大小, 区间列表)；没有.idx时区间为None，表示整个下载'''
+    size = client.head_object(Bucket=bucket, Key=key)['ContentLength']
+    try:
+        idx = _get(client, bucket, key + '.idx').decode()
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+            raise
+        return size, None
+    return size, select_ranges(parse_idx(idx), rules, size)
+
+
+def download_file(executor, client, bucket, key, rules, dest_dir):
+    '''返回(路径, 下载字节数)；本地已有完整文件时下载字节数为0'''
+    path = os.path.join(dest_dir, os.path.basename(key))
+    size, ranges = plan_file(client, bucket, key, rules)
+    if ranges == []:
+        raise IOError(f"{key}: no message matches the Vtable")
+    expected_size = size if ranges is None else sum(end - start + 1 for start, end, _ in ranges)
+    expected_count = None if ranges is None else sum(count for _, _, count in ranges)
+    if os.path.exists(path) and os.path.getsize(path) == expected_size:
+        count = count_grib_messages(path)
+        if count is not None and count == (expected_count or count):
+            return path, 0
+
+    for attempt in range(1, ATTEMPTS + 1):
+        if ranges is None:
+            parts = [executor.submit(_get, client, bucket, key)]
+        else:
+            parts = [executor.submit(_get, client, bucket, key, (start, end)) for start, end, _ in ranges]
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            for part in parts:
+                f.write(part.result())
+        count = count_grib_messages(tmp_path)
+        if count is not None and count == (expected_count or count):
+            os.replace(tmp_path, path)
+            return path, expected_size
+        os.remove(tmp_path)
+        print(f"{key}: invalid GRIB2 ({count} messages, expected {expected_count}), attempt {attempt}")
+    raise IOError(f"{key}: downloaded file is not valid GRIB2")
+
+
+def download(cycle, hours, dest_dir, vtable, bucket=GFS_BUCKET, resolution='0p50', workers=32, client=None):
+    '''
+    并发下载一个预报周期各时效的GFS，Vtable为None时下载全部消息
+    返回 {'files': [路径], 'bytes': 下载字节数, 'failed': [(key, 错误)]}
+    '''
+    client = client or s3_client(workers)
+    rules = read_vtable(vtable) if vtable else [(None, None)]
+    os.makedirs(dest_dir, exist_ok=True)
+    keys = [gfs_key(cycle, hour, resolution) for hour in hours]
+    result = {'files': [], 'bytes': 0, 'failed': []}
+    # 区间请求和文件级任务分用两个线程池，文件任务等待区间结果时不会占满区间请求的线程
+    with ThreadPoolExecutor(max_workers=workers) as parts, \
+            ThreadPoolExecutor(max_workers=min(len(keys), workers) or 1) as files:
+        futures = [(key, files.submit(download_file, parts, client, bucket, key, rules, dest_dir)) for key in keys]
+        for key, future in futures:
+            try:
+                path, size = future.result()
+                result['files'].append(path)
+                result['bytes'] += size
+            except Exception as e:
+                result['failed'].append((key, str(e)))
+    return result
+
+
+def parse_hours(text):
+    '''first:last:step，含last'''
+    first, last, step = (int(v) for v in text.split(':'))
+    return list(range(first, last + 1, step))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="download the GRIB2 messages of a GFS cycle that Vtable uses")
+    parser.add_argument("cycle", help="GFS cycle, YYYYMMDDHH")
+    parser.add_argument("dest", help="local directory, file names are kept")
+    parser.add_argument("--vtable", help="only download the messages this Vtable uses, all of them without it")
+    parser.add_argument("--hours", default='0:96:3', help="forecast hours first:last:step")
+    parser.add_argument("--resolution", default='0p50')
+    parser.add_argument("--bucket", default=GFS_BUCKET)
+    parser.add_argument("--workers", type=int, default=32, help="concurrent range requests and S3 connections")
+    parser.add_argument("--endpoint-url", help="S3 endpoint, e.g. a local S3 stand-in")
+    parser.add_argument("--no-sign-request", action='store_true', help="anonymous access like aws s3 --no-sign-request")
+    args = parser.parse_args(argv)
+
+    started = time.time()
+    client = s3_client(args.workers, args.endpoint_url, args.no_sign_request)
+    result = download(datetime.strptime(args.cycle, '%Y%m%d%H'), parse_hours(args.hours), args.dest, args.vtable,
+                      args.bucket, args.resolution, args.workers, client)
+    print(f"downloaded {len(result['files'])} files ({result['bytes'] / MB:.1f} MB) in {time.time() - started:.1f}s, "
+          f"failed {len(result['failed'])}")
+    for key, error in result['failed']:
+        print(f"failed {key}: {error}", file=sys.stderr)
+    return 1 if result['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
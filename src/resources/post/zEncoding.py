@@ -0,0 +1,110 @@
+'''
+NetCDF4写出的编码配置
+压缩算法/级别、shuffle、分块形状和可选的float32或int16打包，按配置名统一生成
+分块沿id切分、time保持较长，与按风机读取全部时次的访问方式一致
+同一套配置既生成xarray.to_netcdf的encoding，也用于NetCDFAppender的createVariable
+'''
+import warnings
+
+import netCDF4
+import numpy as np
+
+# compression/complevel/shuffle 与netCDF4.createVariable的参数同名
+# dtype: 浮点变量写出类型，None为保持原类型；pack: 按数据范围打包为int16(有损，精度为范围/65534)
+NETCDF_PROFILES = {
+    'none': {},
+    'zlib': {'compression': 'zlib', 'complevel': 4, 'shuffle': True},
+    'zstd': {'compression': 'zstd', 'complevel': 3, 'shuffle': True},
+    'zlib_f32': {'compression': 'zlib', 'complevel': 4, 'shuffle': True, 'dtype': 'float32'},
+    'zstd_f32': {'compression': 'zstd', 'complevel': 3, 'shuffle': True, 'dtype': 'float32'},
+    'packed': {'compression': 'zlib', 'complevel': 4, 'shuffle': True, 'pack': True},
+}
+# 默认与原来的ds.to_netcdf(path)输出一致，压缩需通过--nc-profile显式选择
+DEFAULT_PROFILE = 'none'
+
+# 默认分块：time一次一天(15分钟间隔)，风机每块256个，其余维度整块
+TIME_CHUNK = 96
+ID_CHUNK = 256
+
+PACK_DTYPE = np.int16
+PACK_FILL = np.iinfo(PACK_DTYPE).min
+
+
+def get_profile(profile=DEFAULT_PROFILE):
+    '''返回配置字典的副本；当前netCDF库不支持zstd时退回zlib'''
+    if isinstance(profile, dict):
+        profile = dict(profile)
+    elif profile in NETCDF_PROFILES:
+        profile = dict(NETCDF_PROFILES[profile])
+    else:
+        raise ValueError(f"unknown netcdf profile {profile}, choose from {list(NETCDF_PROFILES)}")
+    if profile.get('compression') == 'zstd' and not getattr(netCDF4, '__has_zstandard_support__', False):
+        warnings.warn("netCDF4 is built without zstd support, falling back to zlib")
+        profile['compression'] = 'zlib'
+        profile['complevel'] = 4
+    return profile
+
+
+def chunk_shape(dims, shape, time_chunk=TIME_CHUNK, id_chunk=ID_CHUNK):
+    '''time和id维按给定大小分块(不超过实际长度)，其余维度整块'''
+    chunks = []
+    for dim, size in zip(dims, shape):
+        if dim == 'time':
+            chunks.append(max(1, min(time_chunk, size)) if size else time_chunk)
+        elif dim == 'id':
+            chunks.append(max(1, min(id_chunk, size)))
+        else:
+            chunks.append(max(1, size))
+    return tuple(chunks)
+
+
+def pack_params(values):
+    '''按数据范围计算int16打包的scale_factor和add_offset，全缺测或常数场返回None'''
+    values = np.asarray(values)
+    finite = np.isfinite(values)
+    if not finite.any():
+        return None
+    vmin, vmax = values[finite].min(), values[finite].max()
+    if vmax == vmin:
+        return None
+    # 留出一个值给_FillValue
+    n_steps = np.iinfo(PACK_DTYPE).max - np.iinfo(PACK_DTYPE).min - 1
+    return {'scale_factor': float(vmax - vmin) / n_steps, 'add_offset': float(vmax + vmin) / 2}
+
+
+def variable_encoding(dims, shape, dtype, profile=DEFAULT_PROFILE, values=None,
+                      time_chunk=TIME_CHUNK, id_chunk=ID_CHUNK):
+    '''单个变量的encoding，只有浮点变量做类型转换和打包'''
+    profile = get_profile(profile)
+    encoding = {}
+    if profile.get('compression'):
+        encoding.update(compression=profile['compression'], complevel=profile['complevel'],
+                        shuffle=profile.get('shuffle', True))
+        if dims:
+            encoding['chunksizes'] = chunk_shape(dims, shape, time_chunk, id_chunk)
+    if np.dtype(dtype).kind != 'f':
+        return encoding
+    if profile.get('pack') and values is not None:
+        params = pack_params(values)
+        if params is not None:
+            encoding.update(params, dtype=PACK_DTYPE, _FillValue=PACK_FILL)
+            return encoding
+    if profile.get('dtype') or profile.get('pack'):
+        encoding['dtype'] = np.dtype(profile.get('dtype') or 'float32')
+    return encoding
+
+
+def netcdf_encoding(ds, profile=DEFAULT_PROFILE, time_chunk=TIME_CHUNK, id_chunk=ID_CHUNK):
+    '''ds.to_netcdf(path, encoding=netcdf_encoding(ds, profile)) 所需的encoding，只作用于数据变量'''
+    profile = get_profile(profile)
+    encoding = {}
+    for name in ds.data_vars:
+        var = ds[name]
+        values = var.values if profile.get('pack') else None
+        encoding[name] = variable_encoding(var.dims, var.shape, var.dtype, profile, values, time_chunk, id_chunk)
+    return encoding
+
+
+def to_netcdf(ds, path, profile=DEFAULT_PROFILE, **kwargs):
+    '''按配置写出，profile为'none'时等价于原来的ds.to_netcdf(path)'''
+    ds.to_netcdf(path, engine='netcdf4', encoding=netcdf_encoding(ds, profile), **kwargs)
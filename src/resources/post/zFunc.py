@@ -1,10 +1,14 @@
 import subprocess as sp
+import json
 import pandas as pd
 import xarray as xr
 import numpy as np
 import wrf
 import os
+from concurrent.futures import ProcessPoolExecutor
 from zConfig import record_dir, date_now_str
+from zLog import get_logger, pool_context
+from zEncoding import DEFAULT_PROFILE, to_netcdf
 
 
 def run_cmd(cmd):
@@ -16,7 +20,7 @@ def clean_idx(data_dir):
 
 
 def export_log(msg, file_path):
-    run_cmd(f"echo '{msg}' >> {file_path}")
+    get_logger(file_path).log(msg)
 
 def load_WT_locat(locat_file):
     df_locat = pd.read_excel(locat_file)
@@ -33,14 +37,57 @@ def mkdir_dir_notexist(data_dir):
     else:
         print(f'{data_dir}已存在')
 
-def export_excel(ds, model_name, refdate, output_dir):
-    '''适用于EC、GFS、Pg、Merge'''
+def _to_excel(df_path):
+    df_output, output_path = df_path
+    df_output.to_excel(output_path)
+
+
+def export_excel(ds, model_name, refdate, output_dir, workers=1):
+    '''适用于EC、GFS、Pg、Merge；一次转成DataFrame后按风机拆分，workers > 1 时多进程写出'''
     data_vars = list(ds.data_vars)
-    for id in ds.id.values:
-        df_output = ds.sel(id=id).to_pandas()[data_vars]
-        output_name = f"{model_name}_{id}_{refdate}.xlsx"
-        output_path = os.path.join(output_dir, output_name)
-        df_output.to_excel(output_path)
+    df_all = ds[data_vars].to_dataframe(dim_order=['id', 'time'])[data_vars]
+    jobs = ((df_all.xs(id, level='id'), os.path.join(output_dir, f"{model_name}_{id}_{refdate}.xlsx"))
+            for id in ds.id.values)
+    if workers <= 1:
+        for job in jobs:
+            _to_excel(job)
+        return
+    with ProcessPoolExecutor(max_workers=workers, mp_context=pool_context()) as executor:
+        list(executor.map(_to_excel, jobs, chunksize=8))
+
+
+def export_parquet(ds_chunks, model_name, refdate, output_dir):
+    '''
+    列式导出：所有风机写入同一个Parquet文件，按(id, time)排序，每个风机块一个row group
+    lead_hour为相对第一个时次的小时数；ds_chunks可以是Dataset或按风机分块的Dataset迭代器
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if isinstance(ds_chunks, xr.Dataset):
+        ds_chunks = [ds_chunks]
+    output_path = os.path.join(output_dir, f"{model_name}_{refdate}.parquet")
+    writer = None
+    try:
+        for ds in ds_chunks:
+            df = ds.to_dataframe(dim_order=['id', 'time']).reset_index()
+            df.insert(2, 'lead_hour', (df['time'] - ds['time'].values[0]) / pd.Timedelta('1h'))
+            df['id'] = df['id'].astype(str)
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(output_path, table.schema, compression='zstd')
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+    return output_path
+
+def export_zarr(ds_chunks, model_name, refdate, output_dir):
+    '''按风机和时次分块的Zarr目录，仪表盘可以只读取单个风机，ds_chunks同export_parquet'''
+    from zZarr import write_zarr
+
+    output_path = os.path.join(output_dir, f"{model_name}_{refdate}.zarr")
+    return write_zarr(ds_chunks, output_path)
 
 def export_excel_mean(ds, model_name, refdate, output_dir):
     '''适用于EC、GFS、Pg、Merge'''
@@ -50,11 +97,11 @@ def export_excel_mean(ds, model_name, refdate, output_dir):
     output_path = os.path.join(output_dir, output_name)
     df_output.to_excel(output_path)
 
-def export_netcdf(ds, model_name, refdate, output_dir):
-    '''适用于EC、GFS、Pg、Merge'''
+def export_netcdf(ds, model_name, refdate, output_dir, profile=DEFAULT_PROFILE):
+    '''适用于EC、GFS、Pg、Merge，profile见zEncoding.NETCDF_PROFILES'''
     output_name = f"{model_name}_{refdate}.nc"
     output_path = os.path.join(output_dir, output_name)
-    ds.to_netcdf(output_path)
+    to_netcdf(ds, output_path, profile)
 
 def utc_to_bjt(ds):
     ds.coords['time'] = ds.coords['time'] + pd.Timedelta('8H')
@@ -66,10 +113,14 @@ def add_vars_leadhour(ds, leadhour, vars_leadhour):
         ds[var_new] = ds[var_leadhour] - ds[var_leadhour].shift(time=4 * leadhour)
     return ds
 
-def detect_files(file_path_list, model_name, all_files, min_valid_short, min_valid_mid, log_path, record_dir):
+def detect_files(file_path_list, model_name, all_files, min_valid_short, min_valid_mid, log_path, record_dir,
+                 file_exist_list=None):
+    '''file_exist_list已知(如来自wrfout清单)时不再逐个检查文件是否存在'''
     global date_now_str
 
-    file_path_exist_list = [os.path.exists(file_path) for file_path in file_path_list]
+    if file_exist_list is None:
+        file_exist_list = [os.path.exists(file_path) for file_path in file_path_list]
+    file_path_exist_list = list(file_exist_list)
     N_file_exist = file_path_exist_list.count(True)
     record_dict = {
         'model': model_name,
@@ -108,13 +159,20 @@ def detect_files(file_path_list, model_name, all_files, min_valid_short, min_val
 
 
 def record_exception(record_dict, record_dir):
+    '''
+    检测结果写入record_<date>.xlsx(每个模式一行，与原格式一致)
+    同时追加一行JSON到record_<date>.jsonl，保留每次检测的记录
+    '''
     global date_now_str
 
-    file_path = os.path.join(record_dir, f"record_{date_now_str}.xlsx")
     column_names = ['all', 'min_valid_short', 'min_valid_mid', 'exist', 'valid_short', 'valid_mid']
+    file_path = os.path.join(record_dir, f"record_{date_now_str}.xlsx")
     if not os.path.exists(file_path):
         df_empty = pd.DataFrame(None, index=['GFS', 'EC', 'Pg'], columns=column_names)
         df_empty.to_excel(file_path)
     df = pd.read_excel(file_path, index_col=0)
     df.loc[record_dict['model']] = [record_dict[column_name] for column_name in column_names]
-    df.to_excel(file_path)
\ No newline at end of file
+    df.to_excel(file_path)
+
+    with open(os.path.join(record_dir, f"record_{date_now_str}.jsonl"), 'a') as f:
+        f.write(json.dumps({column_name: record_dict[column_name] for column_name in ['model'] + column_names}) + '\n')
\ No newline at end of file
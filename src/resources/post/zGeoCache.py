@@ -0,0 +1,159 @@
+'''
+geogrid输出缓存
+geo_em只取决于namelist.wps中的区域设置、GEOGRID.TBL和静态地理数据，与预报日期无关
+以这些内容的哈希为键把geo_em保存到S3，之后的预报周期命中时直接下载，跳过geogrid.exe
+S3布局：<prefix>/<hash>/geo_em.d01.nc ...，<prefix>/<hash>/manifest.json最后写入，存在即表示缓存完整
+
+pre.sh中的用法(在preproc目录下)：
+python zGeoCache.py restore . s3://bucket/cache/geogrid || (./geogrid.exe && python zGeoCache.py save . s3://bucket/cache/geogrid)
+python zGeoCache.py key namelist.wps       # 只输出哈希
+'''
+import argparse
+import glob
+import hashlib
+import json
+import os
+import re
+import sys
+
+import boto3
+import botocore.exceptions
+
+from zUpload import parse_s3_url, upload
+
+MANIFEST_NAME = 'manifest.json'
+# &share中与日期有关、不影响geo_em的字段
+DATE_FIELDS = re.compile(r'^(start_|end_|interval_seconds$|debug_level$)')
+
+
+def read_namelist(path):
+    '''只解析 key = v1, v2, 形式的行，返回 {组名: {字段: [值字符串]}}'''
+    groups = {}
+    group = key = None
+    with open(path) as f:
+        for line in f:
+            line = line.split('!', 1)[0].strip()
+            if not line:
+                continue
+            if line.startswith('&'):
+                group = groups.setdefault(line[1:].strip().lower(), {})
+                key = None
+            elif line == '/':
+                group = key = None
+            elif group is not None:
+                match = re.match(r'(\w+)\s*=\s*(.*)$', line)
+                if match:
+                    key = match.group(1).lower()
+                    group[key] = []
+                    line = match.group(2)
+                if key is not None:
+                    group[key].extend(v.strip().strip('\'"') for v in line.split(',') if v.strip())
+    return groups
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def geog_version(geog_data_path):
+    '''静态地理数据的版本：GEOG_VERSION环境变量，没有时用数据目录的真实路径和各子目录的修改时间'''
+    if os.environ.get('GEOG_VERSION'):
+        return os.environ['GEOG_VERSION']
+    path = os.path.realpath(geog_data_path)
+    try:
+        entries = sorted((entry.name, int(entry.stat().st_mtime)) for entry in os.scandir(path))
+    except OSError:
+        entries = []
+    return [path, entries]
+
+
+def cache_key(namelist_path):
+    '''&share中除日期外的字段、&geogrid全部字段、GEOGRID.TBL内容和地理数据版本的sha256'''
+    namelist = read_namelist(namelist_path)
+    share = {k: v for k, v in namelist.get('share', {}).items() if not DATE_FIELDS.match(k)}
+    geogrid = namelist.get('geogrid', {})
+    base_dir = os.path.dirname(os.path.abspath(namelist_path))
+    tbl_dir = (geogrid.get('opt_geogrid_tbl_path') or ['./geogrid/'])[0]
+    tbl_path = os.path.join(base_dir, tbl_dir, 'GEOGRID.TBL')
+    content = {
+        'share': share,
+        'geogrid': geogrid,
+        'geogrid_tbl': file_sha256(tbl_path) if os.path.exists(tbl_path) else None,
+        'geog': geog_version((geogrid.get('geog_data_path') or [''])[0]),
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+def restore(preproc_dir, cache_url, key=None, client=None):
+    '''命中时把geo_em下载到preproc_dir并返回文件列表，未命中返回None'''
+    client = client or boto3.session.Session().client('s3')
+    key = key or cache_key(os.path.join(preproc_dir, 'namelist.wps'))
+    bucket, prefix = parse_s3_url(cache_url.rstrip('/') + f"/{key}/")
+    try:
+        manifest = json.loads(client.get_object(Bucket=bucket, Key=prefix + MANIFEST_NAME)['Body'].read())
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchKey':
+            raise
+        return None
+
+    restored = []
+    for name, size in sorted(manifest['files'].items()):
+        path = os.path.join(preproc_dir, name)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        client.download_file(bucket, prefix + name, tmp_path)
+        if os.path.getsize(tmp_path) != size:
+            actual = os.path.getsize(tmp_path)
+            os.remove(tmp_path)
+            raise IOError(f"{name} from the geogrid cache has {actual} bytes, expected {size}")
+        os.replace(tmp_path, path)
+        restored.append(path)
+    return restored
+
+
+def save(preproc_dir, cache_url, key=None, client=None):
+    '''上传geogrid刚生成的geo_em，全部成功后再写manifest'''
+    client = client or boto3.session.Session().client('s3')
+    key = key or cache_key(os.path.join(preproc_dir, 'namelist.wps'))
+    paths = sorted(glob.glob(os.path.join(preproc_dir, 'geo_em.d*')))
+    if not paths:
+        raise FileNotFoundError(f"no geo_em files in {preproc_dir}")
+    dest = cache_url.rstrip('/') + f"/{key}/"
+    result = upload(paths, dest, client=client)
+    if result['failed']:
+        raise IOError(f"uploading geo_em failed: {result['failed']}")
+    bucket, prefix = parse_s3_url(dest)
+    manifest = {'files': {os.path.basename(path): os.path.getsize(path) for path in paths}}
+    client.put_object(Bucket=bucket, Key=prefix + MANIFEST_NAME, Body=json.dumps(manifest).encode())
+    return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="cache geogrid output in S3 keyed by the namelist.wps domain settings")
+    parser.add_argument("command", choices=['key', 'restore', 'save'])
+    parser.add_argument("path", help="namelist.wps for key, the preproc directory otherwise")
+    parser.add_argument("cache_url", nargs='?', help="s3:// prefix of the cache")
+    args = parser.parse_args(argv)
+
+    if args.command == 'key':
+        print(cache_key(args.path))
+        return 0
+    if not args.cache_url:
+        parser.error(f"{args.command} needs the s3:// cache prefix")
+    if args.command == 'restore':
+        paths = restore(args.path, args.cache_url)
+        if paths is None:
+            print("geogrid cache miss")
+            return 1
+        print(f"restored {len(paths)} geo_em files from the geogrid cache")
+        return 0
+    paths = save(args.path, args.cache_url)
+    print(f"saved {len(paths)} geo_em files to the geogrid cache")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,214 @@
+'''
+插值权重
+水平：曲线网格(XLAT/XLONG) -> 风机点位的稀疏权重矩阵，与rcm2points相同的四角反距离平方权重
+权重只依赖网格和风机位置，按域缓存到磁盘，之后每个变量、层次、时刻都只是一次矩阵乘法
+垂直：z_agl上目标高度的上下层索引和线性权重每个文件只计算一次，所有三维变量共用
+'''
+import hashlib
+import os
+
+import numpy as np
+import xarray as xr
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+# 进程内缓存，key为网格+风机坐标的哈希
+_weights_cache = {}
+# 与格点重合的判断阈值(度)，与rcm2points相同
+EXACT_DEG = 1e-4
+
+
+def _lonlat_to_xyz(lons, lats):
+    lons_rad, lats_rad = np.deg2rad(lons), np.deg2rad(lats)
+    return np.stack([np.cos(lats_rad) * np.cos(lons_rad),
+                     np.cos(lats_rad) * np.sin(lons_rad),
+                     np.sin(lats_rad)], axis=-1)
+
+
+def _gcdist(lat1, lon1, lat2, lon2):
+    '''大圆距离(弧度)'''
+    lat1, lon1, lat2, lon2 = map(np.deg2rad, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def weights_key(source_lat2d, source_lon2d, target_lats, target_lons):
+    h = hashlib.sha1()
+    for array in (source_lat2d, source_lon2d, target_lats, target_lons):
+        array = np.ascontiguousarray(np.asarray(array, dtype=np.float64))
+        h.update(str(array.shape).encode())
+        h.update(array.tobytes())
+    return h.hexdigest()
+
+
+def build_interp_weights(source_lat2d, source_lon2d, target_lats, target_lons):
+    '''
+    构建 (n_turbines × n_gridcells) 稀疏权重矩阵
+    每个风机点找到所在网格单元，对四个角点按大圆距离做反距离平方加权；与格点重合(相差小于1e-4度)时直接取该格点
+    不在任何网格单元内的点为空行，插值结果为NaN，与rcm2points一致
+    '''
+    lat2d = np.asarray(source_lat2d, dtype=np.float64)
+    lon2d = np.asarray(source_lon2d, dtype=np.float64)
+    lats = np.asarray(target_lats, dtype=np.float64).ravel()
+    lons = np.asarray(target_lons, dtype=np.float64).ravel()
+    ny, nx = lat2d.shape
+
+    # 最近格点，所在单元必定是以它为角点的四个单元之一
+    tree = cKDTree(_lonlat_to_xyz(lon2d, lat2d).reshape(-1, 3))
+    _, nearest = tree.query(_lonlat_to_xyz(lons, lats))
+    iy0, ix0 = np.unravel_index(nearest, (ny, nx))
+
+    # 判断条件与rcm2points相同；四个单元都不包含的点在网格外，权重行留空，插值结果为NaN
+    iy = np.clip(iy0, 0, ny - 2)
+    ix = np.clip(ix0, 0, nx - 2)
+    found = np.zeros(lats.size, dtype=bool)
+    for dy, dx in [(0, 0), (-1, 0), (0, -1), (-1, -1)]:
+        cy = np.clip(iy0 + dy, 0, ny - 2)
+        cx = np.clip(ix0 + dx, 0, nx - 2)
+        inside = ((lons >= lon2d[cy, cx]) & (lons < lon2d[cy, cx + 1]) &
+                  (lats >= lat2d[cy, cx]) & (lats < lat2d[cy + 1, cx]) & ~found)
+        iy = np.where(inside, cy, iy)
+        ix = np.where(inside, cx, ix)
+        found |= inside
+
+    corner_y = np.stack([iy, iy, iy + 1, iy + 1], axis=1)
+    corner_x = np.stack([ix, ix + 1, ix, ix + 1], axis=1)
+    dist = _gcdist(lats[:, None], lons[:, None], lat2d[corner_y, corner_x], lon2d[corner_y, corner_x])
+
+    # 经纬度都与某个角点相差小于EXACT_DEG时直接取该角点，与rcm2points相同
+    exact = ((np.abs(lats[:, None] - lat2d[corner_y, corner_x]) < EXACT_DEG) &
+             (np.abs(lons[:, None] - lon2d[corner_y, corner_x]) < EXACT_DEG))
+    exact &= np.cumsum(exact, axis=1) == 1
+    with np.errstate(divide='ignore'):
+        w = np.where(exact.any(axis=1, keepdims=True), exact.astype(np.float64), 1.0 / dist ** 2)
+
+    # 与最近格点重合的点即使落在最后一行/列的边上也取该格点
+    on_grid = ((np.abs(lats - lat2d[iy0, ix0]) < EXACT_DEG) & (np.abs(lons - lon2d[iy0, ix0]) < EXACT_DEG))
+    snap = on_grid & ~exact.any(axis=1)
+    corner_y[snap, 0], corner_x[snap, 0] = iy0[snap], ix0[snap]
+    w[snap] = [1, 0, 0, 0]
+    w = np.where((found | on_grid)[:, None], w, 0)
+
+    rows = np.repeat(np.arange(lats.size), 4)
+    cols = np.ravel_multi_index((corner_y.ravel(), corner_x.ravel()), (ny, nx))
+    weights = sparse.csr_matrix((w.ravel(), (rows, cols)), shape=(lats.size, ny * nx))
+    weights.eliminate_zeros()
+    return weights
+
+
+def load_interp_weights(source_lat2d, source_lon2d, target_lats, target_lons, cache_dir=None):
+    '''优先从内存、其次从cache_dir读取权重，都没有时重新计算并写入缓存'''
+    key = weights_key(source_lat2d, source_lon2d, target_lats, target_lons)
+    if key in _weights_cache:
+        return _weights_cache[key]
+
+    cache_path = os.path.join(cache_dir, f"weights_{key}.npz") if cache_dir is not None else None
+    if cache_path is not None and os.path.exists(cache_path):
+        weights = sparse.load_npz(cache_path).tocsr()
+    else:
+        weights = build_interp_weights(source_lat2d, source_lon2d, target_lats, target_lons)
+        if cache_path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            # 先写临时文件再改名，避免多个后处理作业同时写同一个缓存
+            tmp_path = f"{cache_path}.{os.getpid()}.npz"
+            sparse.save_npz(tmp_path, weights)
+            os.replace(tmp_path, cache_path)
+    _weights_cache[key] = weights
+    return weights
+
+
+def apply_interp_weights(weights, data):
+    '''
+    data: (..., south_north, west_east) -> (..., n_turbines)
+    缺测(NaN)的角点不参与加权，四角全部缺测时结果为NaN，与rcm2points一致
+    '''
+    data = np.asarray(data)
+    lead_shape = data.shape[:-2]
+    flat = data.reshape(-1, data.shape[-2] * data.shape[-1]).T
+    valid = np.isfinite(flat)
+    if valid.all():
+        num = weights @ flat
+        den = weights @ np.ones((flat.shape[0], 1))
+    else:
+        num = weights @ np.where(valid, flat, 0)
+        den = weights @ valid.astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result = np.where(den > 0, num / den, np.nan)
+    return result.T.reshape(lead_shape + (weights.shape[0],))
+
+
+def interp2d_weights(da_input, weights, target_names, select_levels=None):
+    '''interp2d_wrfout的权重版本，输出维度与原函数相同'''
+    if 'level' in da_input.dims:
+        da_input = da_input.transpose('time', 'level', ...)
+        levels = da_input.level.values if select_levels is None else select_levels
+        result = apply_interp_weights(weights, da_input.values)
+        return xr.DataArray(result, dims=['time', 'level', 'id'], coords=[da_input.time, levels, target_names])
+    result = apply_interp_weights(weights, da_input.values)
+    return xr.DataArray(result, dims=['time', 'id'], coords=[da_input.time, target_names])
+
+
+def level_index_above(z_agl, target_height, axis=1):
+    '''所有时刻、所有格点都不低于target_height的最低模式层索引'''
+    z_agl = np.asarray(z_agl)
+    other_axes = tuple(i for i in range(z_agl.ndim) if i != axis % z_agl.ndim)
+    level_min = z_agl.min(axis=other_axes)
+    above = np.flatnonzero(level_min >= target_height)
+    if above.size == 0:
+        raise ValueError(f"no model level is above {target_height}m AGL")
+    return int(above[0])
+
+
+def vertical_weights(z_agl, target_levels):
+    '''
+    z_agl: (time, bottom_top, south_north, west_east)，随高度单调递增
+    返回下层索引k0 (time, level, south_north, west_east)、上层权重w和有效掩码
+    目标高度超出模式层范围时为缺测，与wrf.interplevel一致
+    '''
+    z_agl = np.asarray(z_agl)
+    levels = np.asarray(target_levels, dtype=z_agl.dtype).reshape(1, -1, 1, 1, 1)
+    nz = z_agl.shape[1]
+    # 小于目标高度的层数-1即为下层索引
+    k_below = (z_agl[:, None] < levels).sum(axis=2) - 1
+    valid = (k_below >= 0) & (k_below < nz - 1)
+    k0 = np.clip(k_below, 0, nz - 2)
+    z0 = np.take_along_axis(z_agl, k0, axis=1)
+    z1 = np.take_along_axis(z_agl, k0 + 1, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        w = (levels[:, :, 0] - z0) / (z1 - z0)
+    return k0, w, valid
+
+
+def apply_vertical_weights(vweights, data):
+    '''data: (..., time, bottom_top, south_north, west_east)，前置维度可以是变量维，一次完成插值'''
+    k0, w, valid = vweights
+    data = np.asarray(data)
+    lead = data.ndim - 4
+    k0 = np.broadcast_to(k0, data.shape[:lead] + k0.shape)
+    v0 = np.take_along_axis(data, k0, axis=lead + 1)
+    v1 = np.take_along_axis(data, k0 + 1, axis=lead + 1)
+    return np.where(valid, v0 + w * (v1 - v0), np.nan)
+
+
+def interplevel_vars(ds, z_agl, target_levels):
+    '''
+    对ds中所有含bottom_top的变量做高度插值，替代逐变量调用wrf.interplevel
+    返回 {变量名: DataArray(time, level, south_north, west_east)}
+    '''
+    dims = ('time', 'bottom_top', 'south_north', 'west_east')
+    var_names = [var_name for var_name in ds.data_vars if 'bottom_top' in ds[var_name].dims]
+    if not var_names:
+        return {}
+    vweights = vertical_weights(z_agl.transpose(*dims).values, target_levels)
+    stacked = np.stack([ds[var_name].transpose(*dims).values for var_name in var_names])
+    result = apply_vertical_weights(vweights, stacked)
+
+    var_interp_dict = {}
+    for var_name, data in zip(var_names, result):
+        da = ds[var_name]
+        var_interp_dict[var_name] = xr.DataArray(
+            data.astype(np.result_type(da.dtype, np.float32)),
+            dims=['time', 'level', 'south_north', 'west_east'],
+            coords={'time': da.time, 'level': np.asarray(target_levels)},
+            attrs=da.attrs)
+    return var_interp_dict
@@ -0,0 +1,182 @@
+'''
+后处理日志与阶段计时
+日志行在进程内缓冲后追加写入，不再为每一行启动/bin/sh
+每个阶段(detect/cut/interp/derive/export/upload)的墙钟时间、CPU时间和峰值内存以JSON lines写入
+与日志同目录的 *.timing.jsonl，随logs目录一起上传
+阶段峰值内存由后台线程在阶段内定时采样RSS得到；安装了psutil时同时采样子进程(进程池worker)
+'''
+import atexit
+import json
+import multiprocessing
+import os
+import resource
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+_loggers = {}
+MB = 1024 * 1024
+# RSS采样间隔(秒)
+SAMPLE_S = 0.2
+
+
+def timing_path(log_path):
+    return os.path.splitext(log_path)[0] + '.timing.jsonl'
+
+
+def _usage():
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        'cpu': self_usage.ru_utime + self_usage.ru_stime,
+        'children_cpu': children_usage.ru_utime + children_usage.ru_stime,
+        # ru_maxrss是进程启动以来的最高值，不是阶段内的峰值；Linux下单位为KB
+        'process_peak_rss_mb': self_usage.ru_maxrss / 1024,
+    }
+
+
+def _rss_mb():
+    '''返回(本进程RSS, 子进程RSS之和)，单位MB；没有psutil时读/proc/self/statm，子进程为None'''
+    if psutil is not None:
+        process = psutil.Process()
+        children = 0
+        for child in process.children(recursive=True):
+            try:
+                children += child.memory_info().rss
+            except psutil.Error:
+                pass
+        return process.memory_info().rss / MB, children / MB
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / MB, None
+    except (OSError, ValueError):
+        return None, None
+
+
+class RssSampler(threading.Thread):
+    '''阶段内每interval秒采样一次RSS，记录本进程和子进程各自的峰值'''
+    def __init__(self, interval=SAMPLE_S):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.peak = None
+        self.children_peak = None
+        self.sample()
+
+    def sample(self):
+        rss, children = _rss_mb()
+        if rss is not None:
+            self.peak = max(self.peak or 0, rss)
+        if children is not None:
+            self.children_peak = max(self.children_peak or 0, children)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.sample()
+
+
+def _round(value, digits=1):
+    return None if value is None else round(value, digits)
+
+
+class PostLogger:
+    def __init__(self, log_path, flush_lines=100):
+        self.log_path = log_path
+        self.timing_path = timing_path(log_path)
+        self.flush_lines = flush_lines
+        self.pid = os.getpid()
+        self.buffer = []
+
+    def _check_fork(self):
+        # 进程池fork出的子进程会继承父进程未写出的缓冲，丢弃以免重复写入
+        if os.getpid() != self.pid:
+            self.pid = os.getpid()
+            self.buffer = []
+
+    def log(self, msg):
+        self._check_fork()
+        self.buffer.append(f"{msg}\n")
+        if len(self.buffer) >= self.flush_lines:
+            self.flush()
+
+    def flush(self):
+        self._check_fork()
+        if not self.buffer:
+            return
+        os.makedirs(os.path.dirname(self.log_path) or '.', exist_ok=True)
+        with open(self.log_path, 'a') as f:
+            f.writelines(self.buffer)
+        self.buffer = []
+
+    def record(self, **fields):
+        '''写入一条结构化记录，一次write完成，多个进程同时追加也不会交错'''
+        fields.setdefault('host', socket.gethostname())
+        fields.setdefault('pid', os.getpid())
+        line = json.dumps(fields, ensure_ascii=False, default=str) + '\n'
+        os.makedirs(os.path.dirname(self.timing_path) or '.', exist_ok=True)
+        with open(self.timing_path, 'a') as f:
+            f.write(line)
+
+    @contextmanager
+    def stage(self, name, **fields):
+        start_time = datetime.now().isoformat(timespec='seconds')
+        start_wall = time.perf_counter()
+        start_usage = _usage()
+        sampler = RssSampler()
+        sampler.start()
+        status = 'ok'
+        try:
+            yield
+        except BaseException:
+            status = 'failed'
+            raise
+        finally:
+            sampler.stop()
+            end_usage = _usage()
+            wall = time.perf_counter() - start_wall
+            self.record(stage=name, status=status, start=start_time, wall_s=round(wall, 3),
+                        cpu_s=round(end_usage['cpu'] - start_usage['cpu'], 3),
+                        children_cpu_s=round(end_usage['children_cpu'] - start_usage['children_cpu'], 3),
+                        peak_rss_mb=_round(sampler.peak),
+                        children_peak_rss_mb=_round(sampler.children_peak),
+                        process_peak_rss_mb=round(end_usage['process_peak_rss_mb'], 1),
+                        **fields)
+            self.log(f"[{name}] {status} {wall:.2f}s")
+            self.flush()
+
+
+def get_logger(log_path):
+    if log_path not in _loggers:
+        _loggers[log_path] = PostLogger(log_path)
+    return _loggers[log_path]
+
+
+def pool_context():
+    '''
+    进程池的启动方式：阶段内有RSS采样线程在运行，fork出的子进程会继承线程持有的锁
+    改用forkserver，worker由不含采样线程的forkserver进程派生
+    '''
+    return multiprocessing.get_context('forkserver')
+
+
+def stage(name, log_path, **fields):
+    '''with stage('cut', log_path, file=...): ... 记录该阶段的耗时'''
+    return get_logger(log_path).stage(name, **fields)
+
+
+@atexit.register
+def flush_all():
+    for logger in _loggers.values():
+        logger.flush()
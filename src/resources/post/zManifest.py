@@ -0,0 +1,154 @@
+'''
+wrfout清单
+每个run目录维护一个wrfout_manifest.json，记录各wrfout的域、文件内的有效时间、大小、修改时间和是否写完
+更新时只扫描一次目录，大小和修改时间未变的文件直接沿用已有记录，只有新文件或变化的文件才读取Times
+后处理、job_monitor.sh和上传都从清单取文件，不再按日期拼文件名或反复ls/stat
+
+只依赖标准库(读取Times时才导入netCDF4，缺少时按文件名解析)，头节点上的系统python3也可以运行：
+python3 zManifest.py status /fsx/domain_1/run      # 输出 文件数 最新修改时间
+python3 zManifest.py list /fsx/domain_1/run --domain d02
+'''
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from datetime import datetime
+
+MANIFEST_NAME = 'wrfout_manifest.json'
+WRFOUT_PATTERN = re.compile(r'^wrfout_(d\d\d)_(\d{4}-\d\d-\d\d_\d\d:\d\d:\d\d)$')
+# 最新的文件在该时间内仍有修改时认为可能还在写出
+SETTLE_S = 120
+
+
+def manifest_path(run_dir):
+    return os.path.join(run_dir, MANIFEST_NAME)
+
+
+def load_manifest(run_dir):
+    try:
+        with open(manifest_path(run_dir)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'run_dir': run_dir, 'updated': None, 'files': {}}
+
+
+def save_manifest(run_dir, manifest):
+    '''先写临时文件再改名，监控脚本和后处理同时读写时不会读到写了一半的清单'''
+    path = manifest_path(run_dir)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def read_valid_times(path, name_time):
+    '''读取文件内的Times；文件无法打开时返回None，表示尚未写完或已损坏'''
+    try:
+        from netCDF4 import Dataset, chartostring
+    except ImportError:
+        return [name_time]
+    try:
+        with Dataset(path) as nc:
+            times = chartostring(nc['Times'][:])
+    except (OSError, IndexError, KeyError, RuntimeError):
+        return None
+    return [datetime.strptime(str(t), '%Y-%m-%d_%H:%M:%S').isoformat() for t in times]
+
+
+def update_manifest(run_dir, final=False, settle_s=SETTLE_S):
+    '''
+    增量更新清单并保存
+    complete：文件可读，且同域已有更晚的文件、或已settle_s秒未修改、或final(WRF作业已结束)
+    '''
+    manifest = load_manifest(run_dir)
+    old_files = manifest.get('files', {})
+    files = {}
+    now = time.time()
+    with os.scandir(run_dir) as entries:
+        for entry in entries:
+            match = WRFOUT_PATTERN.match(entry.name)
+            if match is None or not entry.is_file():
+                continue
+            stat = entry.stat()
+            old = old_files.get(entry.name)
+            if old is not None and old['size'] == stat.st_size and old['mtime'] == stat.st_mtime \
+                    and old['valid_times'] is not None:
+                record = dict(old)
+            else:
+                name_time = datetime.strptime(match.group(2), '%Y-%m-%d_%H:%M:%S').isoformat()
+                record = {'name': entry.name, 'domain': match.group(1), 'size': stat.st_size,
+                          'mtime': stat.st_mtime, 'valid_times': read_valid_times(entry.path, name_time)}
+            # 已判定完整且未再变化的文件保持完整
+            record['complete'] = record.get('complete', False) or (
+                record['valid_times'] is not None and (final or now - record['mtime'] > settle_s))
+            files[entry.name] = record
+
+    # 同域存在更晚的文件说明WRF已经开始写下一个文件
+    latest = {}
+    for record in files.values():
+        latest[record['domain']] = max(latest.get(record['domain'], ''), record['name'])
+    for record in files.values():
+        if record['valid_times'] is not None and record['name'] < latest[record['domain']]:
+            record['complete'] = True
+
+    manifest = {'run_dir': os.path.abspath(run_dir), 'updated': datetime.now().isoformat(timespec='seconds'),
+                'files': files}
+    save_manifest(run_dir, manifest)
+    return manifest
+
+
+def query_manifest(manifest, domain=None, complete=True, start=None, end=None):
+    '''按第一个有效时间排序返回记录；start/end为datetime或ISO字符串，end不含'''
+    start = start.isoformat() if hasattr(start, 'isoformat') else start
+    end = end.isoformat() if hasattr(end, 'isoformat') else end
+    records = []
+    for record in manifest['files'].values():
+        if domain is not None and record['domain'] != domain:
+            continue
+        if complete and not record['complete']:
+            continue
+        first_time = (record['valid_times'] or [''])[0]
+        if start is not None and first_time < start:
+            continue
+        if end is not None and first_time >= end:
+            continue
+        records.append(record)
+    return sorted(records, key=lambda record: ((record['valid_times'] or [''])[0], record['name']))
+
+
+def file_paths(run_dir, records):
+    return [os.path.join(run_dir, record['name']) for record in records]
+
+
+def status(manifest):
+    '''与job_monitor.sh原来的 ls | grep wrfout_d | wc -l 和最新文件的stat -c %Y 对应'''
+    records = list(manifest['files'].values())
+    latest_mtime = int(max(record['mtime'] for record in records)) if records else 0
+    return len(records), latest_mtime
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="incrementally maintained index of wrfout files in a run directory")
+    parser.add_argument("command", choices=['update', 'status', 'list'])
+    parser.add_argument("run_dir")
+    parser.add_argument("--final", action='store_true', help="the WRF job has finished, every readable file is complete")
+    parser.add_argument("--domain", help="only files of this domain, e.g. d02")
+    parser.add_argument("--all", action='store_true', help="list incomplete files too")
+    args = parser.parse_args(argv)
+
+    manifest = update_manifest(args.run_dir, final=args.final)
+    if args.command == 'status':
+        print('{} {}'.format(*status(manifest)))
+    elif args.command == 'list':
+        for path in file_paths(args.run_dir, query_manifest(manifest, args.domain, complete=not args.all)):
+            print(path)
+    else:
+        records = query_manifest(manifest, args.domain, complete=False)
+        print('{} files, {} complete'.format(len(records), sum(record['complete'] for record in records)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
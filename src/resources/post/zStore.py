@@ -0,0 +1,145 @@
+'''
+增量写出最终预报数据
+每个文件的ds_final产生后立即按time追加到NetCDF(time为unlimited维)，内存中只保留当前时次
+北京时转换、前N小时变化量和Excel导出都在磁盘结果上按风机分块进行，峰值内存不随预报时长和风机数增长
+'''
+import numpy as np
+import xarray as xr
+from netCDF4 import Dataset
+
+from zEncoding import DEFAULT_PROFILE, variable_encoding
+
+TIME_UNITS = 'minutes since 1970-01-01 00:00:00'
+EPOCH = np.datetime64('1970-01-01T00:00:00')
+
+
+def _encode(values):
+    '''把xarray的值转换为netCDF4可以直接写入的数组和属性'''
+    values = np.asarray(values)
+    if np.issubdtype(values.dtype, np.datetime64):
+        return (values - EPOCH) / np.timedelta64(1, 'm'), {'units': TIME_UNITS, 'calendar': 'proleptic_gregorian'}
+    if np.issubdtype(values.dtype, np.timedelta64):
+        return values / np.timedelta64(1, 'm'), {'units': 'minutes'}
+    if values.dtype.kind in 'OU':
+        return values.astype(str).astype(object), {}
+    return values, {}
+
+
+def _nc_attrs(attrs):
+    return {key: value for key, value in attrs.items()
+            if isinstance(value, (str, int, float, np.number, np.ndarray, list, tuple))}
+
+
+class NetCDFAppender:
+    '''
+    按time维追加写出Dataset，第一次append时根据ds建立文件结构
+    不含time维的变量(id、level等坐标)只在第一次写出
+    数据变量按profile压缩分块；数据范围事先未知，packed配置在这里按float32写出
+    '''
+
+    def __init__(self, path, time_dim='time', profile=DEFAULT_PROFILE):
+        self.path = path
+        self.time_dim = time_dim
+        self.profile = profile
+        self.nc = None
+        self.n_times = 0
+
+    def _create(self, ds):
+        self.nc = Dataset(self.path, 'w', format='NETCDF4')
+        for dim, size in ds.sizes.items():
+            self.nc.createDimension(dim, None if dim == self.time_dim else size)
+        for name, var in ds.variables.items():
+            values, enc_attrs = _encode(var.values)
+            datatype = str if values.dtype == object else values.dtype
+            options = {}
+            if name in ds.data_vars and values.dtype != object:
+                # time为unlimited维，按长度0计算分块即取默认的time分块大小
+                shape = [0 if dim == self.time_dim else size for dim, size in zip(var.dims, var.shape)]
+                options = variable_encoding(var.dims, shape, values.dtype, self.profile)
+                datatype = options.pop('dtype', datatype)
+            nc_var = self.nc.createVariable(name, datatype, var.dims, **options)
+            attrs = _nc_attrs(var.attrs)
+            attrs.update(enc_attrs)
+            if name in ds.data_vars:
+                # 让xarray读回时能识别非维度坐标(如各风机的level)
+                coords = [coord for coord in ds[name].coords if coord not in ds[name].dims]
+                if coords:
+                    attrs['coordinates'] = ' '.join(coords)
+            nc_var.setncatts(attrs)
+            if self.time_dim not in var.dims:
+                nc_var[...] = values
+
+    def append(self, ds):
+        if self.nc is None:
+            self._create(ds)
+        n_new = ds.sizes[self.time_dim]
+        for name, var in ds.variables.items():
+            if self.time_dim not in var.dims:
+                continue
+            values, _ = _encode(var.values)
+            index = tuple(slice(self.n_times, self.n_times + n_new) if dim == self.time_dim else slice(None)
+                          for dim in var.dims)
+            self.nc[name][index] = values
+        self.n_times += n_new
+
+    def close(self):
+        if self.nc is not None:
+            self.nc.close()
+            self.nc = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _copy_filters(var):
+    '''新变量沿用原变量的压缩设置'''
+    filters = var.filters() or {}
+    compression = next((name for name in ('zstd', 'zlib') if filters.get(name)), None)
+    if compression is None:
+        return {}
+    return {'compression': compression, 'complevel': filters['complevel'], 'shuffle': filters['shuffle']}
+
+
+def shift_time_ondisk(path, hours, time_name='time'):
+    '''等价于utc_to_bjt，直接修改磁盘上的时间坐标'''
+    with Dataset(path, 'a') as nc:
+        nc[time_name][:] = nc[time_name][:] + hours * 60
+
+
+def add_vars_leadhour_ondisk(path, leadhour, vars_leadhour, chunk_size=1000, time_dim='time', id_dim='id'):
+    '''等价于add_vars_leadhour，按风机分块读入并写出新变量'''
+    with Dataset(path, 'a') as nc:
+        n_ids = len(nc.dimensions[id_dim])
+        for var_leadhour in vars_leadhour:
+            var = nc[var_leadhour]
+            chunking = var.chunking()
+            var_new = nc.createVariable(f"{var_leadhour}_-{leadhour}h", np.result_type(var.dtype, np.float32),
+                                        var.dimensions, chunksizes=None if chunking == 'contiguous' else chunking,
+                                        **_copy_filters(var))
+            if 'coordinates' in var.ncattrs():
+                var_new.coordinates = var.coordinates
+            time_axis = var.dimensions.index(time_dim)
+            id_axis = var.dimensions.index(id_dim)
+            for start in range(0, n_ids, chunk_size):
+                index = [slice(None)] * var.ndim
+                index[id_axis] = slice(start, min(start + chunk_size, n_ids))
+                index = tuple(index)
+                data = np.ma.filled(var[index], np.nan).astype(var_new.dtype)
+                shifted = np.full_like(data, np.nan)
+                shift = 4 * leadhour
+                src = [slice(None)] * data.ndim
+                dst = [slice(None)] * data.ndim
+                src[time_axis] = slice(None, -shift if shift else None)
+                dst[time_axis] = slice(shift, None)
+                shifted[tuple(dst)] = data[tuple(src)]
+                var_new[index] = data - shifted
+
+
+def iter_id_chunks(path, chunk_size=1000, id_dim='id'):
+    '''按风机分块读取磁盘结果，用于导出Excel等逐风机操作'''
+    with xr.open_dataset(path) as ds:
+        for start in range(0, ds.sizes[id_dim], chunk_size):
+            yield ds.isel({id_dim: slice(start, start + chunk_size)}).load()
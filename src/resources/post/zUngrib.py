@@ -0,0 +1,183 @@
+'''
+按时间窗并行的ungrib
+ungrib.exe是串行程序，按顺序处理f000-f096的全部GRIB文件
+这里把namelist.wps中start_date到end_date的时次分成N个时间窗，每个时间窗一个工作目录和临时namelist.wps，
+只链接有效时间落在窗内的GRIB文件，N个ungrib.exe同时运行，全部成功后把FILE:*移到当前目录供metgrid使用
+任何一个时间窗失败时不移动任何文件并返回非0，调用方改为串行运行ungrib.exe
+
+在link_grib.csh之后，于ungrib目录下运行：
+python zUngrib.py . --workers 12
+'''
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from zGeoCache import read_namelist
+
+DATE_FORMAT = '%Y-%m-%d_%H:%M:%S'
+WORK_DIR = 'ungrib_windows'
+# gfs.t00z.pgrb2.0p50.f003 中的预报时效
+FORECAST_HOUR = re.compile(r'\.f(\d{2,3})$')
+
+
+def time_steps(namelist):
+    '''d01的start_date到end_date(含)之间每interval_seconds一个时次'''
+    share = namelist['share']
+    start = datetime.strptime(share['start_date'][0], DATE_FORMAT)
+    end = datetime.strptime(share['end_date'][0], DATE_FORMAT)
+    interval = timedelta(seconds=int(share['interval_seconds'][0]))
+    steps = []
+    while start <= end:
+        steps.append(start)
+        start += interval
+    return steps
+
+
+def split_windows(steps, n):
+    '''把时次按顺序分成至多n段，各段时次数相差不超过1'''
+    n = max(1, min(n, len(steps)))
+    size, extra = divmod(len(steps), n)
+    windows = []
+    begin = 0
+    for i in range(n):
+        end = begin + size + (i < extra)
+        windows.append(steps[begin:end])
+        begin = end
+    return windows
+
+
+def grib_valid_time(path):
+    '''GRIB2第1段的参考时间加文件名中的预报时效；无法判断时返回None'''
+    match = FORECAST_HOUR.search(os.path.basename(os.path.realpath(path)))
+    if match is None:
+        return None
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(35)
+    except OSError:
+        return None
+    if len(head) < 35 or head[:4] != b'GRIB' or head[7] != 2:
+        return None
+    year = int.from_bytes(head[28:30], 'big')
+    reference = datetime(year, head[30], head[31], head[32], head[33], head[34])
+    return reference + timedelta(hours=int(match.group(1)))
+
+
+def gribfile_name(i):
+    '''link_grib.csh的命名：GRIBFILE.AAA, GRIBFILE.AAB, ...'''
+    letters = ''
+    for _ in range(3):
+        i, r = divmod(i, 26)
+        letters = chr(ord('A') + r) + letters
+    return 'GRIBFILE.' + letters
+
+
+def window_namelist(text, window):
+    '''把&share中的start_date/end_date换成时间窗的首末时次，保持每行的值个数'''
+    def replace(match, date):
+        count = max(1, match.group(2).count(',') + (not match.group(2).rstrip().endswith(',')))
+        return match.group(1) + ' '.join(f"'{date}'," for _ in range(count))
+    text = re.sub(r'(?im)^(\s*start_date\s*=\s*)(.*)$',
+                  lambda m: replace(m, window[0].strftime(DATE_FORMAT)), text)
+    return re.sub(r'(?im)^(\s*end_date\s*=\s*)(.*)$',
+                  lambda m: replace(m, window[-1].strftime(DATE_FORMAT)), text)
+
+
+def prepare_window(ungrib_dir, work_dir, window, gribfiles, namelist_text):
+    '''建立时间窗的工作目录：临时namelist.wps，链接ungrib.exe、Vtable和窗内的GRIB文件'''
+    os.makedirs(work_dir)
+    with open(os.path.join(work_dir, 'namelist.wps'), 'w') as f:
+        f.write(window_namelist(namelist_text, window))
+    for name in ('ungrib.exe', 'Vtable'):
+        os.symlink(os.path.realpath(os.path.join(ungrib_dir, name)), os.path.join(work_dir, name))
+    first, last = window[0], window[-1]
+    selected = [path for path, valid_time in gribfiles if valid_time is None or first <= valid_time <= last]
+    for i, path in enumerate(selected):
+        os.symlink(path, os.path.join(work_dir, gribfile_name(i)))
+    return len(selected)
+
+
+def run_window(work_dir):
+    with open(os.path.join(work_dir, 'ungrib.out'), 'w') as out:
+        return subprocess.run(['./ungrib.exe'], cwd=work_dir, stdout=out, stderr=subprocess.STDOUT).returncode
+
+
+def parallel_ungrib(ungrib_dir='.', workers=None):
+    '''
+    运行各时间窗的ungrib.exe，全部成功且每个时次都有中间文件时移到ungrib_dir，返回移动的文件列表
+    失败时抛出RuntimeError，ungrib_dir中的文件保持不变
+    '''
+    workers = workers or len(os.sched_getaffinity(0))
+    namelist_path = os.path.join(ungrib_dir, 'namelist.wps')
+    namelist = read_namelist(namelist_path)
+    with open(namelist_path) as f:
+        namelist_text = f.read()
+    prefix = (namelist.get('ungrib', {}).get('prefix') or ['FILE'])[0]
+    steps = time_steps(namelist)
+    windows = split_windows(steps, workers)
+
+    gribfiles = []
+    i = 0
+    while os.path.lexists(os.path.join(ungrib_dir, gribfile_name(i))):
+        path = os.path.realpath(os.path.join(ungrib_dir, gribfile_name(i)))
+        gribfiles.append((path, grib_valid_time(path)))
+        i += 1
+    if not gribfiles:
+        raise RuntimeError(f"no GRIBFILE.* links in {ungrib_dir}, run link_grib.csh first")
+
+    root = os.path.join(ungrib_dir, WORK_DIR)
+    shutil.rmtree(root, ignore_errors=True)
+    work_dirs = [os.path.join(root, f"w{n:02d}") for n in range(len(windows))]
+    for work_dir, window in zip(work_dirs, windows):
+        if prepare_window(ungrib_dir, work_dir, window, gribfiles, namelist_text) == 0:
+            raise RuntimeError(f"no GRIB file is valid in {window[0]} - {window[-1]}")
+
+    print(f"{len(steps)} time steps in {len(windows)} windows")
+    with ThreadPoolExecutor(max_workers=len(windows)) as executor:
+        codes = list(executor.map(run_window, work_dirs))
+    for work_dir, window, code in zip(work_dirs, windows, codes):
+        with open(os.path.join(work_dir, 'ungrib.out')) as f:
+            print(f"==== {os.path.basename(work_dir)}: {window[0]} - {window[-1]}, exit {code}")
+            print(f.read(), end='')
+    failed = [os.path.basename(work_dir) for work_dir, code in zip(work_dirs, codes) if code != 0]
+    if failed:
+        raise RuntimeError(f"ungrib.exe failed in {failed}")
+
+    outputs = []
+    for work_dir, window in zip(work_dirs, windows):
+        for step in window:
+            path = os.path.join(work_dir, f"{prefix}:{step.strftime('%Y-%m-%d_%H')}")
+            if not os.path.exists(path):
+                raise RuntimeError(f"{os.path.basename(path)} missing in {os.path.basename(work_dir)}")
+            outputs.append(path)
+    moved = []
+    for path in outputs:
+        dest = os.path.join(ungrib_dir, os.path.basename(path))
+        os.replace(path, dest)
+        moved.append(dest)
+    shutil.rmtree(root, ignore_errors=True)
+    return moved
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="run ungrib.exe concurrently over time windows of namelist.wps")
+    parser.add_argument("ungrib_dir", nargs='?', default='.', help="directory with namelist.wps, Vtable and GRIBFILE.*")
+    parser.add_argument("--workers", type=int, help="number of windows, defaults to the usable cores")
+    args = parser.parse_args(argv)
+
+    try:
+        moved = parallel_ungrib(args.ungrib_dir, args.workers)
+    except RuntimeError as e:
+        print(e)
+        return 1
+    print(f"{len(moved)} intermediate files merged into {os.path.abspath(args.ungrib_dir)}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
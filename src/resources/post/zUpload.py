@@ -0,0 +1,159 @@
+'''
+并发上传到S3
+所有文件共用一个boto3传输管理器(一个线程池)，大文件自动分片上传
+目标位置已有大小和ETag都相同的对象时跳过，重跑作业不会重复上传
+命令行用法与aws s3 cp类似，最后一个参数为目标：
+python zUpload.py slurm-123.out preproc/ s3://bucket/outputs/20230914/domain_1/logs/ --include "*.log"
+python zUpload.py s3://bucket/outputs/20230914/domain_1/wrfout/ --manifest /fsx/domain_1/run
+'''
+import argparse
+import fnmatch
+import hashlib
+import os
+import sys
+
+import boto3
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
+
+MB = 1024 * 1024
+# 与aws cli默认值一致，保证分片ETag可以在本地复算
+MULTIPART_THRESHOLD = 8 * MB
+MULTIPART_CHUNKSIZE = 8 * MB
+
+
+def parse_s3_url(url):
+    if not url.startswith('s3://'):
+        raise ValueError(f"{url} is not an s3:// url")
+    bucket, _, key = url[len('s3://'):].partition('/')
+    return bucket, key
+
+
+def local_etag(path, threshold=MULTIPART_THRESHOLD, chunksize=MULTIPART_CHUNKSIZE):
+    '''按S3的规则计算本地文件ETag：单片为md5，分片为各片md5拼接后的md5加"-片数"'''
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        if size < threshold:
+            return hashlib.md5(f.read()).hexdigest()
+        digests = []
+        for chunk in iter(lambda: f.read(chunksize), b''):
+            digests.append(hashlib.md5(chunk).digest())
+    return f"{hashlib.md5(b''.join(digests)).hexdigest()}-{len(digests)}"
+
+
+def _match(rel_path, include, exclude):
+    name = os.path.basename(rel_path)
+    def matched(patterns):
+        return any(fnmatch.fnmatch(rel_path, p) or fnmatch.fnmatch(name, p) for p in patterns)
+    if include and not matched(include):
+        return False
+    return not (exclude and matched(exclude))
+
+
+def collect_files(sources, dest, include=None, exclude=None):
+    '''
+    展开本地源文件：目录递归上传，key为相对目录的路径；单个文件上传到dest/文件名(dest以/结尾时)或dest本身
+    返回 [(本地路径, bucket, key)]
+    '''
+    bucket, prefix = parse_s3_url(dest)
+    files = []
+    for source in sources:
+        if os.path.isdir(source):
+            for root, _, names in os.walk(source):
+                for name in sorted(names):
+                    path = os.path.join(root, name)
+                    rel_path = os.path.relpath(path, source).replace(os.sep, '/')
+                    if _match(rel_path, include, exclude):
+                        files.append((path, bucket, prefix.rstrip('/') + '/' + rel_path if prefix else rel_path))
+        elif os.path.isfile(source):
+            if not _match(os.path.basename(source), include, exclude):
+                continue
+            if not prefix or prefix.endswith('/') or len(sources) > 1:
+                key = prefix.rstrip('/') + '/' + os.path.basename(source) if prefix else os.path.basename(source)
+            else:
+                key = prefix
+            files.append((source, bucket, key))
+        else:
+            print(f"{source} not found, skipped", file=sys.stderr)
+    return files
+
+
+def list_remote(client, bucket, prefix):
+    '''一次list拿到目标前缀下所有对象的大小和ETag，替代逐个HEAD'''
+    objects = {}
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            objects[obj['Key']] = (obj['Size'], obj['ETag'].strip('"'))
+    return objects
+
+
+def upload_many(pairs, include=None, exclude=None, workers=16, skip_existing=True, client=None):
+    '''
+    pairs: [(本地源列表, s3目标前缀)]，所有文件提交到同一个传输管理器
+    返回 {'uploaded': 个数, 'skipped': 个数, 'bytes': 上传字节数, 'failed': [(路径, 错误)]}
+    '''
+    client = client or boto3.session.Session().client('s3')
+    config = TransferConfig(max_concurrency=workers, multipart_threshold=MULTIPART_THRESHOLD,
+                            multipart_chunksize=MULTIPART_CHUNKSIZE)
+    result = {'uploaded': 0, 'skipped': 0, 'bytes': 0, 'failed': []}
+
+    files = []
+    for sources, dest in pairs:
+        files.extend(collect_files(sources, dest, include, exclude))
+
+    remote = {}
+    if skip_existing:
+        for bucket, prefix in sorted({parse_s3_url(dest) for _, dest in pairs}):
+            for key, value in list_remote(client, bucket, prefix).items():
+                remote[(bucket, key)] = value
+
+    futures = []
+    with create_transfer_manager(client, config) as manager:
+        for path, bucket, key in files:
+            size = os.path.getsize(path)
+            existing = remote.get((bucket, key))
+            if existing is not None and existing[0] == size and existing[1] == local_etag(path):
+                result['skipped'] += 1
+                continue
+            futures.append((path, size, manager.upload(path, bucket, key)))
+        for path, size, future in futures:
+            try:
+                future.result()
+                result['uploaded'] += 1
+                result['bytes'] += size
+            except Exception as e:
+                result['failed'].append((path, str(e)))
+    return result
+
+
+def upload(sources, dest, **kwargs):
+    return upload_many([(sources, dest)], **kwargs)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="concurrent upload of files and directories to S3")
+    parser.add_argument("paths", nargs='+', help="local files or directories followed by the s3:// destination")
+    parser.add_argument("--include", action='append', default=[], help="only upload files matching this glob")
+    parser.add_argument("--exclude", action='append', default=[], help="skip files matching this glob")
+    parser.add_argument("--workers", type=int, default=16, help="transfer threads shared by all files")
+    parser.add_argument("--no-skip", action='store_true', help="upload even if an identical object exists")
+    parser.add_argument("--manifest", help="also upload the complete wrfout files indexed in this run directory")
+    args = parser.parse_args(argv)
+    sources = args.paths[:-1]
+    if args.manifest:
+        from zManifest import update_manifest, query_manifest, file_paths
+        sources += file_paths(args.manifest, query_manifest(update_manifest(args.manifest)))
+    if not sources:
+        parser.error("need at least one source (or --manifest) and a destination")
+
+    result = upload(sources, args.paths[-1], include=args.include, exclude=args.exclude,
+                    workers=args.workers, skip_existing=not args.no_skip)
+    print(f"uploaded {result['uploaded']} ({result['bytes'] / MB:.1f} MB), skipped {result['skipped']}, "
+          f"failed {len(result['failed'])}")
+    for path, error in result['failed']:
+        print(f"failed {path}: {error}", file=sys.stderr)
+    return 1 if result['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
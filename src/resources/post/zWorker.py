@@ -0,0 +1,307 @@
+'''
+常驻后处理进程
+在头节点上常驻，pandas/xarray/wrf-python/geocat等只导入一次，插值权重预先载入内存，
+进程池子进程由fork产生，直接继承这些模块和权重
+作业通过/fsx上的spool目录提交：incoming -> running -> done，用改名实现原子提交和认领
+
+启动(重复启动时已有进程持有锁，直接退出，可以放在cron中保活)，同时处理的域数和每个域的进程数默认按本机CPU数确定：
+python zWorker.py serve --spool /fsx/post-spool --preload /fsx/domain_1 /fsx/domain_2
+每个域的post作业只占一个CPU，提交后等待结果并以作业的退出码退出，slurm和job_monitor.sh据此判断成败和重试
+(参数与process_gfs.py相同)；没有存活的常驻进程时在本地直接运行process_gfs：
+python zWorker.py submit --spool /fsx/post-spool --id post_domain_1_2023091400 -- /fsx/domain_1 s3://bucket/outputs/20230914/domain_1 --stream
+进程池的子进程被杀(如内存不足)时重建进程池，池中的作业重新排队
+'''
+import argparse
+import contextlib
+import fcntl
+import glob
+import json
+import os
+import sys
+import time
+import traceback
+import uuid
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+
+# 超过该时间未更新心跳认为常驻进程已退出
+HEARTBEAT_STALE_S = 60
+# cron每2分钟拉起常驻进程，wait在常驻进程退出超过该时间后才放弃
+WORKER_GONE_S = 600
+# 每个作业进程至少使用的CPU数
+CPUS_PER_JOB = 4
+# 进程池损坏时池中的作业重新排队的次数，与job_monitor.sh的MAX_RETRY_NUM一致；作业本身失败时由job_monitor.sh重试post作业
+MAX_RETRY_NUM = 1
+
+
+def spool_dirs(spool):
+    dirs = {name: os.path.join(spool, name) for name in ['incoming', 'running', 'done']}
+    for path in dirs.values():
+        os.makedirs(path, exist_ok=True)
+    return dirs
+
+
+def heartbeat_path(spool):
+    return os.path.join(spool, 'worker.heartbeat')
+
+
+def worker_alive(spool, stale_s=HEARTBEAT_STALE_S):
+    try:
+        return time.time() - os.path.getmtime(heartbeat_path(spool)) < stale_s
+    except OSError:
+        return False
+
+
+def write_json(path, content):
+    '''先写临时文件再改名，读取方不会看到写了一半的文件'''
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(content, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def set_date(date_str):
+    '''process_gfs及其依赖在导入时固定了date_now_str，常驻进程按作业提交时的日期刷新'''
+    import zConfig
+    import zFunc
+    import process_gfs
+    for module in (zConfig, zFunc, process_gfs):
+        module.date_now_str = date_str
+
+
+def host_sizing(cpus=None):
+    '''按本机CPU数返回(同时处理的域数, 每个域的--workers)'''
+    cpus = cpus or len(os.sched_getaffinity(0))
+    jobs = max(1, cpus // CPUS_PER_JOB)
+    return jobs, max(1, cpus // jobs)
+
+
+def call_main(argv):
+    '''运行process_gfs.main并返回其退出码'''
+    import process_gfs
+    try:
+        code = process_gfs.main(argv)
+        return code if isinstance(code, int) else 0
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else 1
+    except Exception:
+        traceback.print_exc()
+        return 1
+
+
+def run_job(job, log_path):
+    '''在进程池子进程中执行一个作业，输出写入log_path，返回退出码'''
+    from zLog import flush_all
+
+    set_date(job['date'])
+    with open(log_path, 'a') as log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        try:
+            return call_main(job['argv'])
+        finally:
+            flush_all()
+
+
+def preload_weights(prefixes):
+    '''把各域缓存的插值权重读入zInterp的进程内缓存，fork出的子进程直接使用'''
+    from scipy import sparse
+    import zInterp
+    from zConfig import weights_dir
+
+    n_loaded = 0
+    for prefix in prefixes:
+        for path in glob.glob(os.path.join(weights_dir(prefix), 'weights_*.npz')):
+            key = os.path.basename(path)[len('weights_'):-len('.npz')]
+            zInterp._weights_cache[key] = sparse.load_npz(path).tocsr()
+            n_loaded += 1
+    return n_loaded
+
+
+def serve(spool, jobs=None, job_workers=None, preload=(), poll_s=1.0):
+    default_jobs, default_workers = host_sizing()
+    jobs = jobs or default_jobs
+    job_workers = job_workers or max(1, default_workers * default_jobs // jobs)
+    dirs = spool_dirs(spool)
+    lock = open(os.path.join(spool, 'worker.lock'), 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        print(f"another worker is serving {spool}")
+        return 0
+
+    # 重量级导入放在fork之前完成
+    import process_gfs  # noqa: F401
+    print(f"{datetime.now().isoformat(timespec='seconds')} loaded {preload_weights(preload)} weight matrices, "
+          f"{jobs} jobs with {job_workers} workers each")
+
+    # 上次异常退出时未完成的作业重新排队
+    for path in glob.glob(os.path.join(dirs['running'], '*.json')):
+        os.replace(path, os.path.join(dirs['incoming'], os.path.basename(path)))
+
+    # 子进程被杀后进程池不再可用，由主循环重建
+    broken = threading.Event()
+
+    def requeue(job_id, job):
+        '''进程池损坏时把作业放回incoming，超过MAX_RETRY_NUM次时按失败处理'''
+        if job.get('retry', 0) >= MAX_RETRY_NUM:
+            return False
+        write_json(os.path.join(dirs['incoming'], f"{job_id}.json"), dict(job, retry=job.get('retry', 0) + 1))
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(os.path.join(dirs['running'], f"{job_id}.json"))
+        print(f"{datetime.now().isoformat(timespec='seconds')} {job_id} lost with the process pool, requeued")
+        return True
+
+    def finish(job_id, job, started, future):
+        try:
+            returncode = future.result()
+            error = None
+        except BrokenProcessPool as e:
+            broken.set()
+            if requeue(job_id, job):
+                return
+            returncode, error = 1, repr(e)
+        except Exception as e:
+            returncode, error = 1, repr(e)
+        write_json(os.path.join(dirs['done'], f"{job_id}.json"),
+                   dict(job, returncode=returncode, error=error, started=started,
+                        finished=datetime.now().isoformat(timespec='seconds')))
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(os.path.join(dirs['running'], f"{job_id}.json"))
+        print(f"{datetime.now().isoformat(timespec='seconds')} {job_id} finished with {returncode}")
+
+    executor = ProcessPoolExecutor(max_workers=jobs)
+    try:
+        while True:
+            if broken.is_set():
+                print(f"{datetime.now().isoformat(timespec='seconds')} process pool broken, restarting it")
+                broken.clear()
+                executor.shutdown(wait=False, cancel_futures=True)
+                executor = ProcessPoolExecutor(max_workers=jobs)
+            with open(heartbeat_path(spool), 'w') as f:
+                f.write(str(os.getpid()))
+            for path in sorted(glob.glob(os.path.join(dirs['incoming'], '*.json')), key=os.path.getmtime):
+                job_id = os.path.basename(path)[:-len('.json')]
+                running_path = os.path.join(dirs['running'], f"{job_id}.json")
+                try:
+                    os.replace(path, running_path)
+                except FileNotFoundError:
+                    continue
+                with open(running_path) as f:
+                    job = json.load(f)
+                # 命令行中后出现的--workers生效，同时运行的作业共享头节点的CPU
+                argv = job['argv'] + ['--workers', str(job_workers)]
+                started = datetime.now().isoformat(timespec='seconds')
+                try:
+                    future = executor.submit(run_job, dict(job, argv=argv),
+                                             os.path.join(dirs['done'], f"{job_id}.log"))
+                except BrokenProcessPool:
+                    # 进程池已损坏但回调还没有处理完，作业原样放回，重建后再取
+                    os.replace(running_path, path)
+                    broken.set()
+                    break
+                print(f"{started} {job_id} started: {' '.join(argv)}")
+                future.add_done_callback(lambda future, job_id=job_id, job=job, started=started:
+                                         finish(job_id, job, started, future))
+            sys.stdout.flush()
+            time.sleep(poll_s)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def print_result(dirs, job_id):
+    '''输出作业日志，返回退出码'''
+    with open(os.path.join(dirs['done'], f"{job_id}.json")) as f:
+        result = json.load(f)
+    log_path = os.path.join(dirs['done'], f"{job_id}.log")
+    if os.path.exists(log_path):
+        with open(log_path) as f:
+            sys.stdout.write(f.read())
+    if result['error']:
+        print(result['error'])
+    print(f"{job_id} finished with {result['returncode']}")
+    return result['returncode']
+
+
+def submit(spool, argv, name='post', wait=True, poll_s=2.0, job_id=None):
+    '''
+    提交作业，wait时等待并返回作业的退出码；常驻进程不在时在本地运行并返回process_gfs的退出码
+    job_id：固定的作业号，重新提交时覆盖上一次的结果
+    '''
+    from zConfig import date_now_str
+
+    dirs = spool_dirs(spool)
+    job_id = job_id or f"{name}_{datetime.now().strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:8]}"
+    for suffix in ('json', 'log'):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(os.path.join(dirs['done'], f"{job_id}.{suffix}"))
+    job = {'id': job_id, 'argv': list(argv), 'date': date_now_str, 'host': os.uname().nodename,
+           'submitted': datetime.now().isoformat(timespec='seconds')}
+
+    if not worker_alive(spool):
+        print(f"no live worker on {spool}, running process_gfs locally")
+        started = datetime.now().isoformat(timespec='seconds')
+        returncode = call_main(argv)
+        write_json(os.path.join(dirs['done'], f"{job_id}.json"),
+                   dict(job, returncode=returncode, error=None, started=started,
+                        finished=datetime.now().isoformat(timespec='seconds')))
+        return returncode
+
+    write_json(os.path.join(dirs['incoming'], f"{job_id}.json"), job)
+    print(f"submitted {job_id}")
+    if not wait:
+        return 0
+    return wait_jobs(spool, [job_id], poll_s)
+
+
+def wait_jobs(spool, job_ids, poll_s=10.0, gone_s=WORKER_GONE_S):
+    '''等待各作业出现在done目录，返回最大的退出码；常驻进程停止超过gone_s秒时返回1'''
+    dirs = spool_dirs(spool)
+    pending = list(job_ids)
+    gone_since = None
+    returncode = 0
+    while pending:
+        for job_id in [job_id for job_id in pending if os.path.exists(os.path.join(dirs['done'], f"{job_id}.json"))]:
+            returncode = max(returncode, print_result(dirs, job_id) or 0)
+            pending.remove(job_id)
+        if not pending:
+            break
+        if worker_alive(spool):
+            gone_since = None
+        elif gone_since is None:
+            gone_since = time.time()
+        elif time.time() - gone_since > gone_s:
+            print(f"worker on {spool} stopped before {' '.join(pending)} finished")
+            return 1
+        time.sleep(poll_s)
+    return returncode
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="warm post-processing worker and its client")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = subparsers.add_parser('serve', help="run the long-lived worker")
+    serve_parser.add_argument("--spool", default="/fsx/post-spool")
+    serve_parser.add_argument("--jobs", type=int, help="domains processed at the same time, by default one per "
+                              f"{CPUS_PER_JOB} cpus of this host")
+    serve_parser.add_argument("--job-workers", type=int,
+                              help="--workers passed to each process_gfs run, by default the cpus of this host split over the jobs")
+    serve_parser.add_argument("--preload", nargs='*', default=[], help="domain directories whose weights are preloaded")
+
+    submit_parser = subparsers.add_parser('submit', help="queue one process_gfs run and wait for it")
+    submit_parser.add_argument("--spool", default="/fsx/post-spool")
+    submit_parser.add_argument("--name", default="post")
+    submit_parser.add_argument("--id", help="fixed job id, replaces the result of an earlier run with the same id")
+    submit_parser.add_argument("--no-wait", action='store_true')
+    submit_parser.add_argument("argv", nargs=argparse.REMAINDER, help="arguments of process_gfs.py after --")
+
+    args = parser.parse_args(argv)
+    if args.command == 'serve':
+        return serve(args.spool, args.jobs, args.job_workers, args.preload)
+    process_argv = args.argv[1:] if args.argv[:1] == ['--'] else args.argv
+    return submit(args.spool, process_argv, args.name, not args.no_wait, job_id=args.id)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,83 @@
+'''
+按需读取wrfout
+GFSwrfout_varnames.xlsx中列出的变量及其诊断量依赖的原始变量，每个文件只从磁盘读取一次，
+作为wrf-python的cache传给每次getvar；同名诊断量(如height_agl)在同一文件内只计算一次
+用with打开，退出时释放cache并关闭文件句柄
+'''
+import wrf
+from netCDF4 import Dataset
+
+# wrf-python诊断量所依赖的原始变量
+DIAG_DEPS = {
+    'z': ['PH', 'PHB', 'HGT'],
+    'height': ['PH', 'PHB', 'HGT'],
+    'height_agl': ['PH', 'PHB', 'HGT'],
+    'zstag': ['PH', 'PHB', 'HGT'],
+    'geopt': ['PH', 'PHB'],
+    'geopotential': ['PH', 'PHB'],
+    'ter': ['HGT'],
+    'pressure': ['P', 'PB'],
+    'p': ['P', 'PB'],
+    'tk': ['T', 'P', 'PB'],
+    'tc': ['T', 'P', 'PB'],
+    'theta': ['T'],
+    'th': ['T'],
+    'tv': ['T', 'P', 'PB', 'QVAPOR'],
+    'rh': ['T', 'P', 'PB', 'QVAPOR'],
+    'td': ['P', 'PB', 'QVAPOR'],
+    'eth': ['T', 'P', 'PB', 'QVAPOR'],
+    'theta_e': ['T', 'P', 'PB', 'QVAPOR'],
+    'slp': ['T', 'P', 'PB', 'QVAPOR', 'PH', 'PHB'],
+    'omega': ['T', 'P', 'PB', 'QVAPOR', 'W'],
+    'ua': ['U'],
+    'va': ['V'],
+    'wa': ['W'],
+}
+
+
+def cache_varnames(var_names, file_var_names):
+    '''var_names所需的、文件中实际存在的原始变量'''
+    needed = set()
+    for var_name in var_names:
+        needed.update(DIAG_DEPS.get(var_name, [var_name]))
+    return sorted(needed & set(file_var_names))
+
+
+class WrfoutReader:
+    '''
+    with WrfoutReader(path, var_surface_names + var_sigma_names + ['height_agl']) as wrfin:
+        wrfin.getvar('tk')
+    '''
+
+    def __init__(self, path, var_names):
+        self.path = path
+        self.var_names = list(var_names)
+        self.nc = None
+        self.cache = None
+        self.results = {}
+
+    def open(self):
+        self.nc = Dataset(self.path)
+        self.cache = wrf.extract_vars(self.nc, wrf.ALL_TIMES, cache_varnames(self.var_names, self.nc.variables),
+                                      method='cat')
+        return self
+
+    def getvar(self, var_name):
+        '''与wrf.getvar(wrfin, var_name, timeidx=wrf.ALL_TIMES, method='cat')相同，结果按变量名复用'''
+        if var_name not in self.results:
+            self.results[var_name] = wrf.getvar(self.nc, var_name, timeidx=wrf.ALL_TIMES, method='cat',
+                                                cache=self.cache)
+        return self.results[var_name]
+
+    def close(self):
+        self.cache = None
+        self.results = {}
+        if self.nc is not None:
+            self.nc.close()
+            self.nc = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,93 @@
+'''
+Zarr预报数据集
+按风机和预报时次分块写出，元数据合并为一个.zmetadata，读取一个风机或一个变量只需读取少量分块对象
+目录同步到S3后可以直接读取(需安装s3fs)：
+python zZarr.py s3://bucket/outputs/20230914/domain_1/gfs_zarr/GFS_20230914.zarr --id WT001 --vars ws wd
+'''
+import argparse
+import sys
+
+import numpy as np
+import xarray as xr
+import zarr
+
+# 每块8个风机、96个时次(15分钟间隔一天)
+ID_CHUNK = 8
+TIME_CHUNK = 96
+# zarr 3下写出v2格式，.zmetadata合并元数据在v2中是标准做法，旧版zarr也能读取
+ZARR_KWARGS = {'zarr_format': 2} if int(zarr.__version__.split('.')[0]) >= 3 else {}
+
+
+def zarr_encoding(ds, id_chunk=ID_CHUNK, time_chunk=TIME_CHUNK):
+    encoding = {}
+    for name in ds.data_vars:
+        dims = ds[name].dims
+        encoding[name] = {'chunks': tuple(min(id_chunk, size) if dim == 'id' else
+                                          min(time_chunk, size) if dim == 'time' else size
+                                          for dim, size in zip(dims, ds[name].shape))}
+    return encoding
+
+
+def write_zarr(ds_chunks, output_path, id_chunk=ID_CHUNK, time_chunk=TIME_CHUNK):
+    '''
+    ds_chunks可以是Dataset或按风机分块的Dataset迭代器，后续块沿id追加
+    风机块大小最好是id_chunk的整数倍，避免追加时改写已有分块
+    '''
+    if isinstance(ds_chunks, xr.Dataset):
+        ds_chunks = [ds_chunks]
+    first = True
+    for ds in ds_chunks:
+        ds = ds.assign_coords(id=ds['id'].astype(str))
+        if first:
+            ds.to_zarr(output_path, mode='w', consolidated=True,
+                       encoding=zarr_encoding(ds, id_chunk, time_chunk), **ZARR_KWARGS)
+            first = False
+        else:
+            ds.to_zarr(output_path, append_dim='id', consolidated=True, **ZARR_KWARGS)
+    return output_path
+
+
+def open_forecast(store, storage_options=None):
+    '''惰性打开，只读取合并元数据；之后的索引只读取涉及的分块'''
+    return xr.open_dataset(store, engine='zarr', consolidated=True, chunks=None,
+                           backend_kwargs={'storage_options': storage_options} if storage_options else None)
+
+
+def read_turbine(store, turbine_id, var_names=None, storage_options=None):
+    '''读取单个风机的全部时次，读取量为 变量数 × 时间块数 个分块'''
+    with open_forecast(store, storage_options) as ds:
+        if var_names:
+            ds = ds[list(var_names)]
+        return ds.sel(id=turbine_id).load()
+
+
+def read_variable(store, var_name, turbine_ids=None, storage_options=None):
+    '''读取单个变量，turbine_ids为空时读取所有风机'''
+    with open_forecast(store, storage_options) as ds:
+        da = ds[var_name]
+        if turbine_ids is not None:
+            da = da.sel(id=list(np.atleast_1d(turbine_ids)))
+        return da.load()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="read one turbine or one variable from a forecast Zarr store")
+    parser.add_argument("store", help="local path or s3:// url of the .zarr store")
+    parser.add_argument("--id", nargs='+', help="turbine ids")
+    parser.add_argument("--vars", nargs='+', help="variables, default all")
+    parser.add_argument("--output", help="write CSV here instead of stdout")
+    args = parser.parse_args(argv)
+    if not args.id and not args.vars:
+        parser.error("need --id and/or --vars")
+
+    with open_forecast(args.store) as ds:
+        if args.vars:
+            ds = ds[args.vars]
+        if args.id:
+            ds = ds.sel(id=args.id)
+        df = ds.load().to_dataframe()
+    df.to_csv(args.output or sys.stdout)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,13 @@
 # root_dir=/home/ec2-user/fsx # dev environment
 root_dir=/fsx
 monitor_home=$root_dir/monitor
+post_scripts_home=$root_dir/post-scripts
 job_monitor_log=$monitor_home/job_monitor.log
+# local copies of the content addressed sbatch scripts in s3://bucket/monitor/cache, named by sha256
+script_cache=$monitor_home/cache
+# job name -> sbatch script sha256 and job script sha256, refreshed once per run of this script
+script_index=$monitor_home/index
+monitor_start=$(date +%s)
 # record each domain run folder last modified date
 # sample /fsx/domain_1/run 12345678
 job_record=$monitor_home/job_record
@@ -53,6 +59,29 @@ log(){
   echo $current_datetime $message >> $job_monitor_log
 }
 
+# count wrf out files and get the latest modified time from the run folder manifest,
+# which is updated incrementally instead of listing and stat-ing every file on each tick
+# parameter: $1 run folder path
+# return: prints "<file number> <latest modified epoch>"
+wrfout_status(){
+  python3 $post_scripts_home/zManifest.py status $1 2>/dev/null || echo "0 0"
+}
+
+# get the domain a job runs for
+# per-domain jobs are named <stage>_domain_<n>, job arrays are named <stage>_array
+# and their tasks have ids <array job id>_<n> with the domain index as task id
+# parameter: $1 job name, $2 job id
+# return: prints domain name, e.g. domain_1
+domain_of(){
+  local name=$1
+  local id=$2
+  if [[ "$id" == *_* ]];then
+    echo "domain_${id##*_}"
+  else
+    echo $name | awk -F '_' '{printf "%s_%s",$2,$3}'
+  fi
+}
+
 # clear legacy files if failed job
 # since we check job output files to identify if job run successfully
 # so once job failed, it's required to clear legacy files
@@ -63,6 +92,7 @@ clear_legacy_file(){
   run_path="${root_dir}/${domain_name}/${WRF_JOB_FOLDER}"
   log "Cleaning legacy wrf out files in $run_path"
   rm -rf $run_path/wrfout_d* 2>/dev/null
+  rm -f $run_path/wrfout_manifest.json
   log "Cleaning legacy rsl files"
   rm -rf $run_path/rsl.out.* 2>/dev/null
   log "Cleaning done"
@@ -81,7 +111,7 @@ reach_max_retry(){
   fi
   record_id="${job_name}_${job_id}"
   log "Running pre-check before retry job $record_id"
-  retry_number=$(grep "$record_id" "$job_record" | awk '{print $4}')
+  retry_number=$(grep "^${record_id} " "$job_record" | awk '{print $4}')
   if [ -z "$retry_number" ];then
     retry_number=0
   fi
@@ -94,22 +124,29 @@ reach_max_retry(){
 
 retry_pre_job(){
   job_name=$1
+  job_id=$2
   log "Running specific pre option for job $job_name."
   log "Overriding namelist files with backup ones for job $job_name."
-  domain_name=$(echo $job_name | awk -F '_' '{printf "%s_%s",$2,$3}')
+  domain_name=$(domain_of $job_name $job_id)
   aws s3 cp "s3://$bucket/input/${domain_name}_backup/namelist.wps" "$root_dir/${domain_name}/${PRE_JOB_FOLDER}/" --quiet
 }
 
 retry_wrf_job(){
   job_name=$1
+  job_id=$2
   log "Running specific wrf option for job $job_name."
-  domain_name=$(echo $job_name | awk -F '_' '{printf "%s_%s",$2,$3}')
+  domain_name=$(domain_of $job_name $job_id)
   log "Overriding namelist files with backup ones for domain $domain_name"
   aws s3 cp "s3://${bucket}/input/${domain_name}_backup/namelist.wps" "${root_dir}/${domain_name}/${PRE_JOB_FOLDER}/" --quiet
   aws s3 cp "s3://${bucket}/input/${domain_name}_backup/namelist.input" "${root_dir}/${domain_name}/${WRF_JOB_FOLDER}/" --quiet
   clear_legacy_file $domain_name
 }
 
+retry_ungrib_job(){
+  job_name=$1
+  log "Running specific ungrib option for job $job_name."
+}
+
 retry_post_job(){
   job_name=$1
   log "Running specific post option for job $job_name."
@@ -125,15 +162,12 @@ update_retry_num(){
   job_name=$2
   record_id="${job_name}_${job_id}"
   log "Updating retry number for job $record_id"
-  domain_name=$(echo $job_name | awk -F '_' '{printf "%s_%s\n",$2,$3}')
+  domain_name=$(domain_of $job_name $job_id)
   run_path="${root_dir}/${domain_name}/${WRF_JOB_FOLDER}"
-  retry_number=$(grep "$record_id" "$job_record" | awk '{printf $4}')
-  latest_wrf_file_num=$(ls $run_path | grep wrfout_d | wc -l)
-  if [ $latest_wrf_file_num -eq 0 ];then
-    latest_modified=0
-  else
-    latest_modified=$(ls -1 ${run_path}/wrfout_d* -t | head -n 1 | xargs stat -c %Y)
-  fi
+  retry_number=$(grep "^${record_id} " "$job_record" | awk '{printf $4}')
+  wrf_status=($(wrfout_status $run_path))
+  latest_wrf_file_num=${wrf_status[0]}
+  latest_modified=${wrf_status[1]}
   if [ -z "$retry_number" ];then
     log "$retry_number is initialized to 0 for job ${record_id}"
     retry_number=$MAX_RETRY_NUM
@@ -149,7 +183,7 @@ scan_failed_job(){
   log "Scanning failed job ..."
   output_fields="%.i %.j %.E %.R"
   job_status="F"
-  squeue -h -t $job_status -o "$output_fields" | while read -r failed_job;do
+  squeue -r -h -t $job_status -o "$output_fields" | while read -r failed_job;do
     retry_failed_job "$failed_job"
   done
 }
@@ -178,7 +212,7 @@ retry_common(){
   job_prefix=$(echo $job_name | awk -F '_' '{print $1}')
   func_name="retry_${job_prefix}_job"
   log "Running function $func_name to retry"
-  $func_name $job_name
+  $func_name $job_name $job_id
   new_job_id=$(resubmit $job_name $job_id)
   log "Got new job id after retry $new_job_id"
   if [ -n "$new_job_id" ];then
@@ -188,22 +222,79 @@ retry_common(){
   fi
 }
 
+# download the script index written by the forecast lambda, at most once per run of this script
+# return: 0 if the index is available
+fetch_script_index(){
+  if [ -f $script_index ] && [ $(stat -c %Y $script_index) -ge $monitor_start ];then
+    return 0
+  fi
+  log "Downloading script index"
+  # aws s3 cp keeps the object's last modified time, touch it to mark this run's copy
+  aws s3 cp "s3://$bucket/monitor/index" $script_index --quiet && touch $script_index
+}
+
+# make sure the script with the given sha256 is in the local cache, downloading it only once
+# parameter: $1 sha256 of the script
+# return: 0 if $script_cache/<sha256>.sh is available
+fetch_cached_script(){
+  digest=$1
+  cached_file="${script_cache}/${digest}.sh"
+  if [ -f $cached_file ];then
+    return 0
+  fi
+  log "Downloading script $digest"
+  mkdir -p $script_cache
+  aws s3 cp "s3://$bucket/monitor/cache/${digest}.sh" $cached_file.tmp --quiet
+  if [ "$(sha256sum $cached_file.tmp 2>/dev/null | awk '{print $1}')" != "$digest" ];then
+    log "Script $digest download failed or content does not match its hash"
+    rm -f $cached_file.tmp
+    return 1
+  fi
+  mv $cached_file.tmp $cached_file
+}
+
+# drop the local copies of scripts the last downloaded index no longer references,
+# the forecast lambda deletes them from s3://bucket/monitor/cache the same way
+# return: no return
+prune_script_cache(){
+  if [ ! -f $script_index ];then
+    return 0
+  fi
+  for cached_file in $script_cache/*.sh;do
+    [ -f "$cached_file" ] || continue
+    digest=$(basename $cached_file .sh)
+    if ! grep -q " ${digest}\( \|$\)" $script_index;then
+      rm -f $cached_file
+    fi
+  done
+}
+
 resubmit(){
   job_name=$1
   job_id=$2
 
-  sbatch_file="${monitor_home}/${job_name}.sh"
-  if [ ! -f $sbatch_file ];then
-    log "Downloading sbatch script ${job_name}.sh for job $job_id"
-    aws s3 cp "s3://$bucket/monitor/${job_name}.sh" $monitor_home --quiet
-    aws s3 cp "s3://$bucket/monitor/${job_name}_script.sh" $monitor_home --quiet
+  sbatch_file=""
+  fetch_script_index
+  digests=($(grep "^${job_name} " $script_index 2>/dev/null))
+  sbatch_digest=${digests[1]}
+  script_digest=${digests[2]}
+  # the sbatch script runs in $monitor_home and sources ./cache/<job script sha256>.sh
+  if [ -n "$sbatch_digest" ] && fetch_cached_script $sbatch_digest && fetch_cached_script $script_digest;then
+    sbatch_file="${script_cache}/${sbatch_digest}.sh"
+  fi
+  # only the failed task of a job array is resubmitted, as a new array holding just that task id
+  array_option=""
+  array_task=""
+  if [[ "$job_id" == *_* ]];then
+    array_task=_${job_id##*_}
+    array_option="--array=${job_id##*_}"
   fi
   # in case download failed, let's check it again
-  if [ -f $sbatch_file ];then
-    result=$(sbatch $sbatch_file)
+  if [ -n "$sbatch_file" ] && [ -f $sbatch_file ];then
+    result=$(sbatch $array_option $sbatch_file)
     log "sbatch running result $result after resubmit"
     if [ $? -eq 0 ];then
-      new_job_id=$(echo "$result" | grep -oP [0-9]+)
+      new_job_id=$(echo "$result" | grep -oP [0-9]+)$array_task
       log "Job $job_id resubmit succeeded, new job id is $new_job_id"
       echo $new_job_id
     else
@@ -211,7 +302,7 @@ resubmit(){
       echo ""
     fi
   else
-    log "$sbatch_file not found, please check if s3://$bucket/monitor/${job_name}.sh existed"
+    log "sbatch script of $job_name not found, please check if s3://$bucket/monitor/index lists it"
     echo ""
   fi
 }
@@ -234,15 +325,12 @@ running_job_retry_precheck(){
     log "Job $job_name is not a wrf job"
     return 1
   fi
-  domain_name=$(echo $job_name | awk -F '_' '{printf "%s_%s",$2,$3}')
+  domain_name=$(domain_of $job_name $job_id)
   run_path="${root_dir}/${domain_name}/$WRF_JOB_FOLDER"
-  latest_wrf_file_num=$(ls $run_path | grep wrfout_d | wc -l)
-  if [ $latest_wrf_file_num -eq 0 ];then
-    latest_modified=0
-  else
-    latest_modified=$(ls -1 ${run_path}/wrfout_d* -t | head -n 1 | xargs stat -c %Y)
-  fi
-  record=$(grep "$record_id" "$job_record")
+  wrf_status=($(wrfout_status $run_path))
+  latest_wrf_file_num=${wrf_status[0]}
+  latest_modified=${wrf_status[1]}
+  record=$(grep "^${record_id} " "$job_record")
   log "Checking if record $record is empty"
   if [ -z "$record" ];then
     last_modified=0
@@ -284,10 +372,11 @@ update_job_record(){
   latest_modified=$2
   latest_wrf_file_num=$3
   retry_number=$4
-  record=$(grep "${record_id}" "${job_record}")
+  # the trailing space keeps wrf_array_12_1 from matching wrf_array_12_10
+  record=$(grep "^${record_id} " "${job_record}")
   log "Handling record $record_id with latest_modified: $latest_modified, latest_wrf_file_num: $latest_wrf_file_num, retry_number: $retry_number"
   if [ -n "$record" ];then
-    sed_command="s/^${record_id}.*/${record_id} ${latest_modified} ${latest_wrf_file_num} ${retry_number}/"
+    sed_command="s/^${record_id} .*/${record_id} ${latest_modified} ${latest_wrf_file_num} ${retry_number}/"
     log "Will run below command: sed -i $sed_command"
     sed -i "$sed_command" $job_record
     if [ $? -eq 0 ];then
@@ -305,7 +394,7 @@ scan_running_wrf_job(){
   log "Scanning long time running wrf job ..."
   output_fields="%.i %.j %.E %.R"
   job_status="R"
-  squeue -h -t $job_status -o "$output_fields" | while read -r running_job; do
+  squeue -r -h -t $job_status -o "$output_fields" | while read -r running_job; do
     retry_running_wrf_job "$running_job"
   done
 }
@@ -327,6 +416,42 @@ retry_running_wrf_job(){
   fi
 }
 
+# replace a job inside a dependency list and keep every other job of it
+# parameter: $1 dependency as shown by squeue, e.g. afterok:45(unfulfilled),afterok:46(failed)
+#            $2 id of the replaced job, array task ids of it (45_*) are replaced too
+#            $3 replacement, e.g. afterok:47
+# return: prints the new dependency, or nothing if $1 doesn't name the replaced job
+rewrite_dependency(){
+  local dependency=$1
+  local old_id=$2
+  local replacement=$3
+  local found=""
+  local items=()
+  local deps ids kept dep dep_type token id
+  IFS=',' read -ra deps <<< "$dependency"
+  for dep in "${deps[@]}";do
+    dep_type=${dep%%:*}
+    IFS=':' read -ra ids <<< "${dep#*:}"
+    kept=()
+    for token in "${ids[@]}";do
+      id=${token%%(*}
+      if [ "${id%%_*}" == "$old_id" ];then
+        found=1
+      elif [[ "$token" != *"(satisfied)"* ]] && [ -n "$id" ];then
+        # satisfied jobs may already be purged from slurmctld and would be rejected
+        kept+=("$id")
+      fi
+    done
+    if [ ${#kept[@]} -gt 0 ];then
+      items+=("${dep_type}:$(IFS=':'; echo "${kept[*]}")")
+    fi
+  done
+  if [ -n "$found" ];then
+    items+=("$replacement")
+    (IFS=','; echo "${items[*]}")
+  fi
+}
+
 update_job_dependency(){
   old_job_id=$1
   new_job_id=$2
@@ -335,25 +460,42 @@ update_job_dependency(){
   output_fields="%.i %.j %.E %.R"
   job_status="PD"
   expected_pending_reason="(DependencyNeverSatisfied)"
-  squeue -h -t $job_status -o "$output_fields" | while read -r pending_job;do
+  # array task ids are <array job id>_<task id>, dependencies name the array job id
+  old_array_id=${old_job_id%%_*}
+  old_task=""
+  if [[ "$old_job_id" == *_* ]];then
+    old_task=${old_job_id##*_}
+  fi
+  # -r lists every pending array task on its own line instead of 123_[1-20]
+  squeue -r -h -t $job_status -o "$output_fields" | while read -r pending_job;do
     log "Verifying pending job $pending_job"
     # DO not use double quote to enclose $pending_job variable, or it will not be split by space
     job_props=($pending_job)
     job_id=${job_props[0]}
     job_name=${job_props[1]}
-    # afterok:45(failed)
+    # afterok:45(failed); a task of the wrf or post array: aftercorr:45_*(failed)
     job_dependency=${job_props[2]}
     job_reason=${job_props[3]}
     log "Comparing job_reason: $job_reason, expected_pending_reason:$expected_pending_reason"
-    failed_job_id=$(echo "$job_dependency" | grep -oP [0-9]+)
-    if [ -z "$failed_job_id" ];then
-      continue
+    replacement=afterok:$new_job_id
+    if [ -n "$old_task" ];then
+      if [[ "$job_id" == *_* ]];then
+        # aftercorr: only the task with the same domain index waits for the resubmitted task
+        if [ "${job_id##*_}" != "$old_task" ];then
+          continue
+        fi
+      else
+        # fini waits for the whole post array: the other tasks of the old array and the resubmitted task
+        replacement=afterany:$old_array_id,afterok:$new_job_id
+      fi
     fi
-    log "Comparing failed job id: $failed_job_id, depended job id: $old_job_id"
-    if [ $failed_job_id -eq $old_job_id ];then
+    # fini depends on the post job of every domain, e.g. afterok:45:46:47; only the resubmitted job is replaced
+    new_dependency=$(rewrite_dependency "$job_dependency" $old_array_id $replacement)
+    log "Comparing dependency $job_dependency with depended job id: $old_array_id"
+    if [ -n "$new_dependency" ];then
       log "Found depending job $job_id and the pending reason is $job_reason"
-      log "Updating depending job dependency from $old_job_id to $new_job_id"
-      result=$(scontrol update jobid=$job_id dependency=afterok:$new_job_id)
+      log "Updating depending job dependency from $old_job_id to $new_dependency"
+      result=$(scontrol update jobid=$job_id dependency=$new_dependency)
       if [ $? -eq 0 ];then
         log "Job dependency update succeeded"
       else
@@ -371,6 +513,8 @@ fi
 
 scan_failed_job
 scan_running_wrf_job
+# job scripts stay the same across cycles, only the sbatch headers of old cycles go out of the index
+prune_script_cache
 # upload log and record file to s3 for further troubleshooting
 #aws s3 cp $job_monitor_log "s3://$bucket/output/" --quiet
 #aws s3 cp $job_record "s3://$bucket/monitor/" --quiet
@@ -282,6 +282,8 @@ build_dir(){
      mkdir -p $jobdir/post/gfs_cut
      mkdir -p $jobdir/post/gfs_netcdf
      mkdir -p $jobdir/post/gfs_excel
+     mkdir -p $jobdir/post/gfs_parquet
+     mkdir -p $jobdir/post/gfs_zarr
      mkdir -p $jobdir/post/logs
      mkdir -p $jobdir/post/record
      # create pre-proc folder
@@ -318,20 +320,53 @@ build_dir(){
      aws s3 cp s3://${bucket_name}/input/$jobdir/GFSwrfout_varnames.xlsx $jobdir/post/
      aws s3 cp s3://${bucket_name}/input/$jobdir/locations.xlsx $jobdir/post/
   done
+  # the shared ungrib job decodes the GFS files here once for all domains
+  mkdir -p ungrib
+  ln -sf ${WPS_DIR}/link_grib.csh ungrib/
+  ln -sf ${WPS_DIR}/ungrib.exe ungrib/ungrib.exe
+  ln -sf ${WPS_DIR}/ungrib/Variable_Tables/Vtable.GFS ungrib/Vtable
   mkdir -p /fsx/post-scripts
   aws s3 cp s3://$2/input/post-scripts /fsx/post-scripts/ --recursive
   echo "post scripts copied to /fsx/post-scripts"
   mkdir downloads
   gfs="gfs"
   gfs=$gfs.$y$m$d
-  for i in $(seq -f "%02g"  0 3 96)
-  do
-     aws s3 cp --no-sign-request s3://noaa-gfs-bdp-pds/${gfs}/${h}/atmos/gfs.t${h}z.pgrb2.0p50.f0$i downloads/ --quiet
-  done
+  # only the GRIB messages Vtable.GFS uses, fetched as concurrent byte ranges; whole files one by one if that fails
+  chown ec2-user:ec2-user downloads
+  if ! sudo -u ec2-user bash -lc "cd $(pwd) && conda activate yunda-python39 && python /fsx/post-scripts/zDownload.py ${y}${m}${d}${h} downloads/ --vtable ${WPS_DIR}/ungrib/Variable_Tables/Vtable.GFS --hours 0:96:3 --no-sign-request"
+  then
+     echo "partial GFS download failed, downloading the full files"
+     for i in $(seq -f "%02g"  0 3 96)
+     do
+        aws s3 cp --no-sign-request s3://noaa-gfs-bdp-pds/${gfs}/${h}/atmos/gfs.t${h}z.pgrb2.0p50.f0$i downloads/ --quiet
+     done
+  fi
   chown -R ec2-user:ec2-user .
   mkdir -p /fsx/monitor
 }
 
+# post processing dependencies that are not on the AMI yet, installed into the post environment
+# without touching the packages already there; process_gfs skips an export whose package is missing
+install_post_dependencies(){
+  sudo -u ec2-user bash -lc "conda install -y -n yunda-python39 -c conda-forge --freeze-installed pyarrow=14.0.2 zarr=2.18.2 psutil" \
+    || echo "installing the post processing dependencies failed"
+  # s3fs is only used to read the zarr stores from s3; it pulls aiobotocore, which pins botocore,
+  # so it goes on its own and a conflict with the installed boto3 leaves the writers above in place
+  sudo -u ec2-user bash -lc "conda install -y -n yunda-python39 -c conda-forge --freeze-installed s3fs" \
+    || echo "installing s3fs failed, the zarr stores can still be read after downloading them"
+}
+
+# long-lived post processing worker on the head node, the one-cpu post job of each domain queues it
+# in /fsx/post-spool and waits for the result; the worker sizes its concurrent domains and their
+# --workers from the head node's cpus. A second start exits at once, so cron keeps it alive
+start_post_worker(){
+  mkdir -p /fsx/post-spool
+  chown ec2-user:ec2-user /fsx/post-spool
+  worker_cmd="sudo -u ec2-user bash -lc 'cd /fsx/post-scripts && conda activate yunda-python39 && python zWorker.py serve --spool /fsx/post-spool --preload /fsx/domain_*' >> /fsx/post-spool/worker.log 2>&1"
+  (crontab -l; echo "*/2 * * * * ${worker_cmd}") | sort -u | crontab -
+  nohup bash -c "${worker_cmd}" > /dev/null 2>&1 &
+}
+
 echo "NODE TYPE: ${cfn_node_type}"
 
 case ${cfn_node_type} in
@@ -349,6 +384,9 @@ case ${cfn_node_type} in
     aws s3 cp s3://${bucket}/monitor/job_monitor.sh /fsx/monitor/job_monitor.sh
     chmod u+x /fsx/monitor/job_monitor.sh
     (crontab -l; echo "*/2 * * * * /fsx/monitor/job_monitor.sh ${bucket}") | sort -u | crontab -
+    echo "Begin to start the warm post worker"
+    install_post_dependencies
+    start_post_worker
         ;;
         ComputeFleet)
                 echo "I am a Compute node"
@@ -61,6 +61,7 @@ class Forecast(NestedStack):
                     "BUCKET_NAME": bucket_name,
                     "DOMAINS_NUM": domains,
                     "FORECAST_DAYS":forecast_days,
+                    "ARRAY_JOBS":"false",
                 },
                 handler="forecast.main",
                 layers=[layer],